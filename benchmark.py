@@ -0,0 +1,1314 @@
+"""
+Benchmarks for the WithSecure export tools, run against the local mock API.
+
+    python benchmark.py pagination --devices 100000
+    python benchmark.py concurrency --organizations 100 --latency 0.05
+    python benchmark.py connections --organizations 50
+    python benchmark.py retries
+    python benchmark.py tokens
+    python benchmark.py resume --trials 5
+    python benchmark.py memory --sizes 10000 100000 1000000
+    python benchmark.py formats --devices 200000
+    python benchmark.py transform --devices 1000000
+    python benchmark.py decode --devices 50000
+    python benchmark.py batch --accounts 4
+    python benchmark.py filters --devices 5000
+    python benchmark.py cache --latency 0.02
+    python benchmark.py fleet --sizes 100000 1000000
+    python benchmark.py shards --workers 1 2 4 8
+    python benchmark.py diff --devices 500000
+    python benchmark.py loadtest --organizations 20 --devices 5000 --error-rate 0.01 --rate-limit 50
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from itertools import chain
+from urllib.parse import parse_qs
+
+import requests
+
+import withsecure_writers
+from mock_withsecure_api import MockConfig, make_device, make_self_signed_cert, make_ssl_context, start_mock_server
+from withsecure_api import DevicePage, WithSecureAPIError, WithSecureClient
+from withsecure_batch import Account, format_summary, run_batch
+from withsecure_device_cache import CHANGE_ADDED, CHANGE_REMOVED, CHANGE_UPDATED
+from withsecure_export import checkpoint_path_for, export_csv_checkpointed, export_pages, iter_organization_devices
+from withsecure_fleet import FleetSummary
+from withsecure_metrics import RunMetrics
+from withsecure_profiles import EXPORT_PROFILES, ExportProfile
+from withsecure_response_cache import ResponseCache
+from withsecure_schema import bytes_to_gb_str
+from withsecure_shards import run_sharded_export
+from withsecure_snapshots import take_snapshot, write_change_report
+from withsecure_writers import OUTPUT_FORMATS, open_writer
+
+
+def measure(func):
+    """
+    Run func and return (result, elapsed seconds, peak traced memory in MB).
+    """
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        result = func()
+    finally:
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, elapsed, peak / (1024 ** 2)
+
+
+def bench_pagination(args):
+    """
+    Check that following nextAnchor returns every device exactly once and compare
+    peak memory of streaming pages against holding the whole organization.
+    """
+    config = MockConfig(organizations=1, devices_per_org=args.devices, max_page_size=args.page_size)
+    server = start_mock_server(config)
+    client = WithSecureClient(base_url=server.base_url, rate_limit=0)
+    client.authenticate("mock-id", "mock-secret")
+    org_id = config.organization_items()[0]["id"]
+
+    def streamed():
+        seen = set()
+        for device in chain.from_iterable(client.iter_device_pages(org_id)):
+            seen.add(device["id"])
+        return len(seen)
+
+    def materialized():
+        devices = list(chain.from_iterable(client.iter_device_pages(org_id)))
+        return len({device["id"] for device in devices})
+
+    try:
+        for label, func in (("streamed", streamed), ("materialized", materialized)):
+            unique, elapsed, peak_mb = measure(func)
+            status = "complete" if unique == args.devices else f"INCOMPLETE ({unique}/{args.devices})"
+            print(f"{label:>13}: {unique} devices, {elapsed:.2f}s, peak {peak_mb:.1f} MB, {status}")
+            if unique != args.devices:
+                raise SystemExit(f"{label}: {unique} of {args.devices} devices listed")
+    finally:
+        client.close()
+        server.shutdown()
+
+
+def bench_concurrency(args):
+    """
+    Compare serial and concurrent wall-clock time across many organizations on a
+    mock API with injected latency, and check both produce the same device order.
+    """
+    config = MockConfig(args.organizations, args.devices, args.page_size, args.latency)
+    server = start_mock_server(config)
+    client = WithSecureClient(base_url=server.base_url, rate_limit=0)
+    client.authenticate("mock-id", "mock-secret")
+    organizations = config.organization_items()
+
+    try:
+        results = {}
+        for workers in (1, args.workers):
+            started = time.perf_counter()
+            order = [
+                device["id"]
+                for _, page in iter_organization_devices(organizations, client.iter_device_pages, max_workers=workers)
+                for device in page
+            ]
+            elapsed = time.perf_counter() - started
+            results[workers] = order
+            print(f"{workers:>3} worker(s): {len(order)} devices in {elapsed:.2f}s")
+        print("row order identical:", results[1] == results[args.workers])
+    finally:
+        client.close()
+        server.shutdown()
+
+
+def legacy_export(base_url, verify, workers):
+    """
+    The request pattern used before the pooled client: a bare requests call per
+    request, each opening its own connection.
+    """
+    response = requests.post(f"{base_url}/as/token.oauth2", data={"grant_type": "client_credentials"}, verify=verify)
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    organizations = requests.get(f"{base_url}/organizations/v1/organizations", headers=headers, verify=verify).json()["items"]
+
+    def fetch_pages(org_id):
+        params = {"organizationId": org_id, "limit": 200}
+        while True:
+            body = requests.get(f"{base_url}/devices/v1/devices", params=params, headers=headers, verify=verify).json()
+            yield body["items"]
+            if not body.get("nextAnchor"):
+                break
+            params["anchor"] = body["nextAnchor"]
+
+    return sum(len(page) for _, page in iter_organization_devices(organizations, fetch_pages, max_workers=workers))
+
+
+def pooled_export(base_url, verify, workers):
+    with WithSecureClient(base_url=base_url, verify=verify, rate_limit=0) as client:
+        client.authenticate("mock-id", "mock-secret")
+        organizations = client.get_organizations()
+        pages = iter_organization_devices(organizations, client.iter_device_pages, max_workers=workers)
+        return sum(len(page) for _, page in pages)
+
+
+def bench_connections(args):
+    """
+    Count the connections opened by one full export against an HTTPS mock API,
+    with bare requests calls and with the pooled client.
+    """
+    config = MockConfig(args.organizations, args.devices, args.page_size, args.latency)
+    with tempfile.TemporaryDirectory() as cert_dir:
+        cert_path, key_path = make_self_signed_cert(cert_dir)
+        server = start_mock_server(config, ssl_context=make_ssl_context(cert_path, key_path))
+        try:
+            for label, export in (("bare requests", legacy_export), ("pooled client", pooled_export)):
+                server.reset_stats()
+                started = time.perf_counter()
+                devices = export(server.base_url, cert_path, args.workers)
+                elapsed = time.perf_counter() - started
+                print(
+                    f"{label:>13}: {devices} devices, {server.responses_sent} requests, "
+                    f"{server.connections_opened} connections, "
+                    f"{server.bytes_sent / 1024 ** 2:.1f} MB received, {elapsed:.2f}s"
+                )
+        finally:
+            server.shutdown()
+
+
+def bench_retries(args):
+    """
+    Replay scripted 429/5xx sequences from the mock API and check the client
+    recovers (or gives up) as expected, then check the token bucket pacing.
+    """
+    config = MockConfig(organizations=1, devices_per_org=10)
+    server = start_mock_server(config)
+    org_id = config.organization_items()[0]["id"]
+    scenarios = [
+        ("429 with Retry-After: 1", [429], 1, True),
+        ("503, 503, 502", [503, 503, 502], None, True),
+        ("503 x 4, max_retries=3", [503] * 4, None, False),
+    ]
+
+    try:
+        for label, statuses, retry_after, should_succeed in scenarios:
+            config.script_failures(statuses, retry_after)
+            client = WithSecureClient(base_url=server.base_url, rate_limit=0, max_retries=3)
+            client.authenticate("mock-id", "mock-secret")
+            started = time.perf_counter()
+            try:
+                devices = sum(len(page) for page in client.iter_device_pages(org_id))
+                outcome = f"recovered, {devices} devices"
+                succeeded = True
+            except WithSecureAPIError as e:
+                outcome = f"gave up with status {e.status_code}"
+                succeeded = False
+            elapsed = time.perf_counter() - started
+            stats = client.stats["devices"]
+            result = "ok" if succeeded == should_succeed else "UNEXPECTED"
+            print(
+                f"{label:>24}: {outcome} after {stats['retries']} retries, "
+                f"{stats['wait_seconds']:.2f}s waiting, {elapsed:.2f}s total [{result}]"
+            )
+            client.close()
+            config.failures.clear()
+            if succeeded != should_succeed:
+                raise SystemExit(f"{label}: the client {'gave up' if should_succeed else 'recovered'} unexpectedly")
+
+        client = WithSecureClient(base_url=server.base_url, rate_limit=args.rate)
+        client.authenticate("mock-id", "mock-secret")
+        started = time.perf_counter()
+        for _ in range(args.requests):
+            client.get_organizations()
+        elapsed = time.perf_counter() - started
+        # authenticate() took one token from the bucket as well
+        expected = max(0.0, (args.requests + 1 - client.rate_limiter.capacity) / args.rate)
+        print(
+            f"{'token bucket':>24}: {args.requests} requests at {args.rate:g}/s took {elapsed:.2f}s "
+            f"(expected ~{expected:.2f}s), {client.stats['organizations']['wait_seconds']:.2f}s waiting"
+        )
+        client.close()
+    finally:
+        server.shutdown()
+
+
+def bench_tokens(args):
+    """
+    Run an export that outlives several access tokens, revoking all tokens once
+    midway, and report how many tokens were issued and how many 401s were replayed.
+    """
+    config = MockConfig(args.organizations, args.devices, latency=args.latency, token_lifetime=args.token_lifetime)
+    server = start_mock_server(config)
+    client = WithSecureClient(base_url=server.base_url, rate_limit=0)
+
+    def revoke_all():
+        with config.lock:
+            config.tokens.clear()
+
+    try:
+        client.authenticate("mock-id", "mock-secret")
+        organizations = config.organization_items()
+        revoke = threading.Timer(args.revoke_after, revoke_all)
+        revoke.start()
+        started = time.perf_counter()
+        pages = iter_organization_devices(organizations, client.iter_device_pages, max_workers=args.workers)
+        devices = sum(len(page) for _, page in pages)
+        elapsed = time.perf_counter() - started
+        revoke.cancel()
+
+        complete = devices == args.organizations * args.devices
+        print(
+            f"{devices} devices in {elapsed:.2f}s ({'complete' if complete else 'INCOMPLETE'}), "
+            f"{config.tokens_issued} tokens issued, {client.tokens.refreshes} refreshes, "
+            f"{server.unauthorized_sent} requests rejected with 401 and replayed"
+        )
+        if not complete:
+            raise SystemExit(f"{devices} of {args.organizations * args.devices} devices exported")
+    finally:
+        client.close()
+        server.shutdown()
+
+
+def run_export_worker(args):
+    """
+    Run a checkpointed Extended export against a mock API; used as the victim
+    process of the resume benchmark. The fleet totals and OS counts are saved to
+    <output>.fleet.json.
+    """
+    from WithSecure_API_Export_Tool_Extended import SCHEMA
+
+    withsecure_writers.FLUSH_INTERVAL = args.flush_interval
+    fleet = FleetSummary()
+    with WithSecureClient(base_url=args.base_url, rate_limit=0) as client:
+        client.authenticate("mock-id", "mock-secret")
+        export_csv_checkpointed(
+            args.output,
+            SCHEMA.header,
+            client.get_organizations(),
+            lambda org_id, anchor: client.iter_device_pages(org_id, anchor=anchor),
+            SCHEMA.build_rows,
+            resume=args.resume,
+            max_workers=args.workers,
+            fleet=fleet
+        )
+    with open(args.output + ".fleet.json", "w", encoding="utf-8") as file:
+        json.dump({"totals": fleet.totals(), "operating_systems": fleet.operating_systems()}, file)
+
+
+def bench_resume(args):
+    """
+    Fault injection: kill export processes at random points (possibly several times
+    per export), resume them until they finish, and check each output is
+    byte-identical to an uninterrupted export, with the same fleet summary.
+    """
+    config = MockConfig(args.organizations, args.devices, args.page_size, args.latency)
+    server = start_mock_server(config)
+    total_rows = args.organizations * args.devices
+
+    def worker_command(output, resume):
+        command = [
+            sys.executable, os.path.abspath(__file__), "export-worker",
+            "--base-url", server.base_url, "--output", output, "--workers", str(args.workers),
+            "--flush-interval", str(args.flush_interval)
+        ]
+        return command + (["--resume"] if resume else [])
+
+    def rows_checkpointed(output):
+        try:
+            with open(checkpoint_path_for(output), encoding="utf-8") as file:
+                return json.load(file)["rows"]
+        except (OSError, ValueError):
+            return 0
+
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            reference = os.path.join(folder, "reference.csv")
+            subprocess.run(worker_command(reference, False), check=True)
+            with open(reference, "rb") as file:
+                expected = file.read()
+            with open(reference + ".fleet.json", "rb") as file:
+                expected_fleet = file.read()
+
+            failures = 0
+            for trial in range(1, args.trials + 1):
+                output = os.path.join(folder, f"trial_{trial}.csv")
+                kills = 0
+                resume = False
+                while True:
+                    process = subprocess.Popen(worker_command(output, resume))
+                    if kills < args.max_kills:
+                        kill_at = random.randint(1, total_rows - 1)
+                        while process.poll() is None and rows_checkpointed(output) < kill_at:
+                            time.sleep(0.005)
+                        if process.poll() is None:
+                            process.kill()
+                            process.wait()
+                            kills += 1
+                            resume = True
+                            continue
+                    if process.wait() == 0:
+                        break
+                    resume = True
+
+                with open(output, "rb") as file:
+                    identical = file.read() == expected
+                with open(output + ".fleet.json", "rb") as file:
+                    identical = identical and file.read() == expected_fleet
+                failures += not identical
+                print(f"trial {trial}: killed {kills} time(s), output {'identical' if identical else 'DIFFERENT'}")
+            print(f"{args.trials - failures}/{args.trials} resumed exports byte-identical to an uninterrupted run")
+            if failures:
+                raise SystemExit(f"{failures} resumed exports differ from the uninterrupted run")
+    finally:
+        server.shutdown()
+
+
+def peak_rss_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 ** 2) if sys.platform == "darwin" else peak / 1024
+
+
+def run_memory_worker(args):
+    """
+    Export synthetic devices in one process and print its peak RSS; used by the
+    memory benchmark so each run starts from a clean process.
+    """
+    from WithSecure_API_Export_Tool_Extended import SCHEMA
+
+    per_org = 10000
+    organizations = [
+        {"id": f"org-{index:05d}", "name": f"Organization {index:05d}"}
+        for index in range((args.devices + per_org - 1) // per_org)
+    ]
+    org_sizes = {org["id"]: min(per_org, args.devices - index * per_org) for index, org in enumerate(organizations)}
+
+    def fetch_pages(org_id, anchor=None):
+        size = org_sizes[org_id]
+        for start in range(0, size, 200):
+            end = min(start + 200, size)
+            yield DevicePage([make_device(org_id, index) for index in range(start, end)], str(end) if end < size else None)
+
+    if args.mode == "streaming":
+        export_csv_checkpointed(args.output, SCHEMA.header, organizations, fetch_pages, SCHEMA.build_rows)
+    else:
+        # The pipeline before streaming: every row in a list, written at the end
+        data = []
+        for org in organizations:
+            for page in fetch_pages(org["id"]):
+                data.extend(SCHEMA.build_rows(org["name"], page))
+        with open(args.output, mode="w", newline="", encoding="utf-8") as file:
+            file.write("\ufeff")
+            writer = csv.writer(file)
+            writer.writerow(SCHEMA.header)
+            writer.writerows(data)
+    print(f"{peak_rss_mb():.1f}")
+
+
+def process_rss_mb(pid):
+    """
+    Current RSS of a process in MB, read from /proc; None where that is not available.
+    """
+    try:
+        with open(f"/proc/{pid}/status", encoding="ascii") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+# Tool scripts exercised by the load test
+LOADTEST_TOOLS = {
+    "basic": "WithSecure_API_Export_Tool.py",
+    "extended": "WithSecure_API_Export_Tool_Extended.py",
+}
+
+
+def bench_loadtest(args):
+    """
+    Run the tool scripts themselves, as separate processes on their command line,
+    against a mock API with latency, random errors, 429 throttling and short-lived
+    tokens. Samples devices served and the exporter's RSS over time, and reads the
+    request latency percentiles from the exporter's run report.
+    """
+    config = MockConfig(
+        organizations=args.organizations,
+        devices_per_org=args.devices,
+        latency=args.latency,
+        token_lifetime=args.token_lifetime,
+        latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate,
+        rate_limit=args.rate_limit,
+        seed=args.seed
+    )
+    server = start_mock_server(config)
+    total = args.organizations * args.devices
+    results = {}
+
+    try:
+        for tool in args.tools:
+            with tempfile.TemporaryDirectory() as folder:
+                report_path = os.path.join(folder, "report.json")
+                command = [
+                    sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), LOADTEST_TOOLS[tool]),
+                    "--output-dir", folder, "--quiet", "--no-cache", "--report", report_path,
+                    "--max-workers", str(args.workers)
+                ]
+                env = dict(
+                    os.environ,
+                    WITHSECURE_API_URL=server.base_url,
+                    WITHSECURE_CLIENT_ID="loadtest",
+                    WITHSECURE_CLIENT_SECRET="secret",
+                    WITHSECURE_RATE_LIMIT=str(args.client_rate_limit)
+                )
+                server.reset_stats()
+                tokens_before = config.tokens_issued
+                samples = []
+                started = time.perf_counter()
+                process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+                while process.poll() is None:
+                    samples.append({
+                        "seconds": round(time.perf_counter() - started, 3),
+                        "devices": server.devices_sent,
+                        "responses": server.responses_sent,
+                        "rss_mb": process_rss_mb(process.pid),
+                    })
+                    time.sleep(args.interval)
+                stdout, stderr = process.communicate()
+                elapsed = time.perf_counter() - started
+                if process.returncode != 0:
+                    raise SystemExit(f"{tool}: exit code {process.returncode}\n{stderr.strip()}")
+
+                with open(report_path, encoding="utf-8") as file:
+                    report = json.load(file)
+                devices = report["endpoints"]["devices"]
+                exported = report["totals"]["devices"]
+                if exported != total:
+                    raise SystemExit(f"{tool}: {exported} of {total} devices exported")
+                rss = [sample["rss_mb"] for sample in samples if sample["rss_mb"] is not None]
+                results[tool] = {
+                    "seconds": round(elapsed, 3),
+                    "devices_per_second": round(total / elapsed),
+                    "peak_rss_mb": round(max(rss), 1) if rss else None,
+                    "device_latency_seconds": devices["latency_seconds"],
+                    "retries": report["totals"]["retries"],
+                    "throttled": server.throttled_sent,
+                    "server_errors": server.errors_sent,
+                    "tokens_issued": config.tokens_issued - tokens_before,
+                    "samples": samples,
+                }
+
+            latency = devices["latency_seconds"]
+            print(
+                f"{tool:<9} {elapsed:6.2f}s, {total / elapsed:>8,.0f} devices/s, "
+                f"peak RSS {results[tool]['peak_rss_mb'] or 0:6.1f} MB, "
+                f"devices p50/p95/p99 {latency['p50'] * 1000:.0f}/{latency['p95'] * 1000:.0f}/"
+                f"{latency['p99'] * 1000:.0f} ms, {report['totals']['retries']} retries "
+                f"({server.throttled_sent} x 429, {server.errors_sent} x 5xx), "
+                f"{results[tool]['tokens_issued']} tokens"
+            )
+            # Throughput and memory once per second
+            previous = 0
+            for sample in samples[::max(1, round(1 / args.interval))]:
+                print(
+                    f"    {sample['seconds']:6.1f}s {sample['devices']:>9} devices "
+                    f"(+{sample['devices'] - previous:>7}) {sample['rss_mb'] or 0:6.1f} MB"
+                )
+                previous = sample["devices"]
+    finally:
+        server.shutdown()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+        print(f"Time series written to {args.output}")
+
+
+def bench_memory(args):
+    """
+    Compare the peak RSS of the streaming writer with the accumulate-then-write
+    pipeline for growing numbers of synthetic devices.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        output = os.path.join(folder, "withsecure_export.csv")
+        for devices in args.sizes:
+            results = []
+            for mode in ("streaming", "in-memory"):
+                started = time.perf_counter()
+                completed = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "memory-worker",
+                     "--devices", str(devices), "--mode", mode, "--output", output],
+                    check=True, stdout=subprocess.PIPE, universal_newlines=True
+                )
+                elapsed = time.perf_counter() - started
+                results.append(f"{mode} {float(completed.stdout.strip()):7.1f} MB peak RSS ({elapsed:.1f}s)")
+            print(f"{devices:>8} devices: " + ", ".join(results))
+
+
+def bench_formats(args):
+    """
+    Write the same synthetic devices in every output format and compare file size
+    and write throughput with the plain CSV export.
+    """
+    from WithSecure_API_Export_Tool_Extended import SCHEMA
+
+    per_org = 10000
+    pages = []
+    for start in range(0, args.devices, args.page_size):
+        org_index = start // per_org
+        org = {"id": f"org-{org_index:05d}", "name": f"Organization {org_index:05d}"}
+        end = min(start + args.page_size, args.devices)
+        pages.append((org, [make_device(org["id"], index) for index in range(start, end)]))
+
+    baseline = None
+    with tempfile.TemporaryDirectory() as folder:
+        for output_format, (extension, typed, _) in OUTPUT_FORMATS.items():
+            output = os.path.join(folder, "withsecure_export" + extension)
+            try:
+                started = time.perf_counter()
+                writer = open_writer(output_format, output, SCHEMA.header, SCHEMA.fields)
+                export_pages(writer, pages, SCHEMA.build_records if typed else SCHEMA.build_rows)
+                elapsed = time.perf_counter() - started
+            except ImportError as e:
+                print(f"{output_format:<11} skipped: {e}")
+                continue
+
+            size = os.path.getsize(output)
+            if baseline is None:
+                baseline = (size, elapsed)
+            print(
+                f"{output_format:<11} {size / 1024 ** 2:8.1f} MB ({size / baseline[0]:5.1%} of csv)  "
+                f"{args.devices / elapsed:>9,.0f} rows/s ({baseline[1] / elapsed:4.2f}x csv)"
+            )
+
+
+def legacy_build_row(org_name, device):
+    """
+    The per-device transform the Extended tool used before the column schema,
+    kept as the baseline of the transform benchmark.
+    """
+    # OS data
+    os_data = device.get("os", {})
+    os_name = os_data.get("name", "N/A")
+    os_version = os_data.get("version", "N/A")
+    end_of_life_bool = os_data.get("endOfLife", False)
+    end_of_life_str = "Yes" if end_of_life_bool else "No"
+
+    # Additional fields
+    last_user = device.get("lastUser", "N/A")
+    online_bool = device.get("online", False)
+    online_str = "Yes" if online_bool else "No"
+
+    serial_number = device.get("serialNumber", "N/A")
+    computer_model = device.get("computerModel", "N/A")
+    bios_version = device.get("biosVersion", "N/A")
+
+    # Convert to GB if possible
+    system_drive_total_raw = device.get("systemDriveTotalSize", "N/A")
+    system_drive_free_raw = device.get("systemDriveFreeSpace", "N/A")
+    physical_mem_raw = device.get("physicalMemoryTotalSize", "N/A")
+
+    system_drive_total = bytes_to_gb_str(system_drive_total_raw)
+    system_drive_free = bytes_to_gb_str(system_drive_free_raw)
+    physical_mem_total = bytes_to_gb_str(physical_mem_raw)
+
+    disk_encryption_bool = device.get("discEncryptionEnabled", False)
+    disk_encryption_str = "Yes" if disk_encryption_bool else "No"
+
+    # Build a row for CSV
+    return [
+        org_name,
+        device.get("name", "N/A"),       # Device Name
+        os_name,                         # OS Name
+        os_version,                      # OS Version
+        end_of_life_str,                 # End Of Life
+        last_user,                       # Last User
+        online_str,                      # Online
+        serial_number,                   # Serial Number
+        computer_model,                  # Computer Model
+        bios_version,                    # BIOS Version
+        system_drive_total,              # System Drive Total (in GB)
+        system_drive_free,               # System Drive Free (in GB)
+        physical_mem_total,              # Physical Memory Total (in GB)
+        disk_encryption_str              # Disk Encryption Enabled
+    ]
+
+
+def bench_transform(args):
+    """
+    Rows per second of the per-device transform against the schema's batched page
+    transform, over the same synthetic devices.
+    """
+    from WithSecure_API_Export_Tool_Extended import SCHEMA
+
+    # A pool of distinct pages, cycled through until args.devices have been transformed
+    pool = [
+        [make_device("org-00000", index) for index in range(start, start + args.page_size)]
+        for start in range(0, args.pool, args.page_size)
+    ]
+    pages = [pool[index % len(pool)] for index in range(args.devices // args.page_size)]
+    total = len(pages) * args.page_size
+
+    for page in pool:
+        if [list(row) for row in SCHEMA.build_rows("Org", page)] != [legacy_build_row("Org", device) for device in page]:
+            raise SystemExit("schema rows differ from the per-device transform")
+
+    transforms = [
+        ("per-device", lambda page: [legacy_build_row("Org", device) for device in page]),
+        ("schema rows", lambda page: SCHEMA.build_rows("Org", page)),
+        ("schema records", lambda page: SCHEMA.build_records("Org", page)),
+    ]
+    baseline = None
+    for name, transform in transforms:
+        started = time.process_time()
+        for page in pages:
+            transform(page)
+        elapsed = time.process_time() - started
+        baseline = baseline or elapsed
+        print(f"{name:<15} {total / elapsed:>10,.0f} rows/s  ({baseline / elapsed:4.2f}x per-device)")
+
+
+def record_device_pages(devices, page_size):
+    """
+    Fetch every devices page of a mock organization and return the raw response bodies.
+    """
+    config = MockConfig(organizations=1, devices_per_org=devices, max_page_size=page_size)
+    server = start_mock_server(config)
+    try:
+        with requests.Session() as session:
+            token = session.post(f"{server.base_url}/as/token.oauth2").json()["access_token"]
+            session.headers["Authorization"] = f"Bearer {token}"
+            params = {"organizationId": config.organization_items()[0]["id"], "limit": page_size}
+            bodies = []
+            while True:
+                response = session.get(f"{server.base_url}/devices/v1/devices", params=params)
+                bodies.append(response.content)
+                next_anchor = response.json().get("nextAnchor")
+                if not next_anchor:
+                    return bodies
+                params["anchor"] = next_anchor
+    finally:
+        server.shutdown()
+
+
+def bench_decode(args):
+    """
+    CPU time and allocations of decoding device pages with each available JSON
+    decoder, alone and followed by row building. Pages are recorded from the mock
+    API, or read from --payload files saved from a real tenant.
+    """
+    from WithSecure_API_Export_Tool_Extended import SCHEMA
+
+    if args.payload:
+        bodies = []
+        for path in args.payload:
+            with open(path, "rb") as file:
+                bodies.append(file.read())
+    else:
+        bodies = record_device_pages(args.devices, args.page_size)
+    devices = sum(len(json.loads(body).get("items", [])) for body in bodies)
+    megabytes = sum(len(body) for body in bodies) / 1024 ** 2
+    print(f"{len(bodies)} pages, {devices} devices, {megabytes:.1f} MB of JSON")
+
+    decoders = [("json", json.loads)]
+    for module_name in ("orjson", "msgspec"):
+        try:
+            module = __import__(module_name)
+        except ImportError:
+            print(f"{module_name:<8} skipped: not installed")
+            continue
+        decoders.append((module_name, module.loads if module_name == "orjson" else module.json.decode))
+
+    baseline = None
+    for name, loads in decoders:
+        started = time.process_time()
+        for _ in range(args.repeat):
+            for body in bodies:
+                loads(body)
+        decode_cpu = (time.process_time() - started) / args.repeat
+
+        started = time.process_time()
+        for _ in range(args.repeat):
+            for body in bodies:
+                SCHEMA.build_rows("Org", loads(body).get("items", []))
+        export_cpu = (time.process_time() - started) / args.repeat
+
+        # Allocations: peak traced memory while decoding one page, averaged
+        peaks = []
+        for body in bodies:
+            tracemalloc.start()
+            loads(body)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+        baseline = baseline or decode_cpu
+        print(
+            f"{name:<8} decode {decode_cpu * 1000:7.1f} ms CPU ({baseline / decode_cpu:4.1f}x json), "
+            f"decode+rows {export_cpu * 1000:7.1f} ms CPU, {sum(peaks) / len(peaks) / 1024:7.0f} KB allocated per page"
+        )
+
+
+def bench_batch(args):
+    """
+    Export several API accounts with overlapping organizations, once as separate
+    runs per account (the single-account tool run N times) and once through the
+    batch runner, merged and per account.
+    """
+    from WithSecure_API_Export_Tool_Extended import SCHEMA
+
+    step = args.orgs_per_account - args.overlap
+    config = MockConfig(
+        organizations=step * (args.accounts - 1) + args.orgs_per_account,
+        devices_per_org=args.devices,
+        latency=args.latency
+    )
+    for index in range(args.accounts):
+        config.account_organizations[f"client-{index}"] = range(index * step, index * step + args.orgs_per_account)
+    server = start_mock_server(config)
+
+    def make_accounts():
+        return [Account(f"account-{index}", f"client-{index}", "secret", args.workers) for index in range(args.accounts)]
+
+    def separate_runs(folder):
+        devices = 0
+        for account in make_accounts():
+            with WithSecureClient(base_url=server.base_url, rate_limit=args.rate_limit) as client:
+                client.authenticate(account.client_id, account.client_secret)
+                pages = iter_organization_devices(client.get_organizations(), client.iter_device_pages, args.workers)
+                writer = open_writer("csv", os.path.join(folder, f"{account.name}.csv"), SCHEMA.header)
+                devices += export_pages(writer, pages, SCHEMA.build_rows)
+        return devices, None
+
+    def batch(folder, merge):
+        accounts = make_accounts()
+        run_batch(accounts, folder, SCHEMA, merge=merge, base_url=server.base_url, rate_limit=args.rate_limit)
+        return sum(account.devices for account in accounts), accounts
+
+    try:
+        summary = None
+        runs = [
+            ("separate runs", separate_runs),
+            ("batch merged", lambda folder: batch(folder, True)),
+            ("batch per account", lambda folder: batch(folder, False)),
+        ]
+        for label, run in runs:
+            with tempfile.TemporaryDirectory() as folder:
+                server.reset_stats()
+                started = time.perf_counter()
+                devices, accounts = run(folder)
+                elapsed = time.perf_counter() - started
+            print(
+                f"{label:>18}: {elapsed:6.2f}s, {devices} devices exported, "
+                f"{server.connections_opened} connections, {server.responses_sent} responses"
+            )
+            summary = summary or accounts
+        print()
+        for line in format_summary(summary):
+            print(line)
+    finally:
+        server.shutdown()
+
+
+def bench_filters(args):
+    """
+    Export with device filters applied locally only and pushed into the device
+    query. Checks that every devices request carried the filter parameters, that
+    both ways export the same devices, and compares the bytes received.
+    """
+    from WithSecure_API_Export_Tool_Extended import SCHEMA
+
+    config = MockConfig(organizations=args.organizations, devices_per_org=args.devices)
+    server = start_mock_server(config)
+    profiles = [
+        EXPORT_PROFILES["online"],
+        EXPORT_PROFILES["end-of-life"],
+        ExportProfile("offline mobiles", {"type": "mobile", "online": False}),
+    ]
+
+    def export(profile, push_down):
+        metrics = RunMetrics()
+        server.reset_stats()
+        with WithSecureClient(base_url=server.base_url, rate_limit=0, metrics=metrics) as client:
+            client.authenticate("client", "secret")
+            query = profile.query_params if push_down else None
+
+            def fetch_pages(org_id):
+                return profile.filter_pages(client.iter_device_pages(org_id, filters=query))
+
+            pages = iter_organization_devices(client.get_organizations(), fetch_pages, args.workers)
+            rows = [row for org, devices in pages for row in SCHEMA.build_rows(org["name"], devices)]
+        queries = [parse_qs(text) for text in server.device_queries]
+        return rows, metrics.report()["endpoints"]["devices"], queries
+
+    try:
+        _, unfiltered, _ = export(ExportProfile("all devices"), False)
+        print(f"{'all devices':<16} {unfiltered['bytes'] / 1024:9.0f} KB in {unfiltered['requests']:>4} requests")
+        for profile in profiles:
+            local_rows, local, _ = export(profile, False)
+            rows, pushed, queries = export(profile, True)
+
+            if rows != local_rows:
+                raise SystemExit(f"{profile.name}: pushed-down filters exported different devices")
+            for query in queries:
+                sent = {key: values[-1] for key, values in query.items() if key in profile.query_params}
+                if sent != profile.query_params:
+                    raise SystemExit(f"{profile.name}: devices request without its filters: {query}")
+
+            print(
+                f"{profile.name:<16} {len(rows):>7} devices, local filtering {local['bytes'] / 1024:9.0f} KB "
+                f"in {local['requests']:>4} requests, pushed down {pushed['bytes'] / 1024:9.0f} KB "
+                f"in {pushed['requests']:>4} requests ({1 - pushed['bytes'] / local['bytes']:5.1%} saved), "
+                f"query {'&'.join(f'{key}={value}' for key, value in profile.query_params.items())}"
+            )
+    finally:
+        server.shutdown()
+
+
+def bench_cache(args):
+    """
+    Repeat an export through the response cache: cold, while fresh, once stale with
+    ETag revalidation and once stale without validators. Then fill a cache far
+    smaller than the export to check that eviction keeps it within its limit.
+    """
+    from WithSecure_API_Export_Tool_Extended import SCHEMA
+
+    config = MockConfig(organizations=args.organizations, devices_per_org=args.devices, latency=args.latency)
+    server = start_mock_server(config)
+
+    def export(folder, cache, output_name):
+        metrics = RunMetrics()
+        with WithSecureClient(base_url=server.base_url, rate_limit=0, metrics=metrics, cache=cache) as client:
+            client.authenticate("client", "secret")
+            pages = iter_organization_devices(client.get_organizations(), client.iter_device_pages, args.workers)
+            writer = open_writer("csv", os.path.join(folder, output_name), SCHEMA.header)
+            export_pages(writer, pages, SCHEMA.build_rows)
+        with open(os.path.join(folder, output_name), "rb") as file:
+            content = file.read()
+        return content, metrics.report()["cache"]
+
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            cache_path = os.path.join(folder, "cache.sqlite")
+            fresh = {"organizations": 3600, "devices": 3600}
+            stale = {"organizations": 1e-9, "devices": 1e-9}
+            runs = [
+                ("no cache", None, True),
+                ("cold cache", fresh, True),
+                ("fresh cache", fresh, True),
+                ("stale, ETag", stale, True),
+                ("stale, no ETag", stale, False),
+            ]
+            expected = None
+            for index, (label, ttls, etags) in enumerate(runs):
+                config.etags = etags
+                cache = ResponseCache(cache_path, ttls) if ttls else None
+                server.reset_stats()
+                started = time.perf_counter()
+                try:
+                    content, outcomes = export(folder, cache, f"export-{index}.csv")
+                finally:
+                    if cache:
+                        cache.close()
+                elapsed = time.perf_counter() - started
+
+                expected = expected or content
+                if content != expected:
+                    raise SystemExit(f"{label}: export differs from the uncached one")
+                counts = {}
+                for endpoint_counts in outcomes.values():
+                    for outcome, count in endpoint_counts.items():
+                        counts[outcome] = counts.get(outcome, 0) + count
+                print(
+                    f"{label:<15} {elapsed:6.2f}s, {server.responses_sent:>4} responses "
+                    f"({server.not_modified_sent:>4} not modified), {server.bytes_sent / 1024:8.0f} KB sent, "
+                    f"cache {counts.get('hit', 0)} hits / {counts.get('revalidated', 0)} revalidated / "
+                    f"{counts.get('miss', 0)} misses"
+                )
+
+            # Eviction: a cache a quarter of the compressed export must stay under its limit
+            config.etags = True
+            limit = os.path.getsize(cache_path) // 4
+            os.remove(cache_path)
+            cache = ResponseCache(cache_path, fresh, max_bytes=limit)
+            try:
+                export(folder, cache, "export-evicted.csv")
+                print(
+                    f"{'eviction':<15} limit {limit / 1024:.0f} KB, {cache.size / 1024:.0f} KB kept, "
+                    f"{cache.evictions} responses evicted"
+                )
+                if cache.size > limit:
+                    raise SystemExit("eviction: cache grew past its limit")
+            finally:
+                cache.close()
+    finally:
+        server.shutdown()
+
+
+def bench_fleet(args):
+    """
+    Throughput and memory of the streaming fleet summary: the devices per second it
+    counts next to building the rows of the same pages, and its peak traced memory,
+    which grows with the organizations and OS versions but not with the devices.
+    """
+    from WithSecure_API_Export_Tool_Extended import SCHEMA
+
+    pool = [
+        [make_device("org-00000", index) for index in range(start, start + args.page_size)]
+        for start in range(0, args.pool, args.page_size)
+    ]
+
+    def pages(devices):
+        count = devices // args.page_size
+        for number in range(count):
+            index = number * args.organizations // count
+            yield {"id": f"org-{index:05d}", "name": f"Organization {index:05d}"}, pool[number % len(pool)]
+
+    for devices in args.sizes:
+        started = time.process_time()
+        for org, page in pages(devices):
+            SCHEMA.build_rows(org["name"], page)
+        rows_seconds = time.process_time() - started
+
+        fleet = FleetSummary()
+        started = time.process_time()
+        for org, page in pages(devices):
+            fleet.add_page(org, page)
+        fleet_seconds = time.process_time() - started
+
+        # As in a checkpointed export, which snapshots the counts with every page
+        checkpointed = FleetSummary()
+        started = time.process_time()
+        for org, page in pages(devices):
+            checkpointed.add_page(org, page)
+            checkpointed.snapshot()
+        checkpointed_seconds = time.process_time() - started
+
+        tracemalloc.start()
+        traced = FleetSummary()
+        for org, page in pages(devices):
+            traced.add_page(org, page)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        totals = fleet.totals()
+        print(
+            f"{devices:>8} devices, {totals['organizations']} organizations: "
+            f"{devices / fleet_seconds:>10,.0f} devices/s ({fleet_seconds / rows_seconds:5.1%} of building rows), "
+            f"{devices / checkpointed_seconds:>10,.0f} devices/s with checkpoint snapshots, "
+            f"peak {peak / 1024:7.1f} KB"
+        )
+
+
+def bench_shards(args):
+    """
+    Sharded export of the Extended tool against the mock with each number of shard
+    processes: wall time, devices per second, speed-up over one shard and merge
+    time, checking each merged file is identical to the one-shard export. The mock
+    serves from this process, so with few cores it competes with the shards for CPU.
+    """
+    import withsecure_shards
+
+    config = MockConfig(args.organizations, args.devices, args.page_size, args.latency)
+    server = start_mock_server(config)
+    tool = os.path.join(os.path.dirname(os.path.abspath(__file__)), LOADTEST_TOOLS["extended"])
+    total = args.organizations * args.devices
+    # Only the mock limits the request rate here
+    withsecure_shards.DEFAULT_RATE_LIMIT = 0
+    os.environ["WITHSECURE_API_URL"] = server.base_url
+    os.environ["WITHSECURE_RATE_LIMIT"] = "0"
+    print(f"{total:,} devices in {args.organizations} organizations, {os.cpu_count()} CPUs")
+
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            reference = None
+            baseline = None
+            for count in args.workers:
+                output_dir = os.path.join(folder, f"shards_{count}")
+                os.mkdir(output_dir)
+                command = [
+                    sys.executable, tool, "--output-dir", output_dir, "--max-workers", str(args.max_workers),
+                    "--quiet", "--no-cache"
+                ]
+                started = time.perf_counter()
+                result = run_sharded_export(command, "mock-id", "mock-secret", output_dir, count)
+                elapsed = time.perf_counter() - started
+                baseline = baseline or elapsed
+
+                digest = hashlib.sha256()
+                with open(result.output_path, "rb") as file:
+                    for chunk in iter(lambda: file.read(1024 ** 2), b""):
+                        digest.update(chunk)
+                reference = reference or digest.digest()
+                identical = digest.digest() == reference and result.rows == total
+                merge_seconds = result.metrics.report()["phases_seconds"]["merge_shards"]
+                print(
+                    f"{count:>2} shards: {elapsed:7.2f}s {total / elapsed:>10,.0f} devices/s "
+                    f"({baseline / elapsed:4.2f}x), merge {merge_seconds:5.2f}s, "
+                    f"output {'identical' if identical else 'DIFFERENT'}"
+                )
+                if not identical:
+                    raise SystemExit(f"{count} shards: merged export differs from the one-shard export")
+    finally:
+        server.shutdown()
+
+
+def bench_diff(args):
+    """
+    Snapshot two synthetic exports of the same fleet, the second with devices removed
+    and added, OS upgrades, BIOS changes and disk encryption turned off, then diff
+    them: snapshot time and size next to the CSV, diff time and peak traced memory,
+    and the counts found against the changes planted.
+    """
+    from WithSecure_API_Export_Tool_Extended import SCHEMA
+
+    per_org = args.devices // args.organizations
+    added_per_org = per_org // 200
+    organizations = [
+        {"id": f"org-{index:05d}", "name": f"Organization {index:05d}"} for index in range(args.organizations)
+    ]
+
+    def changed_device(org_id, index):
+        device = make_device(org_id, index)
+        if index % 50 == 1:
+            device["os"] = dict(device["os"], version=device["os"]["version"] + ".1")
+        elif index % 50 == 3:
+            device["biosVersion"] = "2.0.0"
+        elif index % 50 == 7:
+            device["discEncryptionEnabled"] = False
+        return device
+
+    def export(folder, changed):
+        # The second export also lists the organizations in another order, as the API may
+        def fetch_pages(org_id, anchor=None):
+            if changed:
+                indexes = [index for index in range(per_org) if index % 100 != 0]
+                indexes += range(per_org, per_org + added_per_org)
+                make = changed_device
+            else:
+                indexes = range(per_org)
+                make = make_device
+            for start in range(0, len(indexes), args.page_size):
+                end = min(start + args.page_size, len(indexes))
+                yield DevicePage([make(org_id, index) for index in indexes[start:end]],
+                                 str(end) if end < len(indexes) else None)
+
+        listed = organizations[::-1] if changed else organizations
+        output_path = os.path.join(folder, "withsecure_export.csv")
+        offsets = []
+        export_csv_checkpointed(output_path, SCHEMA.header, listed, fetch_pages, SCHEMA.build_rows,
+                                organization_offsets=offsets)
+        started = time.perf_counter()
+        snapshot = take_snapshot(output_path, SCHEMA.header, listed, offsets, folder)
+        elapsed = time.perf_counter() - started
+        csv_size = os.path.getsize(output_path)
+        snapshot_size = os.path.getsize(snapshot.data_path)
+        print(
+            f"{'new' if changed else 'old'} snapshot: {snapshot.rows:,} devices in {elapsed:6.2f}s, "
+            f"{snapshot_size / 1024 ** 2:6.1f} MB ({snapshot_size / csv_size:5.1%} of the "
+            f"{csv_size / 1024 ** 2:.1f} MB CSV)"
+        )
+        return snapshot
+
+    # The changes planted in each organization
+    kept = [index for index in range(per_org) if index % 100 != 0]
+    expected = {
+        CHANGE_ADDED: added_per_org,
+        CHANGE_REMOVED: per_org - len(kept),
+        CHANGE_UPDATED: sum(1 for index in kept if index % 50 in (1, 3, 7)),
+    }
+    expected_columns = {
+        "OS Version": sum(1 for index in kept if index % 50 == 1),
+        "BIOS Version": sum(1 for index in kept if index % 50 == 3),
+        "Disk Encryption Enabled": sum(1 for index in kept if index % 50 == 7),
+    }
+
+    with tempfile.TemporaryDirectory() as folder:
+        old = export(folder, changed=False)
+        new = export(folder, changed=True)
+        report_path = os.path.join(folder, "withsecure_changes.csv")
+        started = time.perf_counter()
+        summary = write_change_report(old, new, report_path)
+        elapsed = time.perf_counter() - started
+        # Traced separately: tracing slows the diff down several times
+        _, _, peak = measure(lambda: write_change_report(old, new, report_path))
+        compared = old.rows + new.rows
+        print(
+            f"diff: {elapsed:6.2f}s, {compared / elapsed:>10,.0f} rows/s, peak {peak:6.1f} MB, "
+            f"report {os.path.getsize(report_path) / 1024 ** 2:.1f} MB"
+        )
+        for line in summary.lines():
+            print(f"  {line.strip()}")
+
+        found = {change: summary.devices[change] for change in expected}
+        found_columns = {column: summary.columns[column] for column in expected_columns}
+        planted = {change: count * args.organizations for change, count in expected.items()}
+        planted_columns = {column: count * args.organizations for column, count in expected_columns.items()}
+        matches = found == planted and found_columns == planted_columns and len(summary.columns) == len(planted_columns)
+        print(f"changes found {'match' if matches else 'DO NOT MATCH'} the changes planted: {planted}")
+        if not matches:
+            raise SystemExit(f"diff found {found} and columns {dict(summary.columns)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the WithSecure export tools.")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    pagination = subparsers.add_parser("pagination", help="pagination completeness and peak memory")
+    pagination.add_argument("--devices", type=int, default=100000)
+    pagination.add_argument("--page-size", type=int, default=200)
+    pagination.set_defaults(func=bench_pagination)
+
+    concurrency = subparsers.add_parser("concurrency", help="serial vs concurrent organization fetching")
+    concurrency.add_argument("--organizations", type=int, default=100)
+    concurrency.add_argument("--devices", type=int, default=500, help="devices per organization")
+    concurrency.add_argument("--page-size", type=int, default=200)
+    concurrency.add_argument("--latency", type=float, default=0.05, help="seconds added to every response")
+    concurrency.add_argument("--workers", type=int, default=8)
+    concurrency.set_defaults(func=bench_concurrency)
+
+    connections = subparsers.add_parser("connections", help="connections opened per export over HTTPS")
+    connections.add_argument("--organizations", type=int, default=50)
+    connections.add_argument("--devices", type=int, default=1000, help="devices per organization")
+    connections.add_argument("--page-size", type=int, default=200)
+    connections.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    connections.add_argument("--workers", type=int, default=8)
+    connections.set_defaults(func=bench_connections)
+
+    retries = subparsers.add_parser("retries", help="retry/backoff on scripted 429/5xx and rate limiting")
+    retries.add_argument("--rate", type=float, default=10, help="token bucket rate in requests per second")
+    retries.add_argument("--requests", type=int, default=30)
+    retries.set_defaults(func=bench_retries)
+
+    tokens = subparsers.add_parser("tokens", help="token refresh during a long export")
+    tokens.add_argument("--organizations", type=int, default=20)
+    tokens.add_argument("--devices", type=int, default=2000, help="devices per organization")
+    tokens.add_argument("--latency", type=float, default=0.05, help="seconds added to every response")
+    tokens.add_argument("--token-lifetime", type=int, default=1, help="seconds each mock token stays valid")
+    tokens.add_argument("--revoke-after", type=float, default=0.5, help="seconds before all tokens are revoked once")
+    tokens.add_argument("--workers", type=int, default=8)
+    tokens.set_defaults(func=bench_tokens)
+
+    resume = subparsers.add_parser("resume", help="kill and resume exports, compare output bytes")
+    resume.add_argument("--organizations", type=int, default=20)
+    resume.add_argument("--devices", type=int, default=1000, help="devices per organization")
+    resume.add_argument("--page-size", type=int, default=100)
+    resume.add_argument("--latency", type=float, default=0.01, help="seconds added to every response")
+    resume.add_argument("--workers", type=int, default=4)
+    resume.add_argument("--trials", type=int, default=5)
+    resume.add_argument("--max-kills", type=int, default=3, help="interruptions per export")
+    resume.add_argument("--flush-interval", type=float, default=0.05, help="seconds between checkpoints")
+    resume.set_defaults(func=bench_resume)
+
+    worker = subparsers.add_parser("export-worker")
+    worker.add_argument("--base-url", required=True)
+    worker.add_argument("--output", required=True)
+    worker.add_argument("--workers", type=int, default=4)
+    worker.add_argument("--resume", action="store_true")
+    worker.add_argument("--flush-interval", type=float, default=withsecure_writers.FLUSH_INTERVAL)
+    worker.set_defaults(func=run_export_worker)
+
+    memory = subparsers.add_parser("memory", help="peak RSS of streaming vs in-memory CSV export")
+    memory.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    memory.set_defaults(func=bench_memory)
+
+    formats = subparsers.add_parser("formats", help="file size and write throughput of each output format")
+    formats.add_argument("--devices", type=int, default=200000)
+    formats.add_argument("--page-size", type=int, default=200)
+    formats.set_defaults(func=bench_formats)
+
+    transform = subparsers.add_parser("transform", help="per-device vs schema-driven row building")
+    transform.add_argument("--devices", type=int, default=1000000)
+    transform.add_argument("--page-size", type=int, default=200)
+    transform.add_argument("--pool", type=int, default=20000, help="distinct synthetic devices cycled through")
+    transform.set_defaults(func=bench_transform)
+
+    decode = subparsers.add_parser("decode", help="CPU time and allocations of JSON decoders on device pages")
+    decode.add_argument("--devices", type=int, default=50000)
+    decode.add_argument("--page-size", type=int, default=200)
+    decode.add_argument("--repeat", type=int, default=5)
+    decode.add_argument("--payload", nargs="+", help="recorded devices response bodies to decode instead")
+    decode.set_defaults(func=bench_decode)
+
+    batch = subparsers.add_parser("batch", help="several API accounts: separate runs vs the batch runner")
+    batch.add_argument("--accounts", type=int, default=4)
+    batch.add_argument("--orgs-per-account", type=int, default=10)
+    batch.add_argument("--overlap", type=int, default=3, help="organizations each account shares with the next")
+    batch.add_argument("--devices", type=int, default=1000, help="devices per organization")
+    batch.add_argument("--latency", type=float, default=0.02, help="seconds added to every response")
+    batch.add_argument("--workers", type=int, default=4, help="organizations fetched in parallel per account")
+    batch.add_argument("--rate-limit", type=float, default=0, help="requests per second per account (0: unlimited)")
+    batch.set_defaults(func=bench_batch)
+
+    filters = subparsers.add_parser("filters", help="device filters applied locally vs pushed into the query")
+    filters.add_argument("--organizations", type=int, default=4)
+    filters.add_argument("--devices", type=int, default=5000, help="devices per organization")
+    filters.add_argument("--workers", type=int, default=4)
+    filters.set_defaults(func=bench_filters)
+
+    cache = subparsers.add_parser("cache", help="repeated exports through the response cache, and its eviction")
+    cache.add_argument("--organizations", type=int, default=4)
+    cache.add_argument("--devices", type=int, default=5000, help="devices per organization")
+    cache.add_argument("--latency", type=float, default=0.02, help="seconds added to every response")
+    cache.add_argument("--workers", type=int, default=4)
+    cache.set_defaults(func=bench_cache)
+
+    fleet = subparsers.add_parser("fleet", help="throughput and memory of the streaming fleet summary")
+    fleet.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000])
+    fleet.add_argument("--organizations", type=int, default=20)
+    fleet.add_argument("--page-size", type=int, default=200)
+    fleet.add_argument("--pool", type=int, default=20000, help="distinct synthetic devices cycled through")
+    fleet.set_defaults(func=bench_fleet)
+
+    shards = subparsers.add_parser("shards", help="sharded export at several numbers of processes")
+    shards.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="numbers of shard processes")
+    shards.add_argument("--organizations", type=int, default=32)
+    shards.add_argument("--devices", type=int, default=5000, help="devices per organization")
+    shards.add_argument("--page-size", type=int, default=200)
+    shards.add_argument("--latency", type=float, default=0.01, help="seconds added to every response")
+    shards.add_argument("--max-workers", type=int, default=8, help="organizations fetched in parallel per shard")
+    shards.set_defaults(func=bench_shards)
+
+    diff = subparsers.add_parser("diff", help="snapshot two exports and diff them with the streaming merge-join")
+    diff.add_argument("--devices", type=int, default=500000, help="devices in each snapshot")
+    diff.add_argument("--organizations", type=int, default=50)
+    diff.add_argument("--page-size", type=int, default=200)
+    diff.set_defaults(func=bench_diff)
+
+    loadtest = subparsers.add_parser("loadtest", help="both tool scripts end to end against a busy mock API")
+    loadtest.add_argument("--tools", nargs="+", choices=list(LOADTEST_TOOLS), default=list(LOADTEST_TOOLS))
+    loadtest.add_argument("--organizations", type=int, default=20)
+    loadtest.add_argument("--devices", type=int, default=5000, help="devices per organization")
+    loadtest.add_argument("--latency", type=float, default=0.02, help="seconds added to every response")
+    loadtest.add_argument("--latency-jitter", type=float, default=0.03, help="random extra seconds per response")
+    loadtest.add_argument("--error-rate", type=float, default=0.01, help="share of requests answered with a 5xx")
+    loadtest.add_argument("--rate-limit", type=float, default=0, help="requests per second before the mock answers 429")
+    loadtest.add_argument("--token-lifetime", type=int, default=30, help="seconds a mock access token stays valid")
+    loadtest.add_argument("--client-rate-limit", type=float, default=0, help="WITHSECURE_RATE_LIMIT of the exporter")
+    loadtest.add_argument("--workers", type=int, default=8)
+    loadtest.add_argument("--seed", type=int, default=1)
+    loadtest.add_argument("--interval", type=float, default=0.25, help="seconds between two samples")
+    loadtest.add_argument("--output", help="write the results and time series to this JSON file")
+    loadtest.set_defaults(func=bench_loadtest)
+
+    memory_worker = subparsers.add_parser("memory-worker")
+    memory_worker.add_argument("--devices", type=int, required=True)
+    memory_worker.add_argument("--mode", choices=["streaming", "in-memory"], required=True)
+    memory_worker.add_argument("--output", required=True)
+    memory_worker.set_defaults(func=run_memory_worker)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,466 @@
+"""
+Local stand-in for the WithSecure Elements API.
+
+Serves synthetic organizations and devices on the same paths as
+api.connect.withsecure.com so the export tools can be exercised without
+real credentials. Point the tools at it with:
+
+    python mock_withsecure_api.py --port 8765 --organizations 5 --devices 20000
+    WITHSECURE_API_URL=http://127.0.0.1:8765 python WithSecure_API_Export_Tool_Extended.py
+
+Besides paging through synthetic tenants it can behave like a busy API: slow and
+uneven responses (--latency, --latency-jitter), random server errors
+(--error-rate), 429 throttling above a request rate (--rate-limit) and short-lived
+tokens (--token-lifetime).
+"""
+import argparse
+import base64
+import binascii
+import gzip
+import hashlib
+import json
+import math
+import os
+import random
+import ssl
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+OS_CATALOG = [
+    ("Windows 11", "23H2", False),
+    ("Windows 10", "22H2", False),
+    ("Windows 7", "SP1", True),
+    ("macOS", "14.4", False),
+    ("Ubuntu", "22.04", False),
+    ("Android", "14", False),
+]
+
+
+# Statuses of the random server errors
+RANDOM_ERROR_STATUSES = (500, 502, 503)
+
+
+class MockThrottle:
+    """
+    Server-side token bucket: requests above `rate` per second (after a burst of
+    `burst`) are answered with 429.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, int(rate)))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def delay(self):
+        """
+        Take a token and return None, or return the seconds until one is available.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return None
+            return (1 - self.tokens) / self.rate
+
+
+class MockConfig:
+    def __init__(self, organizations=3, devices_per_org=1000, max_page_size=200, latency=0.0, token_lifetime=3600,
+                 etags=True, latency_jitter=0.0, error_rate=0.0, rate_limit=0.0, seed=None):
+        self.organizations = organizations
+        self.devices_per_org = devices_per_org
+        self.max_page_size = max_page_size
+        # Seconds added to every response to imitate a round-trip to the real API,
+        # plus a random extra of up to latency_jitter seconds
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        # Share of GET requests answered with a random 5xx error
+        self.error_rate = error_rate
+        # GET requests per second served before answering 429 (0: unlimited)
+        self.throttle = MockThrottle(rate_limit) if rate_limit else None
+        self.random = random.Random(seed)
+        # Scripted error responses returned, in order, by the next GET requests
+        self.failures = deque()
+        self.lock = threading.Lock()
+        # Issued access tokens and when they stop being accepted
+        self.token_lifetime = token_lifetime
+        self.tokens = {}
+        self.tokens_issued = 0
+        # Client IDs that only see some organizations: client_id -> organization indexes.
+        # Any other client ID sees every organization.
+        self.account_organizations = {}
+        self.token_clients = {}
+        # Send an ETag with GET responses and answer a matching If-None-Match with 304
+        self.etags = etags
+
+    def issue_token(self, client_id=None):
+        with self.lock:
+            self.tokens_issued += 1
+            token = f"mock-token-{self.tokens_issued}"
+            self.tokens[token] = time.monotonic() + self.token_lifetime
+            self.token_clients[token] = client_id
+            return token
+
+    def token_valid(self, token):
+        with self.lock:
+            return self.tokens.get(token, 0) > time.monotonic()
+
+    def client_of(self, token):
+        with self.lock:
+            return self.token_clients.get(token)
+
+    def script_failures(self, statuses, retry_after=None):
+        """
+        Queue error statuses (e.g. [429, 503, 503]) for the next GET requests.
+        """
+        with self.lock:
+            self.failures.extend((status, retry_after) for status in statuses)
+
+    def next_failure(self):
+        """
+        Return the (status, retry_after) of the error the next GET request gets, if any:
+        a scripted failure, a 429 above the rate limit or a random server error.
+        """
+        with self.lock:
+            if self.failures:
+                return self.failures.popleft()
+        if self.throttle:
+            delay = self.throttle.delay()
+            if delay is not None:
+                return 429, max(1, math.ceil(delay))
+        if self.error_rate:
+            with self.lock:
+                if self.random.random() < self.error_rate:
+                    return self.random.choice(RANDOM_ERROR_STATUSES), None
+        return None
+
+    def response_delay(self):
+        if not self.latency_jitter:
+            return self.latency
+        with self.lock:
+            return self.latency + self.random.uniform(0, self.latency_jitter)
+
+    def organization_items(self, client_id=None):
+        indexes = self.account_organizations.get(client_id, range(self.organizations))
+        return [
+            {"id": f"org-{idx:05d}", "name": f"Organization {idx:05d}", "type": "company"}
+            for idx in indexes
+        ]
+
+
+def make_device(org_id, index):
+    """
+    Build a deterministic synthetic device resembling the devices API payload.
+    """
+    os_name, os_version, end_of_life = OS_CATALOG[index % len(OS_CATALOG)]
+    return {
+        "id": f"{org_id}-dev-{index:07d}",
+        "name": f"PC-{index:07d}",
+        "type": "mobile" if index % 10 == 9 else "computer",
+        "state": "inactive" if index % 25 == 24 else "active",
+        "online": index % 3 != 0,
+        "company": {"id": org_id},
+        "os": {"name": os_name, "version": os_version, "endOfLife": end_of_life},
+        "clientVersion": "24.3.1234",
+        "protectionStatusOverview": "allOk",
+        "patchOverallState": "allImportantUpdatesInstalled",
+        "lastUser": f"DOMAIN\\user{index % 500}",
+        "serialNumber": f"SN{index:010d}",
+        "computerModel": "Latitude 7440",
+        "biosVersion": f"1.{index % 20}.0",
+        "systemDriveTotalSize": 512 * 1024 ** 3,
+        "systemDriveFreeSpace": (index % 400) * 1024 ** 3,
+        "physicalMemoryTotalSize": 16 * 1024 ** 3,
+        "discEncryptionEnabled": index % 4 != 0,
+        "ipAddresses": f"10.{index % 250}.{index % 200}.{index % 100}/24",
+        "macAddresses": "00:11:22:33:44:55",
+        "registrationTimestamp": "2024-01-15T08:30:00Z",
+        "statusUpdateTimestamp": "2025-01-08T10:00:00Z",
+    }
+
+
+# Device filters the devices endpoint applies: query parameter -> device value as query text
+DEVICE_QUERY_FILTERS = {
+    "type": lambda device: device["type"],
+    "state": lambda device: device["state"],
+    "online": lambda device: "true" if device["online"] else "false",
+}
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        delay = self.server.config.response_delay()
+        if delay:
+            time.sleep(delay)
+        payload = json.dumps(body).encode("utf-8")
+
+        etag = None
+        if self.command == "GET" and status == 200 and self.server.config.etags:
+            etag = '"' + hashlib.sha1(payload).hexdigest()[:20] + '"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                self.server.record_response(0, not_modified=True)
+                return
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        if etag:
+            self.send_header("ETag", etag)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            payload = gzip.compress(payload, compresslevel=5)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        self.server.record_response(len(payload))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        if urlparse(self.path).path != "/as/token.oauth2":
+            self.send_json(404, {"message": "Not found"})
+            return
+        config = self.server.config
+        token = config.issue_token(self.basic_auth_user())
+        self.send_json(200, {"access_token": token, "token_type": "Bearer", "expires_in": config.token_lifetime})
+
+    def basic_auth_user(self):
+        scheme, _, credentials = self.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "basic":
+            return None
+        try:
+            return base64.b64decode(credentials).decode("utf-8").partition(":")[0]
+        except (binascii.Error, UnicodeDecodeError):
+            return None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        config = self.server.config
+
+        failure = config.next_failure()
+        if failure:
+            status, retry_after = failure
+            headers = {"Retry-After": str(retry_after)} if retry_after is not None else None
+            self.server.record_error(status)
+            self.send_json(status, {"message": "Too many requests" if status == 429 else "Server error"}, headers)
+            return
+
+        token = self.headers.get("Authorization", "").replace("Bearer ", "", 1)
+        if not config.token_valid(token):
+            self.server.record_unauthorized()
+            self.send_json(401, {"message": "Invalid or expired token"})
+            return
+
+        if url.path == "/organizations/v1/organizations":
+            self.send_json(200, {"items": config.organization_items(config.client_of(token))})
+        elif url.path == "/devices/v1/devices":
+            self.server.record_device_query(url.query)
+            self.send_devices_page(config, query)
+        else:
+            self.send_json(404, {"message": "Not found"})
+
+    def send_devices_page(self, config, query):
+        org_id = query.get("organizationId")
+        if not org_id:
+            self.send_json(400, {"message": "organizationId is required"})
+            return
+
+        limit = min(int(query.get("limit", config.max_page_size)), config.max_page_size)
+        start = int(query.get("anchor", 0))
+        filters = [(DEVICE_QUERY_FILTERS[key], value) for key, value in query.items() if key in DEVICE_QUERY_FILTERS]
+
+        # The anchor is the index of the next device to look at, matching or not
+        items = []
+        end = start
+        while end < config.devices_per_org and len(items) < limit:
+            device = make_device(org_id, end)
+            end += 1
+            if all(value_of(device) == value for value_of, value in filters):
+                items.append(device)
+
+        body = {"items": items}
+        if end < config.devices_per_org:
+            body["nextAnchor"] = str(end)
+        self.server.record_devices(len(items))
+        self.send_json(200, body)
+
+
+class MockWithSecureServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config, ssl_context=None):
+        super().__init__(address, MockRequestHandler)
+        self.config = config
+        self.ssl_context = ssl_context
+        self.stats_lock = threading.Lock()
+        self.connections_opened = 0
+        self.responses_sent = 0
+        self.bytes_sent = 0
+        self.unauthorized_sent = 0
+        self.not_modified_sent = 0
+        self.throttled_sent = 0
+        self.errors_sent = 0
+        self.devices_sent = 0
+        # Query strings of the latest devices requests
+        self.device_queries = deque(maxlen=1000)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        scheme = "https" if self.ssl_context else "http"
+        return f"{scheme}://{host}:{port}"
+
+    def get_request(self):
+        request, client_address = super().get_request()
+        with self.stats_lock:
+            self.connections_opened += 1
+        return request, client_address
+
+    def finish_request(self, request, client_address):
+        # The TLS handshake runs on the connection's own thread, not the accept loop
+        if self.ssl_context:
+            try:
+                request = self.ssl_context.wrap_socket(request, server_side=True)
+            except (ssl.SSLError, OSError):
+                return
+        super().finish_request(request, client_address)
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-response (e.g. killed exports) are expected here
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+    def record_response(self, body_size, not_modified=False):
+        with self.stats_lock:
+            self.responses_sent += 1
+            self.bytes_sent += body_size
+            self.not_modified_sent += not_modified
+
+    def record_error(self, status):
+        with self.stats_lock:
+            if status == 429:
+                self.throttled_sent += 1
+            else:
+                self.errors_sent += 1
+
+    def record_devices(self, count):
+        with self.stats_lock:
+            self.devices_sent += count
+
+    def record_device_query(self, query):
+        with self.stats_lock:
+            self.device_queries.append(query)
+
+    def record_unauthorized(self):
+        with self.stats_lock:
+            self.unauthorized_sent += 1
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.connections_opened = 0
+            self.responses_sent = 0
+            self.bytes_sent = 0
+            self.unauthorized_sent = 0
+            self.not_modified_sent = 0
+            self.throttled_sent = 0
+            self.errors_sent = 0
+            self.devices_sent = 0
+            self.device_queries.clear()
+
+
+def make_self_signed_cert(directory):
+    """
+    Create a throwaway certificate for 127.0.0.1 with the openssl command line tool.
+    Returns (cert_path, key_path).
+    """
+    cert_path = os.path.join(directory, "mock_cert.pem")
+    key_path = os.path.join(directory, "mock_key.pem")
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+            "-keyout", key_path, "-out", cert_path,
+            "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1",
+        ],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return cert_path, key_path
+
+
+def make_ssl_context(cert_path, key_path):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_path, key_path)
+    return context
+
+
+def start_mock_server(config=None, host="127.0.0.1", port=0, ssl_context=None):
+    """
+    Start the mock API on a background thread and return the server.
+    Call server.shutdown() when done.
+    """
+    server = MockWithSecureServer((host, port), config or MockConfig(), ssl_context)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the WithSecure Elements API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--organizations", type=int, default=3, help="number of organizations to serve")
+    parser.add_argument("--devices", type=int, default=1000, help="number of devices per organization")
+    parser.add_argument("--page-size", type=int, default=200, help="largest page the devices endpoint returns")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds of delay added to every response")
+    parser.add_argument("--latency-jitter", type=float, default=0.0, help="random extra delay of up to this many seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of GET requests answered with a random 5xx")
+    parser.add_argument("--rate-limit", type=float, default=0.0,
+                        help="GET requests per second served before answering 429 (default: unlimited)")
+    parser.add_argument("--seed", type=int, help="seed of the random latency and errors")
+    parser.add_argument("--token-lifetime", type=int, default=3600, help="seconds an access token stays valid")
+    parser.add_argument("--fail-sequence", default="", help="comma-separated statuses returned by the first GET requests, e.g. 429,503")
+    parser.add_argument("--retry-after", type=int, help="Retry-After seconds sent with scripted failures")
+    parser.add_argument("--no-etags", action="store_true", help="send no ETag headers and never answer 304")
+    parser.add_argument("--cert", help="serve HTTPS with this certificate (PEM)")
+    parser.add_argument("--key", help="private key for --cert (PEM)")
+    args = parser.parse_args()
+
+    config = MockConfig(
+        args.organizations, args.devices, args.page_size, args.latency, args.token_lifetime, etags=not args.no_etags,
+        latency_jitter=args.latency_jitter, error_rate=args.error_rate, rate_limit=args.rate_limit, seed=args.seed
+    )
+    if args.fail_sequence:
+        config.script_failures([int(status) for status in args.fail_sequence.split(",")], args.retry_after)
+    ssl_context = make_ssl_context(args.cert, args.key) if args.cert else None
+    server = MockWithSecureServer((args.host, args.port), config, ssl_context)
+    print(f"Mock WithSecure API listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
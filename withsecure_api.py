@@ -0,0 +1,461 @@
+import json
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from withsecure_response_cache import CACHE_HIT, CACHE_MISS, CACHE_REVALIDATED, cache_scope
+
+# orjson decodes device pages several times faster than the json module; it is
+# optional and the standard library is used when it is not installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Base URL of the WithSecure Elements API. Can be pointed at a local stand-in
+# (see mock_withsecure_api.py) through the WITHSECURE_API_URL environment variable.
+API_BASE_URL = os.environ.get("WITHSECURE_API_URL", "https://api.connect.withsecure.com").rstrip("/")
+
+# Largest page size accepted by the devices endpoint
+DEVICES_PAGE_LIMIT = 200
+
+# Query parameter the devices endpoint would take to list only devices changed since
+# a timestamp. The API does not document one today, so incremental exports fall back
+# to comparing every device against the local device cache.
+DEVICES_UPDATED_SINCE_PARAM = None
+
+# Device filters the devices endpoint applies itself: device payload field -> query
+# parameter. Filters on other fields are applied locally (see withsecure_profiles.py).
+DEVICES_QUERY_FILTERS = {"type": "type", "state": "state", "online": "online"}
+
+# Query parameter that would select the fields returned for each device. The API does
+# not document one today, so devices come back whole and columns are picked locally.
+DEVICES_FIELDS_PARAM = None
+
+# Keep-alive connections kept open to the API; should cover the export worker count
+DEFAULT_POOL_SIZE = 16
+
+# Client-side request rate (requests per second) kept under the API quota.
+# Override with WITHSECURE_RATE_LIMIT; 0 disables the limiter.
+DEFAULT_RATE_LIMIT = float(os.environ.get("WITHSECURE_RATE_LIMIT", 10))
+
+# Access tokens are refreshed this many seconds before they expire
+TOKEN_REFRESH_MARGIN = 60
+
+# Retry policy for throttled or failing requests
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+DEFAULT_MAX_RETRIES = 6
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60.0
+
+# (connect, read) seconds before a stalled request is abandoned and retried
+DEFAULT_TIMEOUT = (10, 60)
+
+
+class DevicePage(list):
+    """
+    One page of devices. next_anchor is the cursor of the following page, or None
+    on the last page, so a consumer can record where an organization can resume.
+    """
+
+    def __init__(self, devices, next_anchor=None):
+        super().__init__(devices)
+        self.next_anchor = next_anchor
+
+
+class WithSecureAPIError(Exception):
+    """
+    Raised when the API answers with an error status after any retries.
+    """
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket: allows `rate` requests per second on average with
+    bursts of up to `burst` requests.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, int(rate)))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, sleeping until one is available. Returns the seconds waited.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class TokenManager:
+    """
+    Caches the OAuth2 access token with its expiry and refreshes it ahead of time.
+    Refreshes happen under a lock, so concurrent callers share a single in-flight
+    refresh instead of all hitting the token endpoint.
+    """
+
+    def __init__(self, fetch_token):
+        # fetch_token() must return (access_token, expires_in seconds)
+        self.fetch_token = fetch_token
+        self.token = None
+        self.refresh_at = 0.0
+        self.refreshes = 0
+        self.lock = threading.Lock()
+
+    def get_token(self):
+        """
+        Return a token that is not about to expire, refreshing it first if needed.
+        """
+        with self.lock:
+            if self.token is None or time.monotonic() >= self.refresh_at:
+                self._refresh()
+            return self.token
+
+    def refresh(self, stale_token):
+        """
+        Replace a token the API rejected. If another caller already replaced it, the
+        newer token is returned without a second refresh.
+        """
+        with self.lock:
+            if self.token == stale_token:
+                self._refresh()
+            return self.token
+
+    def _refresh(self):
+        token, expires_in = self.fetch_token()
+        margin = min(TOKEN_REFRESH_MARGIN, expires_in / 5)
+        self.token = token
+        self.refresh_at = time.monotonic() + expires_in - margin
+        self.refreshes += 1
+
+
+def decode_json(content):
+    """
+    Decode a JSON response body given as bytes, with orjson when available.
+    Both decoders raise a ValueError on malformed input.
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def parse_retry_after(value):
+    """
+    Return the delay in seconds requested by a Retry-After header (delta-seconds or
+    HTTP-date), or None if it is missing or unreadable.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def response_size(response):
+    """
+    Bytes received for a response: the compressed size when the body was gzipped,
+    nothing for one served from the response cache.
+    """
+    if getattr(response, "from_cache", False):
+        return 0
+    try:
+        return int(response.headers["Content-Length"])
+    except (KeyError, ValueError):
+        return len(response.content)
+
+
+def cached_response(cached, url):
+    """
+    Turn a withsecure_response_cache.CachedResponse back into a requests.Response.
+    """
+    response = requests.Response()
+    response.status_code = cached.status_code
+    response.headers.update(cached.headers)
+    response._content = cached.body
+    response.encoding = "utf-8"
+    response.url = url
+    response.from_cache = True
+    return response
+
+
+def make_session(pool_size=DEFAULT_POOL_SIZE, user_agent=None):
+    """
+    Create a requests.Session with a keep-alive connection pool of pool_size
+    connections, asking for JSON and gzip-compressed responses.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        "Accept": "application/json",
+        "Accept-Encoding": "gzip, deflate",
+        "Connection": "keep-alive"
+    })
+    if user_agent:
+        session.headers["User-Agent"] = user_agent
+    return session
+
+
+class WithSecureClient:
+    """
+    Client for the WithSecure Elements API over one pooled session, safe to share
+    between the export worker threads. Requests are paced and retried, and the access
+    token is refreshed before it expires.
+    """
+
+    def __init__(self, base_url=None, user_agent=None, pool_size=DEFAULT_POOL_SIZE, verify=True,
+                 rate_limit=DEFAULT_RATE_LIMIT, max_retries=DEFAULT_MAX_RETRIES, session=None, metrics=None,
+                 cache=None):
+        self.base_url = (base_url or API_BASE_URL).rstrip("/")
+        self.tokens = None
+        # Passed on each call: a session-level verify is overridden by REQUESTS_CA_BUNDLE
+        self.verify = verify
+        self.max_retries = max_retries
+        self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+
+        self.stats_lock = threading.Lock()
+        self.stats = {}
+        self.metrics = metrics
+        self.cache = cache
+        self.cache_scope = None
+
+        self.owns_session = session is None
+        self.session = make_session(pool_size, user_agent) if session is None else session
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.owns_session:
+            self.session.close()
+
+    def record(self, endpoint, retries=0, wait=0.0, seconds=0.0, response=None):
+        with self.stats_lock:
+            entry = self.stats.setdefault(endpoint, {"requests": 0, "retries": 0, "wait_seconds": 0.0})
+            entry["requests"] += 1
+            entry["retries"] += retries
+            entry["wait_seconds"] += wait
+
+        if self.metrics:
+            if response is None:
+                self.metrics.record_request(endpoint, seconds, 0, None, retries)
+            else:
+                self.metrics.record_request(endpoint, seconds, response_size(response), response.status_code, retries)
+
+    def request(self, method, path, endpoint, **kwargs):
+        """
+        Send a request, waiting for the rate limiter and retrying throttled or failed
+        attempts. Returns the final response, whatever its status.
+        """
+        url = f"{self.base_url}{path}"
+        kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+        retries = 0
+        wait = 0.0
+        started = time.monotonic()
+
+        while True:
+            if self.rate_limiter:
+                wait += self.rate_limiter.acquire()
+
+            try:
+                response = self.session.request(method, url, verify=self.verify, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if retries >= self.max_retries:
+                    self.record(endpoint, retries, wait, time.monotonic() - started)
+                    raise
+                delay = self.backoff(retries)
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or retries >= self.max_retries:
+                    self.record(endpoint, retries, wait, time.monotonic() - started, response)
+                    return response
+                delay = parse_retry_after(response.headers.get("Retry-After"))
+                # A far-off Retry-After would park the worker for as long; wait no longer than a backoff
+                delay = self.backoff(retries) if delay is None else min(delay, BACKOFF_MAX)
+                response.close()
+
+            time.sleep(delay)
+            retries += 1
+            wait += delay
+
+    def backoff(self, retries):
+        # Full jitter keeps concurrent workers from retrying in lockstep
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** retries)))
+
+    @property
+    def token(self):
+        return self.tokens.get_token() if self.tokens else None
+
+    def authenticate(self, client_id, client_secret):
+        """
+        Authenticate against WithSecure's OAuth2 endpoint. The credentials are kept
+        so the access token can be refreshed for the rest of the export.
+        """
+        self.tokens = TokenManager(lambda: self.fetch_token(client_id, client_secret))
+        self.cache_scope = cache_scope(client_id)
+        return self.tokens.get_token()
+
+    def fetch_token(self, client_id, client_secret):
+        """
+        Request a new access token. Returns (access_token, expires_in seconds).
+        """
+        payload = {
+            "grant_type": "client_credentials",
+            "scope": "connect.api.read"
+        }
+        response = self.request("POST", "/as/token.oauth2", "token", data=payload, auth=(client_id, client_secret))
+
+        if response.status_code != 200:
+            raise WithSecureAPIError(
+                f"Authentication failed. Status: {response.status_code}, Body: {response.text}",
+                response.status_code
+            )
+
+        body = decode_json(response.content)
+        return body["access_token"], float(body.get("expires_in", 3600))
+
+    def get(self, path, endpoint, params=None):
+        key = cached = None
+        if self.cache and self.cache_scope and self.cache.caches(endpoint):
+            key = self.cache.key_for(self.cache_scope, f"{self.base_url}{path}", params)
+            cached = self.cache.lookup(key, endpoint)
+            if cached and cached.fresh:
+                self.cache.touch(key)
+                self.record_cache(endpoint, CACHE_HIT)
+                return cached_response(cached, f"{self.base_url}{path}")
+
+        headers = cached.conditional_headers() if cached else {}
+        token = self.token
+        response = self.request(
+            "GET", path, endpoint, params=params, headers={**headers, "Authorization": f"Bearer {token}"}
+        )
+
+        # The token may have been revoked or expired early: refresh once and replay
+        if response.status_code == 401 and self.tokens:
+            response.close()
+            token = self.tokens.refresh(token)
+            response = self.request(
+                "GET", path, endpoint, params=params, headers={**headers, "Authorization": f"Bearer {token}"}
+            )
+
+        if key:
+            if cached and response.status_code == 304:
+                response.close()
+                self.cache.touch(key, revalidated=True)
+                self.record_cache(endpoint, CACHE_REVALIDATED)
+                return cached_response(cached, response.url)
+            if response.status_code == 200:
+                self.cache.store(key, response.status_code, response.headers, response.content)
+            self.record_cache(endpoint, CACHE_MISS)
+
+        response.encoding = "utf-8"
+        return response
+
+    def record_cache(self, endpoint, outcome):
+        if self.metrics:
+            self.metrics.record_cache(endpoint, outcome)
+
+    def get_organizations(self):
+        """
+        Retrieve list of organizations associated with the token.
+        """
+        response = self.get("/organizations/v1/organizations", "organizations")
+
+        if response.status_code != 200:
+            raise WithSecureAPIError(
+                f"Failed to retrieve organizations (Status: {response.status_code}): {response.text}",
+                response.status_code
+            )
+
+        return decode_json(response.content)["items"]
+
+    @property
+    def supports_updated_since(self):
+        return DEVICES_UPDATED_SINCE_PARAM is not None
+
+    def iter_device_pages(self, organization_id, limit=DEVICES_PAGE_LIMIT, updated_since=None, anchor=None,
+                          filters=None, fields=None):
+        """
+        Yield the devices of an organization one DevicePage at a time.
+        Follows the nextAnchor cursor returned by the API until the last page, so only
+        a single page of devices is held in memory at any time. updated_since limits the
+        listing to recently changed devices when the API supports such a filter, and
+        anchor resumes the listing from a previously returned cursor.
+
+        filters are extra query parameters narrowing the listing (see
+        DEVICES_QUERY_FILTERS) and fields the device fields wanted, sent only if the
+        API supports selecting them.
+        """
+        params = {"organizationId": organization_id, "limit": limit}
+        if updated_since and self.supports_updated_since:
+            params[DEVICES_UPDATED_SINCE_PARAM] = updated_since
+        if filters:
+            params.update(filters)
+        if fields and DEVICES_FIELDS_PARAM:
+            params[DEVICES_FIELDS_PARAM] = ",".join(fields)
+        if anchor:
+            params["anchor"] = anchor
+        metrics = self.metrics
+        pages = devices = size = 0
+        seconds = 0.0
+
+        while True:
+            started = time.monotonic()
+            response = self.get("/devices/v1/devices", "devices", params=params)
+
+            if response.status_code != 200:
+                raise WithSecureAPIError(
+                    f"Failed to retrieve devices for org {organization_id} "
+                    f"(Status: {response.status_code}): {response.text}",
+                    response.status_code
+                )
+
+            # Decoded straight from the raw bytes, skipping the text decoding of response.json()
+            decode_started = time.monotonic()
+            body = decode_json(response.content)
+            page = DevicePage(body.get("items", []), body.get("nextAnchor") or None)
+
+            if metrics:
+                now = time.monotonic()
+                metrics.add_work("decode", now - decode_started)
+                pages += 1
+                devices += len(page)
+                size += response_size(response)
+                seconds += now - started
+                if not page.next_anchor:
+                    metrics.record_organization(organization_id, devices, pages, size, seconds)
+            yield page
+
+            if not page.next_anchor:
+                break
+            params["anchor"] = page.next_anchor
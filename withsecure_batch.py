@@ -0,0 +1,287 @@
+"""
+Batch export across several WithSecure API accounts in one process.
+
+The accounts are read from a JSON credentials file:
+
+    [
+        {"name": "partner-eu", "client_id": "...", "client_secret_env": "PARTNER_EU_SECRET", "max_workers": 4},
+        {"name": "partner-us", "client_id": "...", "client_secret": "..."}
+    ]
+
+Every account gets its own token and rate limiter but all of them share one
+connection pool. An organization visible to several accounts is exported once,
+by the first account in the file that lists it.
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from withsecure_api import DEFAULT_POOL_SIZE, DEFAULT_RATE_LIMIT, WithSecureClient, make_session
+from withsecure_export import (
+    DEFAULT_MAX_WORKERS, EXPORT_FILENAME, export_pages, export_path_for, iter_organization_devices, name_suffix
+)
+from withsecure_fleet import FleetSummary
+from withsecure_metrics import RunMetrics
+from withsecure_response_cache import RESPONSE_CACHE_FILENAME, ResponseCache
+from withsecure_writers import OUTPUT_FORMATS, format_is_typed, open_writer
+
+# Accounts authenticated, listed or exported at the same time
+DEFAULT_MAX_ACCOUNTS = 4
+
+
+class Account:
+    """
+    One set of API credentials and what happened to it during the batch.
+    max_workers caps the organizations of this account fetched at the same time.
+    """
+
+    def __init__(self, name, client_id, client_secret, max_workers=DEFAULT_MAX_WORKERS):
+        self.name = name
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.max_workers = max_workers
+        self.client = None
+        self.organizations = []
+        self.error = None
+
+        # Run summary
+        self.auth_seconds = 0.0
+        self.listing_seconds = 0.0
+        self.export_seconds = 0.0
+        self.duplicates = 0
+        self.devices = 0
+        self.requests = 0
+        self.retries = 0
+        self.output_path = None
+
+    def summary(self):
+        return {
+            "account": self.name,
+            "organizations": len(self.organizations),
+            "duplicate_organizations": self.duplicates,
+            "devices": self.devices,
+            "auth_seconds": round(self.auth_seconds, 3),
+            "listing_seconds": round(self.listing_seconds, 3),
+            "export_seconds": round(self.export_seconds, 3),
+            "requests": self.requests,
+            "retries": self.retries,
+            "output_path": self.output_path,
+            "error": self.error,
+        }
+
+
+def load_accounts(path, default_max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Read the accounts of a credentials file. Each entry needs a name, a client_id and
+    either a client_secret or client_secret_env, the environment variable holding it.
+    Raises ValueError if the file is not usable.
+    """
+    with open(path, encoding="utf-8") as file:
+        try:
+            entries = json.load(file)
+        except ValueError as e:
+            raise ValueError(f"Credentials file {path} is not valid JSON: {e}") from None
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"Credentials file {path} must hold a non-empty list of accounts")
+
+    accounts = []
+    names = set()
+    for index, entry in enumerate(entries, start=1):
+        if not isinstance(entry, dict):
+            raise ValueError(f"Account {index} in {path} must be an object, not: {json.dumps(entry)}")
+        name = str(entry.get("name") or f"account-{index}")
+        if name in names:
+            raise ValueError(f"Duplicate account name in {path}: {name}")
+        names.add(name)
+
+        secret = entry.get("client_secret")
+        if not secret and entry.get("client_secret_env"):
+            secret = os.environ.get(entry["client_secret_env"])
+        if not entry.get("client_id") or not secret:
+            raise ValueError(f"Account {name} in {path} needs a client_id and a client_secret or client_secret_env")
+
+        accounts.append(Account(name, entry["client_id"], secret, int(entry.get("max_workers", default_max_workers))))
+    return accounts
+
+
+def account_export_path(export_folder, account_name, output_format="csv", profile_name=None):
+    base = os.path.splitext(EXPORT_FILENAME)[0] + name_suffix(account_name) + name_suffix(profile_name)
+    return os.path.join(export_folder, base + OUTPUT_FORMATS[output_format][0])
+
+
+def run_batch(accounts, export_folder, schema, merge=True, output_format="csv", max_accounts=DEFAULT_MAX_ACCOUNTS,
+              user_agent=None, base_url=None, rate_limit=DEFAULT_RATE_LIMIT, on_status=None, on_progress=None,
+              metrics=None, profile=None, use_cache=True, cache_ttls=None, fleet=None):
+    """
+    Export the devices of every account. With merge, all organizations go to one
+    withsecure_export file in account order, then organization order; otherwise each
+    account gets its own withsecure_export_<account> file. An account that fails is
+    reported in its summary and skipped without stopping the others: one that fails
+    to authenticate or list its organizations exports nothing, one whose devices
+    fail to download gets no file of its own, and in the merged file keeps only the
+    devices downloaded before the failure.
+
+    rate_limit applies to each account separately, as API quotas are per client.
+    on_status(message) and on_progress(completed, total, organization) work as for
+    run_export, over the organizations of all accounts. The calls of every account are
+    timed into metrics, a new withsecure_metrics.RunMetrics unless one is given.
+    profile, use_cache and cache_ttls work as for run_export, with one response cache
+    shared by all accounts. The devices of all accounts are counted into fleet, a new
+    withsecure_fleet.FleetSummary unless one is given, written to export_folder as
+    withsecure_fleet_summary.json and .csv. Returns the accounts with their summaries
+    filled in.
+    """
+    status = on_status or (lambda message: None)
+    metrics = metrics or RunMetrics()
+    fleet = fleet or FleetSummary()
+    if profile:
+        schema = profile.project(schema)
+    profile_name = profile.name if profile else None
+    build_rows = schema.build_records if format_is_typed(output_format) else schema.build_rows
+
+    # One pool for all accounts, large enough for every account's workers at once
+    pool_size = max(DEFAULT_POOL_SIZE, sum(account.max_workers for account in accounts))
+    session = make_session(pool_size, user_agent)
+    response_cache = ResponseCache(os.path.join(export_folder, RESPONSE_CACHE_FILENAME), cache_ttls) if use_cache else None
+    for account in accounts:
+        account.client = WithSecureClient(
+            base_url, rate_limit=rate_limit, session=session, metrics=metrics, cache=response_cache
+        )
+
+    try:
+        # Step 1 and 2: Authenticate every account and get its organizations
+        status(f"Authenticating {len(accounts)} accounts...")
+        with metrics.phase("authenticate_and_list"), ThreadPoolExecutor(max_workers=max(1, max_accounts)) as executor:
+            list(executor.map(_list_organizations, accounts))
+
+        owners = {}
+        for account in accounts:
+            organizations = [org for org in account.organizations if org["id"] not in owners]
+            account.duplicates = len(account.organizations) - len(organizations)
+            account.organizations = organizations
+            for org in organizations:
+                owners[org["id"]] = account
+            metrics.name_organizations(organizations)
+
+        total = len(owners)
+        # An account's export time runs from the start of the export to its last organization
+        started = time.monotonic()
+        progress_lock = threading.Lock()
+        completed = [0]
+
+        def report_progress(done, account_total, org):
+            account = owners[org["id"]]
+            with progress_lock:
+                completed[0] += 1
+                done = completed[0]
+                account.export_seconds = time.monotonic() - started
+            if on_progress:
+                on_progress(done, total, org)
+
+        def fetch_pages(org_id):
+            client = owners[org_id].client
+            if not profile:
+                return client.iter_device_pages(org_id)
+            pages = client.iter_device_pages(org_id, filters=profile.query_params, fields=profile.device_fields(schema))
+            return profile.filter_pages(pages)
+
+        def account_pages(org_id):
+            # Skip the rest of an account whose devices failed, so the merged file keeps the other accounts
+            account = owners[org_id]
+            if account.error is not None:
+                return
+            try:
+                yield from fetch_pages(org_id)
+            except Exception as e:
+                account.error = account.error or str(e)
+
+        def counted(pages):
+            for org, devices in pages:
+                owners[org["id"]].devices += len(devices)
+                yield org, devices
+
+        # Steps 3 and 4: Get devices for each organization and stream them to the output
+        status("Retrieving devices...")
+        active = [account for account in accounts if account.error is None]
+        with metrics.phase("export_devices"):
+            if merge:
+                organizations = [org for account in active for org in account.organizations]
+                output_path = export_path_for(export_folder, output_format=output_format, profile_name=profile_name)
+                pages = iter_organization_devices(
+                    organizations,
+                    account_pages,
+                    on_progress=report_progress,
+                    group_of=lambda org: owners[org["id"]].name,
+                    group_workers={account.name: account.max_workers for account in active}
+                )
+                writer = open_writer(output_format, output_path, schema.header, schema.fields)
+                export_pages(writer, counted(pages), build_rows, metrics, fleet)
+                for account in active:
+                    if account.error is None:
+                        account.output_path = output_path
+            else:
+                def export_account(account):
+                    output_path = account_export_path(export_folder, account.name, output_format, profile_name)
+                    pages = iter_organization_devices(
+                        account.organizations, fetch_pages, account.max_workers, report_progress
+                    )
+                    writer = open_writer(output_format, output_path, schema.header, schema.fields)
+                    try:
+                        export_pages(writer, counted(pages), build_rows, metrics, fleet)
+                    except Exception as e:
+                        # A batch is not resumed, so the partial file of a failed account is of no use
+                        account.error = str(e)
+                        if os.path.exists(writer.temp_path):
+                            os.remove(writer.temp_path)
+                        return
+                    finally:
+                        account.export_seconds = time.monotonic() - started
+                    account.output_path = output_path
+
+                with ThreadPoolExecutor(max_workers=max(1, max_accounts)) as executor:
+                    list(executor.map(export_account, active))
+            fleet.write(export_folder, name_suffix(profile_name))
+    finally:
+        for account in accounts:
+            for entry in account.client.stats.values():
+                account.requests += entry["requests"]
+                account.retries += entry["retries"]
+            account.client.close()
+        session.close()
+        if response_cache:
+            response_cache.close()
+        metrics.finish()
+
+    return accounts
+
+
+def _list_organizations(account):
+    try:
+        started = time.monotonic()
+        account.client.authenticate(account.client_id, account.client_secret)
+        account.auth_seconds = time.monotonic() - started
+
+        started = time.monotonic()
+        account.organizations = account.client.get_organizations()
+        account.listing_seconds = time.monotonic() - started
+    except Exception as e:
+        account.error = str(e)
+
+
+def format_summary(accounts):
+    """
+    Return the per-account summary as lines of a text table.
+    """
+    lines = [
+        f"{'Account':<24} {'Orgs':>6} {'Dupes':>6} {'Devices':>9} {'Auth s':>7} {'List s':>7} "
+        f"{'Export s':>9} {'Requests':>9} {'Retries':>8}  Status"
+    ]
+    for account in accounts:
+        lines.append(
+            f"{account.name[:24]:<24} {len(account.organizations):>6} {account.duplicates:>6} {account.devices:>9} "
+            f"{account.auth_seconds:>7.2f} {account.listing_seconds:>7.2f} {account.export_seconds:>9.2f} "
+            f"{account.requests:>9} {account.retries:>8}  {account.error or 'ok'}"
+        )
+    return lines
@@ -0,0 +1,449 @@
+"""
+Command line front end shared by both export tools.
+
+Runs an export without a window, for schedulers and other headless hosts:
+
+    WITHSECURE_CLIENT_ID=... WITHSECURE_CLIENT_SECRET=... \
+        python WithSecure_API_Export_Tool_Extended.py --output-dir /srv/exports --delta
+
+or for several API accounts at once (see withsecure_batch.py for the file format):
+
+    python WithSecure_API_Export_Tool_Extended.py --output-dir /srv/exports --batch accounts.json
+
+Full exports are kept in a snapshot history; --diff compares two of them without the API:
+
+    python WithSecure_API_Export_Tool_Extended.py --output-dir /srv/exports --diff
+"""
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import sys
+
+from withsecure_batch import DEFAULT_MAX_ACCOUNTS, format_summary, load_accounts, run_batch
+from withsecure_export import DEFAULT_MAX_WORKERS, export_path_for, load_checkpoint, run_export
+from withsecure_fleet import FleetSummary
+from withsecure_metrics import RunMetrics
+from withsecure_profiles import EXPORT_PROFILES, build_profile
+from withsecure_response_cache import DEFAULT_CACHE_TTLS, RESPONSE_CACHE_FILENAME
+from withsecure_shards import ShardProgress, merge_shards, parse_shard, run_sharded_export
+from withsecure_snapshots import CHANGES_FILENAME, SNAPSHOTS_KEPT, find_snapshot, list_snapshots, write_change_report
+from withsecure_writers import OUTPUT_FORMATS
+
+
+def build_parser(description):
+    parser = argparse.ArgumentParser(
+        description=description,
+        epilog="Run without arguments to open the graphical interface."
+    )
+    parser.add_argument("--client-id", default=os.environ.get("WITHSECURE_CLIENT_ID"),
+                        help="API client ID (default: $WITHSECURE_CLIENT_ID)")
+    parser.add_argument("--client-secret", default=os.environ.get("WITHSECURE_CLIENT_SECRET"),
+                        help="API client secret (default: $WITHSECURE_CLIENT_SECRET)")
+    parser.add_argument("-o", "--output-dir", required=True, help="folder the CSV file is written to")
+    parser.add_argument("--delta", action="store_true",
+                        help="write only the devices added, updated or removed since the last delta run")
+    parser.add_argument("--full-from-cache", action="store_true",
+                        help="with --delta, also write the full withsecure_export.csv from the device cache")
+    parser.add_argument("--resume", action="store_true", help="continue an interrupted full export")
+    parser.add_argument("--format", dest="output_format", choices=list(OUTPUT_FORMATS), default="csv",
+                        help="output format of a full export (default: csv); ndjson, parquet and arrow keep typed columns")
+    parser.add_argument("--max-workers", type=int, default=DEFAULT_MAX_WORKERS,
+                        help=f"organizations fetched in parallel (default: {DEFAULT_MAX_WORKERS})")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print errors and the final summary")
+
+    batch = parser.add_argument_group("batch mode")
+    batch.add_argument("--batch", metavar="CREDENTIALS_FILE",
+                       help="export every account of a JSON credentials file instead of a single client")
+    batch.add_argument("--per-account", action="store_true",
+                       help="write one file per account instead of a single merged export")
+    batch.add_argument("--max-accounts", type=int, default=DEFAULT_MAX_ACCOUNTS,
+                       help=f"accounts processed in parallel (default: {DEFAULT_MAX_ACCOUNTS})")
+
+    shards = parser.add_argument_group(
+        "sharded export", "split a full CSV export by organization across processes or machines, then merge it"
+    )
+    shards.add_argument("--shards", type=int, metavar="COUNT",
+                        help="run the export as COUNT local processes and merge their part files")
+    shards.add_argument("--shard", metavar="INDEX/COUNT",
+                        help="export only shard INDEX (from 0) of COUNT to its part file, e.g. on one of COUNT "
+                             "machines sharing the export folder")
+    shards.add_argument("--merge-shards", type=int, metavar="COUNT",
+                        help="merge the part files of a COUNT-way sharded export into withsecure_export.csv")
+
+    snapshots = parser.add_argument_group(
+        "snapshot history", f"every full CSV export is kept as a snapshot; the {SNAPSHOTS_KEPT} newest are kept"
+    )
+    snapshots.add_argument("--no-snapshot", action="store_true", help="do not keep this export as a snapshot")
+    snapshots.add_argument("--snapshots", action="store_true", help="list the snapshots of the export folder")
+    snapshots.add_argument("--diff", nargs="*", metavar="SNAPSHOT",
+                           help=f"write the devices added, removed or changed between two snapshots to "
+                                f"{CHANGES_FILENAME}: the two newest by default, SNAPSHOT and the newest, or "
+                                f"OLD NEW")
+
+    profile = parser.add_argument_group("export profile", "narrow a full export to some devices and columns")
+    profile.add_argument("--export-profile", metavar="NAME_OR_FILE",
+                         help=f"built-in profile ({', '.join(EXPORT_PROFILES)}) or a JSON profile file")
+    profile.add_argument("--filter", dest="filters", action="append", default=[], metavar="FIELD=VALUE",
+                         help="keep only devices whose field has this value, e.g. os.endOfLife=true or "
+                              "type=computer; a comma-separated value matches any of them; repeatable")
+    profile.add_argument("--columns", type=lambda text: [name.strip() for name in text.split(",") if name.strip()],
+                         help="comma-separated columns to export, by header or field name")
+
+    cache = parser.add_argument_group("response cache", f"API responses are cached in {RESPONSE_CACHE_FILENAME}")
+    cache.add_argument("--no-cache", action="store_true", help="always ask the API, neither reading nor filling the cache")
+    cache.add_argument("--cache-ttl", dest="cache_ttls", action="append", default=[], metavar="ENDPOINT=SECONDS",
+                       help="seconds responses stay fresh, per endpoint (default: "
+                            f"{', '.join(f'{name}={seconds}' for name, seconds in DEFAULT_CACHE_TTLS.items())}); "
+                            "0 disables caching of the endpoint; repeatable")
+
+    report = parser.add_argument_group("run report")
+    report.add_argument("--report", metavar="FILE",
+                        help="write a JSON report of the run: timings per step, latency percentiles per endpoint, "
+                             "bytes, retries and devices per organization")
+    report.add_argument("--prometheus", metavar="FILE",
+                        help="write the same metrics in the Prometheus text format, e.g. for the node_exporter "
+                             "textfile collector")
+    report.add_argument("--profile", metavar="FILE",
+                        help="run the export under cProfile, save the stats to FILE and print the top functions")
+    return parser
+
+
+def parse_cache_ttls(values):
+    """
+    Return the cache TTLs with the ENDPOINT=SECONDS overrides of --cache-ttl applied.
+    """
+    ttls = dict(DEFAULT_CACHE_TTLS)
+    for text in values:
+        endpoint, _, seconds = text.partition("=")
+        if endpoint not in ttls:
+            raise ValueError(f"--cache-ttl endpoint must be one of {', '.join(ttls)}, not: {endpoint}")
+        try:
+            ttls[endpoint] = float(seconds)
+        except ValueError:
+            raise ValueError(f"--cache-ttl needs a number of seconds, not: {text}") from None
+    return ttls
+
+
+def format_cache_summary(metrics):
+    """
+    One line with the response cache outcomes of a run, or None if it used no cache.
+    """
+    totals = {}
+    for counts in metrics.report()["cache"].values():
+        for outcome, count in counts.items():
+            totals[outcome] = totals.get(outcome, 0) + count
+    if not totals:
+        return None
+    return (
+        f"Response cache: {totals.get('hit', 0)} hits, {totals.get('revalidated', 0)} revalidated, "
+        f"{totals.get('miss', 0)} misses"
+    )
+
+
+# Functions listed from the --profile stats
+PROFILE_TOP_FUNCTIONS = 25
+
+
+def write_run_reports(args, metrics, log):
+    """
+    Write the --report and --prometheus files of a finished or failed run.
+    """
+    try:
+        if args.report:
+            metrics.write_report(args.report)
+            log(f"Run report written to {args.report}")
+        if args.prometheus:
+            metrics.write_prometheus(args.prometheus)
+    except OSError as e:
+        print(f"Could not write the run report: {e}", file=sys.stderr)
+
+
+def run_profiled(args, run, log):
+    """
+    Call run(), under cProfile when --profile is given. Only the calling thread is
+    profiled: building and writing rows. The fetch workers are timed in the run report.
+    """
+    if not args.profile:
+        return run()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return run()
+    finally:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        log(f"Profile written to {args.profile}")
+        if not args.quiet:
+            stats = pstats.Stats(profiler, stream=sys.stderr)
+            stats.sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+
+
+# Written next to the export of a batch run
+BATCH_SUMMARY_FILENAME = "withsecure_batch_summary.json"
+
+
+def run_batch_command(args, schema, user_agent, log, profile, cache_ttls):
+    try:
+        accounts = load_accounts(args.batch, args.max_workers)
+    except (OSError, ValueError) as e:
+        print(f"An error occurred: {e}", file=sys.stderr)
+        return 2
+
+    metrics = RunMetrics()
+    fleet = FleetSummary()
+    try:
+        run_profiled(args, lambda: run_batch(
+            accounts,
+            args.output_dir,
+            schema,
+            merge=not args.per_account,
+            output_format=args.output_format,
+            max_accounts=args.max_accounts,
+            user_agent=user_agent,
+            on_status=log,
+            on_progress=lambda completed, total, org: log(f"Processed {org['name']} ({completed}/{total})..."),
+            metrics=metrics,
+            profile=profile,
+            use_cache=not args.no_cache,
+            cache_ttls=cache_ttls,
+            fleet=fleet
+        ), log)
+    except KeyboardInterrupt:
+        print("Export interrupted.", file=sys.stderr)
+        return 130
+    except Exception as e:
+        print(f"An error occurred: {e}", file=sys.stderr)
+        return 1
+    finally:
+        with open(os.path.join(args.output_dir, BATCH_SUMMARY_FILENAME), "w", encoding="utf-8") as file:
+            json.dump([account.summary() for account in accounts], file, indent=2)
+        write_run_reports(args, metrics, log)
+
+    for line in format_summary(accounts):
+        print(line)
+    print(fleet.headline())
+    if format_cache_summary(metrics):
+        print(format_cache_summary(metrics))
+    return 1 if any(account.error for account in accounts) else 0
+
+
+def shard_arguments(args):
+    """
+    Command line options of this run that every shard process repeats.
+    """
+    arguments = ["--output-dir", args.output_dir, "--max-workers", str(args.max_workers), "--quiet"]
+    if args.export_profile:
+        arguments += ["--export-profile", args.export_profile]
+    for text in args.filters:
+        arguments += ["--filter", text]
+    if args.columns:
+        arguments += ["--columns", ",".join(args.columns)]
+    if args.no_cache:
+        arguments.append("--no-cache")
+    if args.no_snapshot:
+        arguments.append("--no-snapshot")
+    for text in args.cache_ttls:
+        arguments += ["--cache-ttl", text]
+    return arguments
+
+
+def run_shards_command(args, log):
+    """
+    Run a --shards export through processes of the running tool script, or a
+    --merge-shards merge of part files written by --shard runs.
+    """
+    metrics = RunMetrics()
+    try:
+        if args.merge_shards:
+            with metrics.phase("merge_shards"):
+                result = merge_shards(args.output_dir, args.merge_shards)
+            metrics.finish()
+        else:
+            command = [sys.executable, os.path.abspath(sys.argv[0])] + shard_arguments(args)
+            result = run_profiled(args, lambda: run_sharded_export(
+                command,
+                args.client_id,
+                args.client_secret,
+                args.output_dir,
+                args.shards,
+                resume=args.resume,
+                on_status=log,
+                on_progress=lambda completed, total, org: log(f"Processed {completed}/{total} organizations..."),
+                metrics=metrics
+            ), log)
+    except KeyboardInterrupt:
+        print("Export interrupted.", file=sys.stderr)
+        return 130
+    except Exception as e:
+        print(f"An error occurred: {e}", file=sys.stderr)
+        return 1
+    finally:
+        write_run_reports(args, metrics, log)
+
+    print(f"Exported {result.rows} rows from {result.organizations} organizations to {result.output_path}")
+    print(result.fleet.headline())
+    if result.snapshot:
+        log(f"Kept snapshot {result.snapshot.id}.")
+    return 0
+
+
+def run_snapshot_command(args):
+    """
+    List the snapshot history of the export folder, or diff two of its snapshots.
+    """
+    try:
+        snapshots = list_snapshots(args.output_dir)
+        if args.snapshots:
+            for snapshot in snapshots:
+                print(f"{snapshot.id}  {snapshot.created_at}  {snapshot.rows:>10,} rows  "
+                      f"{len(snapshot.organizations):>6,} organizations")
+            if not snapshots:
+                print("No snapshots yet.")
+            return 0
+
+        # Step 1: Pick the two snapshots to compare
+        if len(args.diff) > 2:
+            raise ValueError("--diff takes at most two snapshots")
+        if len(args.diff) == 2:
+            old, new = (find_snapshot(args.output_dir, name) for name in args.diff)
+        elif len(args.diff) == 1:
+            if not snapshots:
+                raise ValueError("No snapshots to compare with")
+            old, new = find_snapshot(args.output_dir, args.diff[0]), snapshots[-1]
+        elif len(snapshots) < 2:
+            raise ValueError("--diff needs two snapshots; run another full export first")
+        else:
+            old, new = snapshots[-2], snapshots[-1]
+
+        # Step 2: Write the change report
+        output_path = os.path.join(args.output_dir, CHANGES_FILENAME)
+        summary = write_change_report(old, new, output_path)
+    except Exception as e:
+        print(f"An error occurred: {e}", file=sys.stderr)
+        return 1
+
+    print(f"Changes from {old.id} to {new.id} written to {output_path}")
+    for line in summary.lines():
+        print(line)
+    return 0
+
+
+def main(argv, schema, user_agent=None, description="Export WithSecure device data to CSV."):
+    """
+    Run an export from command line arguments. Returns the process exit code.
+    """
+    parser = build_parser(description)
+    args = parser.parse_args(argv)
+
+    if args.batch:
+        if args.delta or args.resume:
+            parser.error("--delta and --resume do not apply to --batch")
+    elif args.per_account:
+        parser.error("--per-account requires --batch")
+    elif not (args.merge_shards or args.snapshots or args.diff is not None) and (
+            not args.client_id or not args.client_secret):
+        parser.error("--client-id and --client-secret (or WITHSECURE_CLIENT_ID and WITHSECURE_CLIENT_SECRET) are required")
+    if sum(bool(option) for option in (args.shards, args.shard, args.merge_shards)) > 1:
+        parser.error("--shards, --shard and --merge-shards cannot be combined")
+    if (args.shards or args.shard or args.merge_shards) and (args.batch or args.delta or args.output_format != "csv"):
+        parser.error("sharded exports are full csv exports of a single account")
+    if args.shards is not None and args.shards < 1:
+        parser.error("--shards needs at least 1 shard")
+    if not os.path.isdir(args.output_dir):
+        parser.error(f"export folder does not exist: {args.output_dir}")
+    if args.snapshots or args.diff is not None:
+        if args.snapshots and args.diff is not None:
+            parser.error("--snapshots and --diff cannot be combined")
+        return run_snapshot_command(args)
+    if args.resume and args.delta:
+        parser.error("--resume only applies to full exports")
+    if args.output_format != "csv" and args.delta:
+        parser.error("delta exports are only written as csv")
+    if args.full_from_cache and not args.delta:
+        parser.error("--full-from-cache requires --delta")
+    if args.resume and args.output_format != "csv":
+        parser.error("only csv exports can be resumed")
+    try:
+        profile = build_profile(args.export_profile, args.filters, args.columns)
+        if profile:
+            profile.project(schema)
+        cache_ttls = parse_cache_ttls(args.cache_ttls)
+        shard = parse_shard(args.shard) if args.shard else None
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if profile and args.delta:
+        parser.error("export profiles only apply to full exports")
+
+    def log(message):
+        if not args.quiet:
+            print(message, file=sys.stderr, flush=True)
+
+    if args.batch:
+        return run_batch_command(args, schema, user_agent, log, profile, cache_ttls)
+    if args.shards or args.merge_shards:
+        return run_shards_command(args, log)
+
+    output_path = (
+        shard.output_path(args.output_dir) if shard
+        else export_path_for(args.output_dir, profile_name=profile.name if profile else None)
+    )
+    if args.resume and not load_checkpoint(output_path):
+        log("No interrupted export to resume, starting a new one.")
+
+    # A shard reports its progress to the process or person merging the shards
+    progress = ShardProgress(
+        shard.progress_path(args.output_dir), shard, on_error=lambda message: print(message, file=sys.stderr)
+    ) if shard else None
+
+    def report_progress(completed, total, org):
+        log(f"Processed {org['name']} ({completed}/{total})...")
+        if progress:
+            progress.update(completed, total, org)
+
+    metrics = RunMetrics()
+    try:
+        result = run_profiled(args, lambda: run_export(
+            args.client_id,
+            args.client_secret,
+            args.output_dir,
+            schema,
+            delta=args.delta,
+            full_from_cache=args.full_from_cache,
+            resume=args.resume,
+            max_workers=args.max_workers,
+            user_agent=user_agent,
+            output_format=args.output_format,
+            on_status=log,
+            on_progress=report_progress,
+            metrics=metrics,
+            profile=profile,
+            use_cache=not args.no_cache,
+            cache_ttls=cache_ttls,
+            shard=shard,
+            snapshot=not args.no_snapshot
+        ), log)
+    except KeyboardInterrupt:
+        if progress:
+            progress.finish(error="interrupted")
+        print("Export interrupted.", file=sys.stderr)
+        return 130
+    except Exception as e:
+        if progress:
+            progress.finish(error=e)
+        print(f"An error occurred: {e}", file=sys.stderr)
+        return 1
+    finally:
+        write_run_reports(args, metrics, log)
+
+    if progress:
+        progress.finish(rows=result.rows)
+    print(f"Exported {result.rows} rows from {result.organizations} organizations to {result.output_path}")
+    if result.fleet:
+        print(result.fleet.headline())
+    if result.snapshot:
+        log(f"Kept snapshot {result.snapshot.id}.")
+    if format_cache_summary(metrics):
+        print(format_cache_summary(metrics))
+    return 0
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import sqlite3
+from datetime import datetime, timezone
+
+DEVICE_CACHE_FILENAME = "withsecure_device_cache.sqlite"
+
+CHANGE_ADDED = "Added"
+CHANGE_UPDATED = "Updated"
+CHANGE_REMOVED = "Removed"
+
+
+def utc_now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def row_hash(row):
+    return hashlib.sha1(json.dumps(row, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class DeviceCache:
+    """
+    Local SQLite store of the rows exported for every device, keyed by device id.
+    Each run is compared against it to find added, updated and removed devices,
+    so an incremental export only has to write what changed since the last run.
+
+    Changes are detected by hashing the exported row, so fields that change on
+    every run but are not exported (e.g. status timestamps) do not count as changes.
+    The cache is tied to the CSV header; a different header starts a fresh cache.
+    """
+
+    def __init__(self, path, header):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started_at TEXT NOT NULL,
+                finished_at TEXT
+            );
+            CREATE TABLE IF NOT EXISTS devices (
+                device_id TEXT PRIMARY KEY,
+                organization_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                row_hash TEXT NOT NULL,
+                row_json TEXT NOT NULL,
+                first_seen TEXT NOT NULL,
+                last_seen TEXT NOT NULL,
+                last_changed TEXT NOT NULL,
+                seen_run INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS devices_by_organization ON devices (organization_id, position);
+        """)
+
+        header_json = json.dumps(header)
+        stored = self.connection.execute("SELECT value FROM meta WHERE key = 'header'").fetchone()
+        if stored is None or stored[0] != header_json:
+            self.connection.execute("DELETE FROM devices")
+            self.connection.execute("DELETE FROM runs")
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('header', ?)", (header_json,))
+            self.connection.commit()
+
+        last_run = self.connection.execute(
+            "SELECT started_at FROM runs WHERE finished_at IS NOT NULL ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+        # Start time of the last completed run, for APIs that can list changes since then
+        self.updated_since = last_run[0] if last_run else None
+
+        self.run_started = utc_now()
+        self.run_id = self.connection.execute(
+            "INSERT INTO runs (started_at) VALUES (?)", (self.run_started,)
+        ).lastrowid
+
+    def close(self):
+        # Anything not committed by a completed run is rolled back
+        self.connection.close()
+
+    def merge_page(self, organization_id, rows, first_position):
+        """
+        Store one page of (device_id, row) pairs and return the (change, row) pairs
+        for devices that are new or whose row changed.
+        """
+        existing = {}
+        device_ids = [device_id for device_id, _ in rows]
+        if device_ids:
+            placeholders = ",".join("?" * len(device_ids))
+            existing = {
+                device_id: (stored_hash, first_seen)
+                for device_id, stored_hash, first_seen in self.connection.execute(
+                    f"SELECT device_id, row_hash, first_seen FROM devices WHERE device_id IN ({placeholders})",
+                    device_ids
+                )
+            }
+
+        changes = []
+        unchanged = []
+        upserts = []
+        for position, (device_id, row) in enumerate(rows, start=first_position):
+            digest = row_hash(row)
+            stored = existing.get(device_id)
+            if stored and stored[0] == digest:
+                unchanged.append((position, self.run_started, self.run_id, device_id))
+                continue
+            changes.append((CHANGE_UPDATED if stored else CHANGE_ADDED, row))
+            first_seen = stored[1] if stored else self.run_started
+            upserts.append((
+                device_id, organization_id, position, digest, json.dumps(row, ensure_ascii=False),
+                first_seen, self.run_started, self.run_started, self.run_id
+            ))
+
+        self.connection.executemany(
+            "UPDATE devices SET position = ?, last_seen = ?, seen_run = ? WHERE device_id = ?", unchanged
+        )
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", upserts
+        )
+        return changes
+
+    def remove_unseen(self, organization_id=None):
+        """
+        Delete devices not seen during this run, for one organization or for all of
+        them, and return their last exported rows.
+        """
+        condition = "seen_run < ?"
+        params = [self.run_id]
+        if organization_id is not None:
+            condition += " AND organization_id = ?"
+            params.append(organization_id)
+
+        removed = [
+            json.loads(row_json)
+            for (row_json,) in self.connection.execute(
+                f"SELECT row_json FROM devices WHERE {condition} ORDER BY organization_id, position", params
+            )
+        ]
+        self.connection.execute(f"DELETE FROM devices WHERE {condition}", params)
+        return removed
+
+    def iter_changes(self, row_pages, full_listing=True):
+        """
+        Merge a stream of (organization, [(device_id, row), ...]) pages into the cache
+        and yield (change, row) pairs for every added, updated or removed device.
+        Removals are only reported when the stream lists every device of every
+        organization (full_listing); a listing filtered on recent changes cannot tell.
+        Call finish_run() once the changes have been written out.
+        """
+        current_org_id = None
+        position = 0
+
+        for organization, rows in row_pages:
+            if organization["id"] != current_org_id:
+                if current_org_id is not None and full_listing:
+                    for row in self.remove_unseen(current_org_id):
+                        yield CHANGE_REMOVED, row
+                current_org_id = organization["id"]
+                position = 0
+
+            for change in self.merge_page(current_org_id, rows, position):
+                yield change
+            position += len(rows)
+
+        # Devices of the last organization and of organizations that no longer exist
+        if full_listing:
+            for row in self.remove_unseen():
+                yield CHANGE_REMOVED, row
+
+    def finish_run(self):
+        """
+        Commit this run so the next one is compared against it.
+        """
+        self.connection.execute("UPDATE runs SET finished_at = ? WHERE id = ?", (utc_now(), self.run_id))
+        self.connection.commit()
+
+    def iter_rows(self, organization_ids):
+        """
+        Yield the cached rows of the given organizations in export order.
+        """
+        for organization_id in organization_ids:
+            for (row_json,) in self.connection.execute(
+                "SELECT row_json FROM devices WHERE organization_id = ? ORDER BY position", (organization_id,)
+            ):
+                yield json.loads(row_json)
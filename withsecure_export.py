@@ -0,0 +1,480 @@
+import json
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from withsecure_api import WithSecureClient
+from withsecure_device_cache import DEVICE_CACHE_FILENAME, DeviceCache
+from withsecure_fleet import FleetSummary
+from withsecure_metrics import RunMetrics
+from withsecure_response_cache import RESPONSE_CACHE_FILENAME, ResponseCache
+from withsecure_snapshots import take_snapshot
+from withsecure_writers import (
+    OUTPUT_FORMATS, PARTIAL_SUFFIX, StreamingCsvWriter, format_is_typed, open_writer, write_atomically
+)
+
+# File names written to the export folder
+EXPORT_FILENAME = "withsecure_export.csv"
+DELTA_EXPORT_FILENAME = "withsecure_export_delta.csv"
+
+# Number of organizations fetched in parallel. Override with WITHSECURE_MAX_WORKERS.
+DEFAULT_MAX_WORKERS = int(os.environ.get("WITHSECURE_MAX_WORKERS", 8))
+
+# Pages buffered per organization before its worker waits for the consumer
+PAGES_BUFFERED_PER_ORG = 4
+
+# Rows encoded per chunk when writing a plain row stream
+ROWS_PER_CHUNK = 500
+
+# Progress of an interrupted export is kept next to the output in <output>.checkpoint.json.
+# Bump the version whenever the checkpoint gains state: an older checkpoint then starts a new export
+# instead of resuming with that state missing (3: fleet counts and organization offsets).
+CHECKPOINT_SUFFIX = ".checkpoint.json"
+CHECKPOINT_VERSION = 3
+
+_ORG_DONE = object()
+
+
+class _FetchFailure:
+    def __init__(self, error):
+        self.error = error
+
+
+def iter_organization_devices(organizations, fetch_pages, max_workers=DEFAULT_MAX_WORKERS, on_progress=None,
+                              group_of=None, group_workers=None):
+    """
+    Fetch the devices of many organizations concurrently.
+    Yields (organization, page) tuples in organization order, then page order, so the
+    output is identical to a serial run. fetch_pages(organization_id) must return an
+    iterator over pages of devices. on_progress(completed, total, organization) is
+    called from worker threads whenever an organization has been fully fetched.
+
+    group_of(organization) can split the organizations into groups (e.g. per API
+    account), each fetched by its own pool of group_workers[group] workers, or
+    max_workers for a group not listed.
+    """
+    total = len(organizations)
+    stop = threading.Event()
+    lock = threading.Lock()
+    completed = [0]
+    page_queues = [queue.Queue(maxsize=PAGES_BUFFERED_PER_ORG) for _ in organizations]
+
+    def put(page_queue, item):
+        # Wait for the consumer, but give up once the export has been abandoned
+        while not stop.is_set():
+            try:
+                page_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def worker(organization, page_queue):
+        # Every worker ends its queue, with the end marker or the failure, or the consumer would wait forever
+        end = _ORG_DONE
+        try:
+            if stop.is_set():
+                return
+            for page in fetch_pages(organization["id"]):
+                put(page_queue, page)
+                if stop.is_set():
+                    return
+
+            with lock:
+                completed[0] += 1
+                done = completed[0]
+            if on_progress:
+                on_progress(done, total, organization)
+        except Exception as e:
+            end = _FetchFailure(e)
+        finally:
+            put(page_queue, end)
+
+    # Workers pick organizations up in submission order, so the organization being
+    # consumed is always running or finished and later ones can never starve it.
+    # Each group keeps that order within its own pool.
+    executors = {}
+    try:
+        for organization, page_queue in zip(organizations, page_queues):
+            group = group_of(organization) if group_of else None
+            if group not in executors:
+                workers = (group_workers or {}).get(group, max_workers)
+                executors[group] = ThreadPoolExecutor(max_workers=max(1, workers))
+            executors[group].submit(worker, organization, page_queue)
+
+        for organization, page_queue in zip(organizations, page_queues):
+            while True:
+                item = page_queue.get()
+                if item is _ORG_DONE:
+                    break
+                if isinstance(item, _FetchFailure):
+                    raise item.error
+                yield organization, item
+    finally:
+        stop.set()
+        for executor in executors.values():
+            executor.shutdown(wait=True)
+
+
+def write_page(writer, build_rows, org_name, devices, state=None, metrics=None):
+    """
+    Turn a page of devices into rows with build_rows and queue them on writer,
+    recording the time spent building and encoding them in metrics.
+    """
+    if not metrics:
+        writer.write_rows(build_rows(org_name, devices), state)
+        return
+    started = time.monotonic()
+    rows = build_rows(org_name, devices)
+    built = time.monotonic()
+    writer.write_rows(rows, state)
+    metrics.add_work("build_rows", built - started)
+    # Includes any wait for the writer thread to catch up
+    metrics.add_work("encode", time.monotonic() - built)
+
+
+def write_csv(output_path, header, rows, metrics=None):
+    """
+    Stream rows to output_path through a StreamingCsvWriter.
+    Returns the number of rows written.
+    """
+    writer = StreamingCsvWriter(output_path, header)
+    count = 0
+    try:
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, ROWS_PER_CHUNK))
+            if not chunk:
+                break
+            writer.write_rows(chunk)
+            count += len(chunk)
+    except BaseException:
+        writer.close(commit=False)
+        raise
+    writer.close()
+    if metrics:
+        metrics.add_work("write", writer.write_seconds)
+    return count
+
+
+def checkpoint_path_for(output_path):
+    return output_path + CHECKPOINT_SUFFIX
+
+
+def load_checkpoint(output_path):
+    """
+    Return the saved state of an interrupted export to output_path, or None.
+    """
+    try:
+        with open(checkpoint_path_for(output_path), encoding="utf-8") as file:
+            state = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if state.get("version") != CHECKPOINT_VERSION or not os.path.exists(output_path + PARTIAL_SUFFIX):
+        return None
+    return state
+
+
+def save_checkpoint(output_path, state):
+    write_atomically(checkpoint_path_for(output_path), json.dumps(state))
+
+
+def export_csv_checkpointed(output_path, header, organizations, fetch_pages, build_rows, resume=False,
+                            max_workers=DEFAULT_MAX_WORKERS, on_progress=None, metrics=None,
+                            filters=None, fleet=None, organization_offsets=None):
+    """
+    Stream the rows of every organization to a CSV file, checkpointing as rows reach disk.
+
+    Rows go through a StreamingCsvWriter into <output>.part as each page arrives.
+    Whenever the writer flushes, the checkpoint records the organizations to export,
+    how many are complete, the cursor of the next page of the organization in
+    progress and the size of the partial file. With resume=True an interrupted
+    export is picked up from there: the partial file is cut back to the last
+    checkpoint and appended to, so the finished file is byte-identical to an
+    uninterrupted run. fetch_pages is called as fetch_pages(organization_id, anchor)
+    and must yield DevicePage objects; build_rows(org_name, devices) turns a page into
+    rows. filters describes the devices fetch_pages keeps, so a checkpoint is only
+    resumed with the same ones. The devices are counted into fleet, a
+    withsecure_fleet.FleetSummary, whose counts are checkpointed with the rows.
+    organization_offsets, if given as a list, is filled with the [organization id,
+    byte offset] of the first row of each organization in the file, so parts of an
+    export can be merged without parsing them. Returns the number of rows in the
+    finished file.
+    """
+    filters = filters or {}
+    state = load_checkpoint(output_path) if resume else None
+    if state and (state["header"] != header or state.get("filters", {}) != filters):
+        state = None
+
+    save = lambda flushed_state: save_checkpoint(output_path, flushed_state)
+    if state:
+        # The saved organization list keeps the row order of the original run
+        organizations = state["organizations"]
+        writer = StreamingCsvWriter(output_path, append_at=state["offset"], on_flush=save)
+        if fleet:
+            fleet.restore(state.get("fleet"))
+        if organization_offsets is not None:
+            organization_offsets[:] = state.get("organization_offsets", [])
+    else:
+        # A stale checkpoint must not be applied to the new partial file
+        if os.path.exists(checkpoint_path_for(output_path)):
+            os.remove(checkpoint_path_for(output_path))
+        state = {
+            "version": CHECKPOINT_VERSION,
+            "header": header,
+            "filters": filters,
+            "organizations": [{"id": org["id"], "name": org["name"]} for org in organizations],
+            "org_index": 0,
+            "anchor": None,
+            "rows": 0
+        }
+        writer = StreamingCsvWriter(output_path, header, on_flush=save)
+
+    first_index = state["org_index"]
+    remaining = organizations[first_index:]
+    resume_anchor = state["anchor"]
+    org_positions = {org["id"]: index for index, org in enumerate(remaining, start=first_index)}
+
+    def fetch_remaining(organization_id):
+        anchor = resume_anchor if org_positions[organization_id] == first_index else None
+        return fetch_pages(organization_id, anchor)
+
+    try:
+        pages = iter_organization_devices(remaining, fetch_remaining, max_workers, on_progress)
+        for org, devices in pages:
+            next_anchor = getattr(devices, "next_anchor", None)
+            state["org_index"] = org_positions[org["id"]] + (0 if next_anchor else 1)
+            state["anchor"] = next_anchor
+            state["rows"] += len(devices)
+            if fleet:
+                fleet.add_page(org, devices)
+                state["fleet"] = fleet.snapshot()
+            if organization_offsets is not None and (
+                not organization_offsets or organization_offsets[-1][0] != org["id"]
+            ):
+                organization_offsets.append([org["id"], writer.position])
+                state["organization_offsets"] = list(organization_offsets)
+            write_page(writer, build_rows, org["name"], devices, dict(state), metrics)
+    except BaseException:
+        writer.close(commit=False)
+        raise
+
+    writer.close()
+    if metrics:
+        metrics.add_work("write", writer.write_seconds)
+    if os.path.exists(checkpoint_path_for(output_path)):
+        os.remove(checkpoint_path_for(output_path))
+    return state["rows"]
+
+
+class ExportResult:
+    """
+    Outcome of run_export: the file written, how many rows it holds, how many
+    organizations were exported, the RunMetrics of the run and, for a full export,
+    the FleetSummary of the exported devices and the withsecure_snapshots.Snapshot
+    it was kept as, if any.
+    """
+
+    def __init__(self, output_path, rows, organizations, delta=False, metrics=None, fleet=None, snapshot=None):
+        self.output_path = output_path
+        self.rows = rows
+        self.organizations = organizations
+        self.delta = delta
+        self.metrics = metrics
+        self.fleet = fleet
+        self.snapshot = snapshot
+
+
+def name_suffix(name):
+    """
+    "_<name>" with the characters file names cannot hold replaced, or "" without a name.
+    """
+    return "_" + re.sub(r"[^A-Za-z0-9_.-]+", "_", name) if name else ""
+
+
+def export_path_for(export_folder, delta=False, output_format="csv", profile_name=None):
+    """
+    Path of an export. A profile export is named after its profile, e.g.
+    withsecure_export_end-of-life.csv, so it never replaces the full export.
+    """
+    if delta:
+        return os.path.join(export_folder, DELTA_EXPORT_FILENAME)
+    extension = OUTPUT_FORMATS[output_format][0]
+    return os.path.join(export_folder, os.path.splitext(EXPORT_FILENAME)[0] + name_suffix(profile_name) + extension)
+
+
+def export_pages(writer, pages, build_rows, metrics=None, fleet=None):
+    """
+    Write the devices of (organization, page) pairs through an open writer, turning
+    each page into rows or records with build_rows(org_name, devices), and commit
+    the file. The devices are counted into fleet if given. Returns the number of
+    devices written.
+    """
+    count = 0
+    try:
+        for org, devices in pages:
+            if fleet:
+                fleet.add_page(org, devices)
+            write_page(writer, build_rows, org["name"], devices, metrics=metrics)
+            count += len(devices)
+    except BaseException:
+        writer.close(commit=False)
+        raise
+    writer.close()
+    if metrics:
+        metrics.add_work("write", writer.write_seconds)
+    return count
+
+
+def run_export(client_id, client_secret, export_folder, schema, delta=False, resume=False,
+               max_workers=DEFAULT_MAX_WORKERS, user_agent=None, base_url=None, on_status=None, on_progress=None,
+               output_format="csv", metrics=None, profile=None, use_cache=True, cache_ttls=None, shard=None,
+               snapshot=True, full_from_cache=False):
+    """
+    Export the devices of every organization to export_folder with the columns of a
+    withsecure_schema.Schema: all of them, only the changes since the last delta run,
+    or one shard of them, as configured by the CLI and GUI options. Steps are reported
+    to on_status, finished organizations to on_progress. Returns an ExportResult.
+    """
+    status = on_status or (lambda message: None)
+    metrics = metrics or RunMetrics()
+    if delta and output_format != "csv":
+        raise ValueError("Delta exports are only written as CSV")
+    if delta and profile:
+        raise ValueError("Delta exports cover every device and column; export profiles apply to full exports")
+    if full_from_cache and not delta:
+        raise ValueError("Only a delta export can write the full export from the device cache")
+    if shard and (delta or output_format != "csv"):
+        raise ValueError("Sharded exports are full exports written as CSV")
+    if profile:
+        schema = profile.project(schema)
+    profile_name = profile.name if profile else None
+    output_path = (
+        shard.output_path(export_folder) if shard
+        else export_path_for(export_folder, delta, output_format, profile_name)
+    )
+
+    # One client per export so every request shares the same pooled connections
+    response_cache = ResponseCache(os.path.join(export_folder, RESPONSE_CACHE_FILENAME), cache_ttls) if use_cache else None
+    client = WithSecureClient(base_url, user_agent=user_agent, metrics=metrics, cache=response_cache)
+    cache = None
+    fleet = None if delta else FleetSummary()
+    snapshot = snapshot and not profile and not delta and output_format == "csv"
+    kept_snapshot = None
+
+    def fetch_pages(org_id, anchor=None):
+        if not profile:
+            return client.iter_device_pages(org_id, anchor=anchor)
+        pages = client.iter_device_pages(
+            org_id, anchor=anchor, filters=profile.query_params, fields=profile.device_fields(schema)
+        )
+        return profile.filter_pages(pages)
+    try:
+        # Step 1: Authenticate
+        status("Authenticating...")
+        with metrics.phase("authenticate"):
+            client.authenticate(client_id, client_secret)
+
+        # Step 2: Get organizations
+        status("Retrieving organizations...")
+        with metrics.phase("list_organizations"):
+            organizations = client.get_organizations()
+        if shard:
+            # Only this shard's organizations, in the order of the full list
+            listed = organizations
+            organizations = [org for org in organizations if shard.owns(org["id"])]
+        metrics.name_organizations(organizations)
+        status("Retrieving devices...")
+
+        with metrics.phase("export_devices"):
+            if delta:
+                # A delta export compares this run against the local device cache
+                cache = DeviceCache(os.path.join(export_folder, DEVICE_CACHE_FILENAME), schema.header)
+                updated_since = cache.updated_since
+
+                # Step 3: Get devices for each organization, several organizations at a time.
+                # Pages come back in organization order, then device order.
+                pages = iter_organization_devices(
+                    organizations,
+                    lambda org_id: client.iter_device_pages(org_id, updated_since=updated_since),
+                    max_workers,
+                    on_progress
+                )
+                row_pages = (
+                    (org, list(zip([device.get("id") for device in devices], schema.build_rows(org["name"], devices))))
+                    for org, devices in pages
+                )
+
+                # Step 4: Export only the devices changed since the last run to CSV
+                full_listing = not (updated_since and client.supports_updated_since)
+                changes = cache.iter_changes(row_pages, full_listing)
+                rows = write_csv(
+                    output_path,
+                    ["Change"] + schema.header,
+                    ([change, *row] for change, row in changes),
+                    metrics
+                )
+                cache.finish_run()
+
+                if full_from_cache:
+                    # Step 5: Write every cached device, changed or not, as the full export
+                    full_path = export_path_for(export_folder)
+                    # The full export replaces any interrupted one, whose checkpoint would no longer apply
+                    if os.path.exists(checkpoint_path_for(full_path)):
+                        os.remove(checkpoint_path_for(full_path))
+                    full_rows = write_csv(
+                        full_path, schema.header, cache.iter_rows([org["id"] for org in organizations]), metrics
+                    )
+                    status(f"Wrote {full_rows} devices from the device cache to {full_path}")
+            elif output_format != "csv":
+                # Steps 3 and 4: Get devices for each organization and stream them to the output
+                pages = iter_organization_devices(organizations, fetch_pages, max_workers, on_progress)
+                writer = open_writer(output_format, output_path, schema.header, schema.fields)
+                build_rows = schema.build_records if format_is_typed(output_format) else schema.build_rows
+                rows = export_pages(writer, pages, build_rows, metrics, fleet)
+            else:
+                # Steps 3 and 4: Get devices for each organization and stream them to the CSV,
+                # checkpointing as they reach disk so an interrupted export can be resumed
+                organization_offsets = []
+                rows = export_csv_checkpointed(
+                    output_path,
+                    schema.header,
+                    organizations,
+                    fetch_pages,
+                    schema.build_rows,
+                    resume=resume,
+                    max_workers=max_workers,
+                    on_progress=on_progress,
+                    metrics=metrics,
+                    filters=profile.filters if profile else None,
+                    fleet=fleet,
+                    organization_offsets=organization_offsets
+                )
+
+        if shard:
+            # Step 5: Index the part file; the merge summarizes and snapshots all shards
+            shard.write_index(
+                export_folder, schema.header, listed, organization_offsets, rows, fleet, snapshot, profile_name
+            )
+        else:
+            if fleet:
+                # Step 5: Summarize the fleet next to the export
+                fleet.write(export_folder, name_suffix(profile_name))
+            if snapshot:
+                # Step 6: Keep the export in the snapshot history
+                with metrics.phase("snapshot"):
+                    kept_snapshot = take_snapshot(
+                        output_path, schema.header, organizations, organization_offsets, export_folder
+                    )
+    finally:
+        client.close()
+        if cache:
+            cache.close()
+        if response_cache:
+            response_cache.close()
+        metrics.finish()
+
+    return ExportResult(output_path, rows, len(organizations), delta, metrics, fleet, kept_snapshot)
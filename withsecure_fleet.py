@@ -0,0 +1,193 @@
+"""
+Fleet aggregates computed while the export streams.
+
+FleetSummary counts every page of devices as it goes past: devices per OS and
+version, end-of-life, unencrypted and low-on-disk devices, per organization and
+in total. Its memory grows with the number of organizations and OS versions,
+never with the number of devices. The result is written next to the export as
+withsecure_fleet_summary.json and withsecure_fleet_summary.csv.
+"""
+import csv
+import json
+import os
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+
+SUMMARY_JSON_FILENAME = "withsecure_fleet_summary.json"
+SUMMARY_CSV_FILENAME = "withsecure_fleet_summary.csv"
+
+# A system drive with less free space than this counts as low on space
+LOW_FREE_SPACE_BYTES = 10 * 1024 ** 3
+
+# Counters kept per organization
+COUNTERS = (
+    "devices",
+    "online",
+    "end_of_life",
+    "unencrypted",
+    "encryption_unknown",
+    "low_free_space",
+    "free_space_unknown",
+)
+
+_EMPTY = {}
+
+
+def _new_entry(org):
+    entry = {"id": org["id"], "name": org.get("name")}
+    entry.update((name, 0) for name in COUNTERS)
+    # OS name -> version -> [devices, end-of-life devices]
+    entry["os"] = {}
+    return entry
+
+
+def _copy_entry(entry):
+    copy = dict(entry)
+    copy["os"] = {name: {version: list(counts) for version, counts in versions.items()}
+                  for name, versions in entry["os"].items()}
+    return copy
+
+
+class FleetSummary:
+    """
+    Streaming aggregates over the exported devices. add_page() is called with each
+    (organization, page of devices) in export order; pages of one organization
+    may come from several threads in a batch, so updates are locked.
+
+    snapshot() and restore() carry the counts through an export checkpoint: the
+    counters of finished organizations never change again, so a snapshot only
+    copies those of the organization in progress.
+    """
+
+    def __init__(self, low_free_space_bytes=LOW_FREE_SPACE_BYTES):
+        self.low_free_space_bytes = low_free_space_bytes
+        self.organizations = {}
+        self.last = None
+        self.lock = threading.Lock()
+
+    def add_page(self, org, devices):
+        oses = [device.get("os") or _EMPTY for device in devices]
+        os_counts = Counter(
+            (os_info.get("name") or "Unknown", os_info.get("version") or "Unknown", bool(os_info.get("endOfLife")))
+            for os_info in oses
+        )
+        encryption = [device.get("discEncryptionEnabled") for device in devices]
+        free_space = [device.get("systemDriveFreeSpace") for device in devices]
+        known_free_space = [value for value in free_space if type(value) is int]
+        threshold = self.low_free_space_bytes
+
+        with self.lock:
+            entry = self.organizations.get(org["id"])
+            if entry is None:
+                entry = self.organizations[org["id"]] = _new_entry(org)
+            self.last = entry
+
+            entry["devices"] += len(devices)
+            entry["online"] += sum(1 for device in devices if device.get("online"))
+            entry["unencrypted"] += sum(1 for value in encryption if value is False)
+            entry["encryption_unknown"] += encryption.count(None)
+            entry["low_free_space"] += sum(1 for value in known_free_space if value < threshold)
+            entry["free_space_unknown"] += len(free_space) - len(known_free_space)
+            for (name, version, end_of_life), count in os_counts.items():
+                counts = entry["os"].setdefault(name, {}).setdefault(version, [0, 0])
+                counts[0] += count
+                if end_of_life:
+                    counts[1] += count
+                    entry["end_of_life"] += count
+
+    def snapshot(self):
+        """
+        Return the counts so far as JSON-ready data for restore().
+        """
+        with self.lock:
+            entries = list(self.organizations.values())
+            if entries and entries[-1] is self.last:
+                entries[-1] = _copy_entry(entries[-1])
+            return entries
+
+    def restore(self, entries):
+        with self.lock:
+            self.organizations = {entry["id"]: _copy_entry(entry) for entry in entries or []}
+            self.last = None
+
+    def totals(self):
+        with self.lock:
+            totals = {name: sum(entry[name] for entry in self.organizations.values()) for name in COUNTERS}
+            totals["organizations"] = len(self.organizations)
+            return totals
+
+    def operating_systems(self):
+        """
+        Devices per OS name and version across the fleet, most common first.
+        """
+        merged = {}
+        with self.lock:
+            for entry in self.organizations.values():
+                for name, versions in entry["os"].items():
+                    for version, (devices, end_of_life) in versions.items():
+                        counts = merged.setdefault((name, version), [0, 0])
+                        counts[0] += devices
+                        counts[1] += end_of_life
+        return [
+            {"os_name": name, "os_version": version, "devices": devices, "end_of_life": end_of_life}
+            for (name, version), (devices, end_of_life) in sorted(merged.items(), key=lambda item: (-item[1][0], item[0]))
+        ]
+
+    def report(self):
+        with self.lock:
+            organizations = [
+                {key: value for key, value in entry.items() if key != "os"}
+                for entry in self.organizations.values()
+            ]
+        return {
+            "generated_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "low_free_space_bytes": self.low_free_space_bytes,
+            "totals": self.totals(),
+            "operating_systems": self.operating_systems(),
+            "organizations": organizations,
+        }
+
+    def headline(self):
+        """
+        One line with the numbers worth seeing first.
+        """
+        totals = self.totals()
+        return (
+            f"{totals['devices']:,} devices in {totals['organizations']:,} organizations: "
+            f"{totals['end_of_life']:,} on an end-of-life OS, {totals['unencrypted']:,} without disk encryption, "
+            f"{totals['low_free_space']:,} with under {self.low_free_space_bytes // 1024 ** 3} GB free"
+        )
+
+    def write(self, export_folder, suffix=""):
+        """
+        Write the JSON and CSV summaries to export_folder, with suffix added to their
+        names (e.g. the profile of a profile export). Returns their paths.
+        """
+        report = self.report()
+        json_path = os.path.join(export_folder, suffix.join(os.path.splitext(SUMMARY_JSON_FILENAME)))
+        with open(json_path, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2, ensure_ascii=False)
+
+        csv_path = os.path.join(export_folder, suffix.join(os.path.splitext(SUMMARY_CSV_FILENAME)))
+        with open(csv_path, "w", newline="", encoding="utf-8-sig") as file:
+            writer = csv.writer(file)
+            writer.writerow([
+                "Section", "Organization", "OS Name", "OS Version", "Devices", "Online", "End Of Life",
+                "Unencrypted", "Low Free Space"
+            ])
+            totals = report["totals"]
+            writer.writerow([
+                "Total", "", "", "", totals["devices"], totals["online"], totals["end_of_life"],
+                totals["unencrypted"], totals["low_free_space"]
+            ])
+            for entry in report["organizations"]:
+                writer.writerow([
+                    "Organization", entry["name"], "", "", entry["devices"], entry["online"], entry["end_of_life"],
+                    entry["unencrypted"], entry["low_free_space"]
+                ])
+            for entry in report["operating_systems"]:
+                writer.writerow([
+                    "OS", "", entry["os_name"], entry["os_version"], entry["devices"], "", entry["end_of_life"], "", ""
+                ])
+        return json_path, csv_path
@@ -0,0 +1,217 @@
+"""
+Tkinter front end shared by both export tools.
+
+The export itself runs on a background thread through withsecure_export.run_export;
+the window only reads the events the export posts, so it stays responsive and the
+fetch never waits for a redraw.
+"""
+import queue
+import threading
+import tkinter as tk
+import webbrowser
+from tkinter import filedialog, messagebox, ttk
+
+from withsecure_export import export_path_for, load_checkpoint, run_export
+from withsecure_fleet import SUMMARY_CSV_FILENAME
+
+# Milliseconds between two checks of the export events
+POLL_INTERVAL_MS = 100
+
+
+class WithSecureApp:
+    def __init__(self, root, schema, user_agent=None):
+        self.root = root
+        self.schema = schema
+        self.user_agent = user_agent
+        self.events = queue.Queue()
+        self.root.title("WithSecure API Export Tool")
+        self.root.geometry("480x510")
+        self.root.resizable(False, False)
+
+        self.has_acknowledged = False
+        self.warning_popup_open = False
+
+        # Main frame for centering
+        main_frame = tk.Frame(root)
+        main_frame.place(relx=0.5, rely=0.5, anchor="center")
+
+        # Title and description
+        tk.Label(main_frame, text="WithSecure API Export Tool", font=("Helvetica", 16, "bold")).grid(row=0, column=0, columnspan=3, pady=(10, 5))
+        tk.Label(main_frame, text="Retrieve device data via the WithSecure API and export it to a CSV file.").grid(row=1, column=0, columnspan=3, pady=(0, 10))
+
+        # Input fields for API setup
+        tk.Label(main_frame, text="Client ID:").grid(row=2, column=0, sticky="w")
+        self.client_id = tk.Entry(main_frame, width=40)
+        self.client_id.grid(row=2, column=1, padx=5, pady=5)
+
+        tk.Label(main_frame, text="Client Secret:").grid(row=3, column=0, sticky="w")
+        self.client_secret = tk.Entry(main_frame, width=40, show="*")
+        self.client_secret.grid(row=3, column=1, padx=5, pady=5)
+        self.client_secret.bind("<FocusIn>", self.show_security_warning)
+
+        tk.Label(main_frame, text="Export Folder:").grid(row=4, column=0, sticky="w")
+        self.export_folder = tk.Entry(main_frame, width=40)
+        self.export_folder.grid(row=4, column=1, padx=5, pady=5)
+
+        tk.Button(main_frame, text="Browse", command=self.browse_folder).grid(row=5, column=1, pady=(5, 15))
+
+        # Incremental export: only write devices added, updated or removed since the last run
+        self.delta_export = tk.BooleanVar(value=False)
+        tk.Checkbutton(main_frame, text="Delta export (changes since last run only)", variable=self.delta_export).grid(row=6, column=0, columnspan=3)
+
+        # API key explanation and link
+        tk.Label(main_frame, text="Generate API Key:").grid(row=7, column=0, columnspan=3, pady=(10, 0))
+        tk.Button(main_frame, text="Open API Key Page", command=self.open_api_key_page).grid(row=8, column=0, columnspan=3, pady=(5, 10))
+
+        # Status label and progress bar
+        self.status_label = tk.Label(main_frame, text="Status: Waiting for acknowledgment", anchor="center")
+        self.status_label.grid(row=9, column=0, columnspan=3, pady=(10, 0))
+
+        self.progress_bar = ttk.Progressbar(main_frame, length=300, mode="determinate")
+        self.progress_bar.grid(row=10, column=0, columnspan=3, pady=(5, 10))
+
+        # Start button
+        self.export_button = tk.Button(main_frame, text="Export to CSV", command=self.start_export, state="disabled")
+        self.export_button.grid(row=11, column=0, columnspan=3, pady=10)
+
+        # Footer with link
+        footer = tk.Label(main_frame, text="Made by Clément GHANEME", fg="blue", cursor="hand2")
+        footer.grid(row=12, column=0, columnspan=3, pady=10)
+        footer.bind("<Button-1>", lambda e: webbrowser.open("https://clement.business/"))
+
+    def browse_folder(self):
+        folder = filedialog.askdirectory()
+        if folder:
+            self.export_folder.delete(0, tk.END)
+            self.export_folder.insert(0, folder)
+
+    def open_api_key_page(self):
+        webbrowser.open("https://elements.withsecure.com/apps/ccr/api_keys")
+
+    def show_security_warning(self, event):
+        if not self.has_acknowledged and not self.warning_popup_open:
+            self.warning_popup_open = True
+            warning_popup = tk.Toplevel(self.root)
+            warning_popup.title("Security Warning")
+            warning_popup.geometry("400x150")
+            warning_popup.resizable(False, False)
+
+            tk.Label(warning_popup, text="To ensure the security of your WithSecure database,", wraplength=380, justify="center").pack(pady=(10, 0))
+            tk.Label(warning_popup, text="provide READ ONLY API access when generating your Client Secret.", wraplength=380, justify="center").pack(pady=(0, 10))
+
+            acknowledge_button = tk.Button(warning_popup, text="Acknowledge", state="disabled", command=lambda: self.acknowledge_warning(warning_popup))
+            acknowledge_button.pack(pady=10)
+
+            # Enable button after 2 seconds
+            self.root.after(2000, lambda: acknowledge_button.config(state="normal"))
+
+    def acknowledge_warning(self, popup):
+        self.has_acknowledged = True
+        self.warning_popup_open = False
+        self.status_label.config(text="Status: Ready")
+        self.export_button.config(state="normal")
+        popup.destroy()
+
+    def start_export(self):
+        if not self.has_acknowledged:
+            messagebox.showerror("Acknowledgment Required", "Please acknowledge the security warning before proceeding.")
+            return
+
+        client_id = self.client_id.get().strip()
+        client_secret = self.client_secret.get().strip()
+        export_folder = self.export_folder.get().strip()
+
+        if not client_id or not client_secret or not export_folder:
+            messagebox.showerror("Input Error", "Please fill in all fields.")
+            return
+
+        # An interrupted full export leaves a checkpoint next to its CSV
+        delta = self.delta_export.get()
+        resume = False
+        if not delta and load_checkpoint(export_path_for(export_folder)):
+            resume = messagebox.askyesno("Resume Export", "A previous export to this folder was interrupted. Resume it?")
+
+        self.export_button.config(state="disabled")
+        self.progress_bar["value"] = 0
+        worker = threading.Thread(
+            target=self.run_export_worker,
+            args=(client_id, client_secret, export_folder, delta, resume),
+            daemon=True
+        )
+        worker.start()
+        self.root.after(POLL_INTERVAL_MS, self.poll_events)
+
+    def run_export_worker(self, client_id, client_secret, export_folder, delta, resume):
+        """
+        Run the export off the Tk thread, posting its progress to self.events.
+        """
+        try:
+            result = run_export(
+                client_id,
+                client_secret,
+                export_folder,
+                self.schema,
+                delta=delta,
+                resume=resume,
+                user_agent=self.user_agent,
+                on_status=lambda message: self.events.put(("status", message)),
+                on_progress=lambda completed, total, org: self.events.put(("progress", completed, total, org))
+            )
+        except Exception as e:
+            self.events.put(("error", e))
+        else:
+            self.events.put(("done", result))
+
+    def poll_events(self):
+        """
+        Apply the events posted by the export. Widgets are only updated here, on the Tk thread.
+        """
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+
+            kind = event[0]
+            if kind == "status":
+                self.status_label.config(text=f"Status: {event[1]}")
+            elif kind == "progress":
+                completed, total, org = event[1:]
+                self.status_label.config(text=f"Status: Processed {org['name']} ({completed}/{total})...")
+                self.progress_bar["value"] = (completed / total) * 100
+            elif kind == "done":
+                self.status_label.config(text="Status: Completed")
+                self.export_button.config(state="normal")
+                messagebox.showinfo("Success", self.completion_message(event[1]))
+                return
+            elif kind == "error":
+                self.status_label.config(text="Status: Error")
+                self.export_button.config(state="normal")
+                messagebox.showerror("Error", f"An error occurred: {str(event[1])}")
+                return
+
+        self.root.after(POLL_INTERVAL_MS, self.poll_events)
+
+    def completion_message(self, result):
+        """
+        Text of the success dialog, with the headline numbers of a full export.
+        """
+        if not result.fleet:
+            return "Export completed successfully!"
+        totals = result.fleet.totals()
+        return (
+            "Export completed successfully!\n\n"
+            f"Devices: {totals['devices']:,} in {totals['organizations']:,} organizations\n"
+            f"Online: {totals['online']:,}\n"
+            f"End-of-life OS: {totals['end_of_life']:,}\n"
+            f"Disk encryption disabled: {totals['unencrypted']:,}\n"
+            f"Under {result.fleet.low_free_space_bytes // 1024 ** 3} GB free on the system drive: "
+            f"{totals['low_free_space']:,}\n\n"
+            f"Details: {SUMMARY_CSV_FILENAME}"
+        )
+
+
+def run_gui(schema, user_agent=None):
+    root = tk.Tk()
+    WithSecureApp(root, schema, user_agent)
+    root.mainloop()
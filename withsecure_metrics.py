@@ -0,0 +1,217 @@
+"""
+Run instrumentation: what every API call, organization and export phase cost.
+
+A RunMetrics object is handed to the client and the export functions, which
+record into it from any thread. report() summarizes the run as a JSON-ready dict
+with latency percentiles per endpoint, and prometheus_text() renders the same
+numbers in the Prometheus text exposition format (e.g. for the node_exporter
+textfile collector).
+"""
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from withsecure_writers import write_atomically
+
+# Latency percentiles reported per endpoint
+PERCENTILES = (50, 95, 99)
+
+# Prefix of every Prometheus metric name
+PROMETHEUS_PREFIX = "withsecure_export"
+
+
+def _seconds(value):
+    return None if value is None else round(value, 6)
+
+
+def percentile(sorted_values, percent):
+    """
+    Nearest-rank percentile of an already sorted list, or None if it is empty.
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class RunMetrics:
+    """
+    Thread-safe collector for one export run.
+
+    - record_request(): one API call (after retries) with its latency and size
+    - record_organization(): the devices, pages, bytes and fetch time of an organization
+    - phase(): a wall-clock step of the run, such as authenticating
+    - add_work(): time spent by any thread on a kind of work, such as decoding JSON
+    - record_cache(): a GET answered from the response cache, revalidated or missed
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.monotonic()
+        self.finished = None
+        self.endpoints = {}
+        self.organizations = {}
+        self.organization_names = {}
+        self.phases = {}
+        self.work = {}
+        self.cache = {}
+
+    def record_request(self, endpoint, seconds, size, status_code=None, retries=0):
+        with self.lock:
+            entry = self.endpoints.setdefault(endpoint, {
+                "requests": 0, "retries": 0, "errors": 0, "bytes": 0, "latencies": []
+            })
+            entry["requests"] += 1
+            entry["retries"] += retries
+            entry["bytes"] += size
+            entry["latencies"].append(seconds)
+            if status_code is None or status_code >= 400:
+                entry["errors"] += 1
+
+    def record_organization(self, organization_id, devices, pages, size, seconds):
+        with self.lock:
+            self.organizations[organization_id] = {
+                "devices": devices, "pages": pages, "bytes": size, "fetch_seconds": seconds
+            }
+
+    def name_organizations(self, organizations):
+        with self.lock:
+            self.organization_names.update((org["id"], org.get("name")) for org in organizations)
+
+    def record_cache(self, endpoint, outcome):
+        with self.lock:
+            counts = self.cache.setdefault(endpoint, {})
+            counts[outcome] = counts.get(outcome, 0) + 1
+
+    def add_work(self, kind, seconds):
+        with self.lock:
+            self.work[kind] = self.work.get(kind, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + time.monotonic() - started
+
+    def finish(self):
+        self.finished = time.monotonic()
+
+    def report(self):
+        """
+        Summarize the run as a dict that json.dump can write.
+        """
+        with self.lock:
+            duration = (self.finished or time.monotonic()) - self.started
+            endpoints = {}
+            for endpoint, entry in sorted(self.endpoints.items()):
+                latencies = sorted(entry["latencies"])
+                summary = {
+                    "mean": _seconds(sum(latencies) / len(latencies) if latencies else None),
+                    "max": _seconds(latencies[-1] if latencies else None),
+                }
+                for percent in PERCENTILES:
+                    summary[f"p{percent}"] = _seconds(percentile(latencies, percent))
+                endpoints[endpoint] = {
+                    "requests": entry["requests"],
+                    "retries": entry["retries"],
+                    "errors": entry["errors"],
+                    "bytes": entry["bytes"],
+                    "latency_seconds": summary,
+                }
+
+            # Slowest organizations first
+            organizations = [
+                {
+                    "id": organization_id,
+                    "name": self.organization_names.get(organization_id),
+                    "devices": entry["devices"],
+                    "pages": entry["pages"],
+                    "bytes": entry["bytes"],
+                    "fetch_seconds": _seconds(entry["fetch_seconds"]),
+                }
+                for organization_id, entry in self.organizations.items()
+            ]
+            organizations.sort(key=lambda entry: entry["fetch_seconds"], reverse=True)
+
+            return {
+                "started_at": self.started_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "duration_seconds": _seconds(duration),
+                "totals": {
+                    "requests": sum(entry["requests"] for entry in endpoints.values()),
+                    "retries": sum(entry["retries"] for entry in endpoints.values()),
+                    "bytes": sum(entry["bytes"] for entry in endpoints.values()),
+                    "organizations": len(organizations),
+                    "devices": sum(entry["devices"] for entry in organizations),
+                },
+                # Wall-clock time of each step of the run
+                "phases_seconds": {name: _seconds(value) for name, value in self.phases.items()},
+                # Time summed over all threads, e.g. decoding on every fetch worker
+                "work_seconds": {name: _seconds(value) for name, value in self.work.items()},
+                "endpoints": endpoints,
+                # Response cache outcomes per endpoint
+                "cache": {endpoint: dict(counts) for endpoint, counts in sorted(self.cache.items())},
+                "organizations": organizations,
+            }
+
+    def write_report(self, path):
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.report(), file, indent=2)
+
+    def prometheus_text(self):
+        """
+        Render the run in the Prometheus text exposition format.
+        """
+        report = self.report()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            full_name = f"{PROMETHEUS_PREFIX}_{name}"
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{value_}"' for key, value_ in labels)
+                lines.append(f"{full_name}{{{label_text}}} {value}" if label_text else f"{full_name} {value}")
+
+        endpoints = report["endpoints"]
+        metric("requests_total", "counter", "API requests by endpoint, after retries.",
+               [((("endpoint", name),), entry["requests"]) for name, entry in endpoints.items()])
+        metric("retries_total", "counter", "Retried API attempts by endpoint.",
+               [((("endpoint", name),), entry["retries"]) for name, entry in endpoints.items()])
+        metric("errors_total", "counter", "API requests that ended in an error by endpoint.",
+               [((("endpoint", name),), entry["errors"]) for name, entry in endpoints.items()])
+        metric("response_bytes_total", "counter", "Response bytes received by endpoint.",
+               [((("endpoint", name),), entry["bytes"]) for name, entry in endpoints.items()])
+
+        latency_samples = []
+        for name, entry in endpoints.items():
+            for percent in PERCENTILES:
+                value = entry["latency_seconds"][f"p{percent}"]
+                if value is not None:
+                    latency_samples.append(((("endpoint", name), ("quantile", str(percent / 100))), value))
+        metric("request_duration_seconds", "gauge", "API request latency percentiles by endpoint.", latency_samples)
+
+        metric("cache_requests_total", "counter", "GET requests by endpoint and response cache outcome.",
+               [((("endpoint", name), ("outcome", outcome)), count)
+                for name, counts in report["cache"].items() for outcome, count in sorted(counts.items())])
+        metric("phase_seconds", "gauge", "Wall-clock seconds of each step of the run.",
+               [((("phase", name),), value) for name, value in report["phases_seconds"].items()])
+        metric("work_seconds", "gauge", "Seconds spent on each kind of work, summed over threads.",
+               [((("work", name),), value) for name, value in report["work_seconds"].items()])
+        metric("devices_total", "gauge", "Devices exported by the run.", [((), report["totals"]["devices"])])
+        metric("organizations_total", "gauge", "Organizations exported by the run.",
+               [((), report["totals"]["organizations"])])
+        metric("duration_seconds", "gauge", "Duration of the run.", [((), report["duration_seconds"])])
+        metric("last_run_timestamp_seconds", "gauge", "Unix time the run started.",
+               [((), self.started_at.timestamp())])
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        # Textfile collectors may read it at any time
+        write_atomically(path, self.prometheus_text())
@@ -0,0 +1,187 @@
+"""
+Export profiles: which devices and columns an export keeps.
+
+A profile filters devices on fields of the device payload and can narrow the
+exported columns. Filters the devices endpoint supports (see
+withsecure_api.DEVICES_QUERY_FILTERS) are sent as query parameters, so the API
+never returns the other devices. The remaining filters are applied to each page
+on the fetch workers as it arrives, before any row is built.
+
+Profiles are built in (EXPORT_PROFILES) or read from a JSON file:
+
+    {"filters": {"type": "computer", "os.endOfLife": true}, "columns": ["Organization", "Device Name"]}
+
+A filter value can be a list, matching any of its values. Values are compared as
+text, so "0", 0 and 0.0 are the same number and true, "true" and "yes" the same flag.
+"""
+import json
+import os
+
+from withsecure_api import DEVICES_QUERY_FILTERS, DevicePage
+
+
+def _lookup(device, keys):
+    value = device
+    for key in keys:
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+# Flag values as written in filters and payloads
+_FLAG_TEXTS = {"true": "true", "yes": "true", "false": "false", "no": "false"}
+
+
+def _number_text(number):
+    return str(int(number)) if isinstance(number, float) and number.is_integer() else str(number)
+
+
+def _filter_text(value):
+    """
+    The text a filter value and a device value are compared as, and sent to the API
+    as; None for a value that cannot be compared, such as an object.
+    """
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return _number_text(value)
+    if not isinstance(value, str):
+        return None
+    text = value.strip()
+    if text.lower() in _FLAG_TEXTS:
+        return _FLAG_TEXTS[text.lower()]
+    try:
+        return _number_text(float(text))
+    except ValueError:
+        return text
+
+
+def parse_filter_value(text):
+    """
+    Parse a command line filter value: true/false are booleans and a comma-separated
+    value is a list of alternatives.
+    """
+    values = [{"true": True, "false": False}.get(part.strip().lower(), part.strip()) for part in text.split(",")]
+    return values if len(values) > 1 else values[0]
+
+
+class ExportProfile:
+    """
+    Device filters and exported columns of an export.
+    filters maps a dotted device field (e.g. "os.endOfLife") to the value, or list
+    of values, to keep. A flag filter compares the field's truth, so a missing
+    discEncryptionEnabled counts as false, as it does in the exported rows. columns
+    names the exported columns, or None for all of them. Raises ValueError for a
+    filter value that cannot be compared.
+    """
+
+    def __init__(self, name, filters=None, columns=None):
+        self.name = name
+        self.filters = dict(filters or {})
+        self.columns = list(columns) if columns else None
+
+        self.query_params = {}
+        self.checks = []
+        for path, value in self.filters.items():
+            allowed = value if isinstance(value, list) else [value]
+            if not allowed:
+                raise ValueError(f"Filter {path} of profile {name} has no values")
+            texts = [_filter_text(item) for item in allowed]
+            for item, text in zip(allowed, texts):
+                if text is None:
+                    raise ValueError(f"Filter {path} of profile {name} cannot compare devices with {item!r}")
+            if path in DEVICES_QUERY_FILTERS and len(texts) == 1:
+                self.query_params[DEVICES_QUERY_FILTERS[path]] = texts[0]
+
+            # Filters sent to the API are checked again: a parameter the API ignored
+            # must not let other devices into the export
+            if all(text in ("true", "false") for text in texts):
+                matches = lambda value, allowed=frozenset(texts): ("true" if value else "false") in allowed
+            else:
+                matches = lambda value, allowed=frozenset(texts): _filter_text(value) in allowed
+            self.checks.append((tuple(path.split(".")), matches))
+
+    def project(self, schema):
+        """
+        Return the schema narrowed to the profile's columns. Raises ValueError for a
+        filter on a field the schema reads as an object, such as "os".
+        """
+        objects = {".".join(column.keys[:depth]) for column in schema.columns for depth in range(1, len(column.keys))}
+        for path in self.filters:
+            if path in objects:
+                raise ValueError(f"Filter {path} of profile {self.name} names an object; filter on one of its fields")
+        return schema.select(self.columns) if self.columns else schema
+
+    def device_fields(self, schema):
+        """
+        Top-level device fields the schema and the filters read.
+        """
+        fields = {"id"}
+        fields.update(column.keys[0] for column in schema.columns if column.keys)
+        fields.update(path.split(".")[0] for path in self.filters)
+        return sorted(fields)
+
+    def filter_devices(self, devices):
+        for keys, matches in self.checks:
+            if len(keys) == 1:
+                key = keys[0]
+                devices = [device for device in devices if matches(device.get(key))]
+            else:
+                devices = [device for device in devices if matches(_lookup(device, keys))]
+        return devices
+
+    def filter_pages(self, pages):
+        """
+        Filter an iterator of DevicePage objects, keeping each page's cursor so a
+        checkpointed export can still resume after a page that was filtered out.
+        """
+        if not self.checks:
+            yield from pages
+            return
+        for page in pages:
+            yield DevicePage(self.filter_devices(page), page.next_anchor)
+
+
+# Profiles available by name
+EXPORT_PROFILES = {
+    "computers": ExportProfile("computers", {"type": "computer"}),
+    "online": ExportProfile("online", {"online": True}),
+    "end-of-life": ExportProfile("end-of-life", {"type": "computer", "state": "active", "os.endOfLife": True}),
+    "unencrypted": ExportProfile("unencrypted", {"type": "computer", "state": "active", "discEncryptionEnabled": False}),
+}
+
+
+def load_profile(name_or_path):
+    """
+    Return a built-in profile by name, or read one from a JSON file.
+    Raises ValueError if the file is not a usable profile.
+    """
+    if name_or_path in EXPORT_PROFILES:
+        return EXPORT_PROFILES[name_or_path]
+
+    with open(name_or_path, encoding="utf-8") as file:
+        try:
+            entry = json.load(file)
+        except ValueError as e:
+            raise ValueError(f"Profile file {name_or_path} is not valid JSON: {e}") from None
+    if not isinstance(entry, dict) or not isinstance(entry.get("filters", {}), dict):
+        raise ValueError(f"Profile file {name_or_path} must hold an object with a filters object")
+    name = os.path.splitext(os.path.basename(name_or_path))[0]
+    return ExportProfile(name, entry.get("filters"), entry.get("columns"))
+
+
+def build_profile(name_or_path=None, filters=(), columns=None):
+    """
+    Combine a named or file profile with extra "field=value" filters and a column
+    list, as given on the command line. Returns None if nothing narrows the export.
+    """
+    if not name_or_path and not filters and not columns:
+        return None
+    base = load_profile(name_or_path) if name_or_path else ExportProfile("custom")
+
+    combined = dict(base.filters)
+    for text in filters:
+        path, separator, value = text.partition("=")
+        if not separator or not path.strip():
+            raise ValueError(f"Filters are written as field=value, not: {text}")
+        combined[path.strip()] = parse_filter_value(value)
+    return ExportProfile(base.name, combined, columns or base.columns)
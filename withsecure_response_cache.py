@@ -0,0 +1,171 @@
+"""
+On-disk cache of API responses.
+
+Organization lists hardly ever change and an investigation often exports the
+same tenant several times within minutes, so successful GET responses are kept
+in a SQLite file next to the export. A response younger than the TTL of its
+endpoint is served without a request. An older one is revalidated with
+If-None-Match / If-Modified-Since when the API sent an ETag or Last-Modified
+header, and replaced otherwise. The least recently used responses are evicted
+once the cache outgrows its size limit.
+
+Entries are keyed by API account as well as URL, so accounts sharing an export
+folder never see each other's responses.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+RESPONSE_CACHE_FILENAME = "withsecure_response_cache.sqlite"
+
+# Seconds a response is served without asking the API, per endpoint. Endpoints not
+# listed (e.g. the token endpoint) are never cached.
+DEFAULT_CACHE_TTLS = {
+    "organizations": 3600,
+    "devices": 300,
+}
+
+# Size of the cached response bodies above which the least recently used are evicted
+DEFAULT_CACHE_MAX_BYTES = 512 * 1024 ** 2
+
+# Bodies are stored zlib-compressed: device pages shrink several times over at a
+# fraction of the cost of downloading them again
+CACHE_COMPRESSION_LEVEL = 1
+
+# Outcomes counted per endpoint
+CACHE_HIT = "hit"
+CACHE_MISS = "miss"
+CACHE_REVALIDATED = "revalidated"
+
+
+def cache_scope(client_id):
+    """
+    Key prefix of an API account's responses; the client ID itself is not stored.
+    """
+    return hashlib.sha256(client_id.encode("utf-8")).hexdigest()[:16]
+
+
+class CachedResponse:
+    """
+    A stored response. fresh tells whether it can be served without asking the API.
+    """
+
+    def __init__(self, key, status_code, headers, body, fresh):
+        self.key = key
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.fresh = fresh
+
+    def conditional_headers(self):
+        headers = {}
+        if self.headers.get("ETag"):
+            headers["If-None-Match"] = self.headers["ETag"]
+        if self.headers.get("Last-Modified"):
+            headers["If-Modified-Since"] = self.headers["Last-Modified"]
+        return headers
+
+
+class ResponseCache:
+    """
+    Thread-safe SQLite store of compressed API response bodies, bounded to max_bytes.
+    ttls maps an endpoint name to the seconds its responses stay fresh.
+    """
+
+    def __init__(self, path, ttls=None, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.ttls = dict(DEFAULT_CACHE_TTLS if ttls is None else ttls)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # A lost cache only costs a download, so it is not worth an fsync per response
+        self.connection.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = OFF;
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                status_code INTEGER NOT NULL,
+                headers_json TEXT NOT NULL,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                stored_at REAL NOT NULL,
+                used_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS responses_by_use ON responses (used_at);
+        """)
+        self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.evictions = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def caches(self, endpoint):
+        return bool(self.ttls.get(endpoint))
+
+    def key_for(self, scope, url, params=None):
+        query = json.dumps(sorted((str(key), str(value)) for key, value in (params or {}).items()))
+        return hashlib.sha256(f"{scope}\n{url}\n{query}".encode("utf-8")).hexdigest()
+
+    def lookup(self, key, endpoint):
+        """
+        Return the CachedResponse stored under key, or None if there is none or it is
+        stale without a validator to revalidate it with.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT status_code, headers_json, body, stored_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        status_code, headers_json, body, stored_at = row
+        headers = json.loads(headers_json)
+        fresh = time.time() - stored_at < self.ttls.get(endpoint, 0)
+        if not fresh and not (headers.get("ETag") or headers.get("Last-Modified")):
+            return None
+        return CachedResponse(key, status_code, headers, zlib.decompress(body), fresh)
+
+    def touch(self, key, revalidated=False):
+        """
+        Mark an entry as just used; a revalidated entry is fresh again for a full TTL.
+        """
+        now = time.time()
+        with self.lock:
+            if revalidated:
+                self.connection.execute("UPDATE responses SET stored_at = ?, used_at = ? WHERE key = ?", (now, now, key))
+            else:
+                self.connection.execute("UPDATE responses SET used_at = ? WHERE key = ?", (now, key))
+            self.connection.commit()
+
+    def store(self, key, status_code, headers, body):
+        """
+        Keep a response, then evict the least recently used ones over max_bytes.
+        Only the validators of the headers are kept.
+        """
+        kept = {name: headers[name] for name in ("ETag", "Last-Modified") if headers.get(name)}
+        body = zlib.compress(body, CACHE_COMPRESSION_LEVEL)
+        now = time.time()
+        with self.lock:
+            previous = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, status_code, json.dumps(kept), body, len(body), now, now)
+            )
+            self.size += len(body) - (previous[0] if previous else 0)
+            if self.size > self.max_bytes:
+                self._evict()
+            self.connection.commit()
+
+    def _evict(self):
+        # Oldest used first, down to 90% of the limit so eviction does not run on every store
+        target = self.max_bytes * 0.9
+        evicted = []
+        for key, size in self.connection.execute("SELECT key, size FROM responses ORDER BY used_at"):
+            if self.size <= target:
+                break
+            evicted.append((key,))
+            self.size -= size
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self.evictions += len(evicted)
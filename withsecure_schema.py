@@ -0,0 +1,173 @@
+"""
+Declarative description of the exported columns.
+
+Each tool lists its columns once as Column(header, source path, converter). The
+schema then turns a whole page of devices into rows at once: every column is
+extracted and converted in one pass over the page, instead of a dozen lookups
+and conversions per device.
+"""
+from datetime import datetime, timezone
+
+GIGABYTE = 1024 ** 3
+
+# Preformatted "N GB" labels for the sizes devices actually have
+_GB_LABELS = [f"{gigabytes} GB" for gigabytes in range(8192)]
+
+_EMPTY = {}
+
+
+def bytes_to_gb_str(value_bytes):
+    """
+    Convert a byte count to a string representing gigabytes (GB) rounded to the nearest whole number.
+    If conversion fails or value_bytes is not numeric, return "N/A".
+    """
+    try:
+        gigabytes = round(int(value_bytes) / GIGABYTE)
+        return f"{gigabytes} GB"
+    except (ValueError, TypeError):
+        return "N/A"
+
+
+def bytes_or_none(value_bytes):
+    """
+    Return a byte count as an integer, or None if it is missing or not numeric.
+    """
+    try:
+        return int(value_bytes)
+    except (ValueError, TypeError):
+        return None
+
+
+def parse_timestamp(value):
+    """
+    Parse an ISO 8601 timestamp from the API into a UTC datetime, or None.
+    """
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+# Batch converters: each takes the values of one column for a whole page
+
+def yes_no(values):
+    return ["Yes" if value else "No" for value in values]
+
+
+def gigabytes(values):
+    if set(map(type, values)) == {int}:
+        # A page of plain byte counts, by far the common case: divide and round the
+        # whole column at once and look the labels up instead of formatting them
+        labels = _GB_LABELS
+        size = len(labels)
+        return [
+            labels[rounded] if 0 <= rounded < size else f"{rounded} GB"
+            for rounded in map(round, [value / GIGABYTE for value in values])
+        ]
+    return [bytes_to_gb_str(value) for value in values]
+
+
+# Typed conversions for NDJSON, Parquet and Arrow, by field type
+TYPED_CONVERTERS = {
+    "string": None,
+    "int": lambda values: [value if type(value) is int else bytes_or_none(value) for value in values],
+    "float": lambda values: [float(value) if isinstance(value, (int, float)) else None for value in values],
+    "bool": lambda values: [bool(value) for value in values],
+    "timestamp": lambda values: [parse_timestamp(value) for value in values],
+}
+
+
+class Column:
+    """
+    One exported column.
+    path is the dotted location of the value in the device payload (e.g. "os.name"),
+    or None for the organization name. convert(values) formats a page of values for
+    CSV, with default standing in for missing ones. field and field_type describe the
+    column in typed outputs, where missing values are None.
+    """
+
+    def __init__(self, header, path, convert=None, default="N/A", field=None, field_type="string"):
+        if field_type not in TYPED_CONVERTERS:
+            raise ValueError(f"Unknown field type: {field_type}")
+        self.header = header
+        self.path = path
+        self.keys = tuple(path.split(".")) if path else ()
+        self.convert = convert
+        self.default = default
+        self.field = field or header.lower().replace(" ", "_")
+        self.field_type = field_type
+
+    def extract(self, org_name, devices, default, parents=None):
+        """
+        Return the values of this column for a page of devices. parents caches the
+        nested objects (e.g. every device's "os") shared by the columns of a page.
+        """
+        keys = self.keys
+        if not keys:
+            return [org_name] * len(devices)
+        if len(keys) == 1:
+            key = keys[0]
+            return [device.get(key, default) for device in devices]
+        if len(keys) == 2:
+            outer, inner = keys
+            if parents is None:
+                parents = {}
+            if outer not in parents:
+                parents[outer] = [device.get(outer) or _EMPTY for device in devices]
+            return [parent.get(inner, default) for parent in parents[outer]]
+
+        values = []
+        for device in devices:
+            value = device
+            for key in keys:
+                value = value.get(key) if isinstance(value, dict) else None
+            values.append(default if value is None else value)
+        return values
+
+    def csv_values(self, org_name, devices, parents=None):
+        values = self.extract(org_name, devices, self.default, parents)
+        return self.convert(values) if self.convert else values
+
+    def typed_values(self, org_name, devices, parents=None):
+        values = self.extract(org_name, devices, None, parents)
+        convert = TYPED_CONVERTERS[self.field_type]
+        return convert(values) if convert else values
+
+
+class Schema:
+    """
+    The ordered columns of an export. build_rows() gives the formatted CSV rows of a
+    page of devices and build_records() the typed records, both as tuples.
+    """
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.header = [column.header for column in self.columns]
+        self.fields = [(column.field, column.field_type) for column in self.columns]
+
+    def build_rows(self, org_name, devices):
+        parents = {}
+        columns = [column.csv_values(org_name, devices, parents) for column in self.columns]
+        return list(zip(*columns))
+
+    def build_records(self, org_name, devices):
+        parents = {}
+        columns = [column.typed_values(org_name, devices, parents) for column in self.columns]
+        return list(zip(*columns))
+
+    def select(self, names):
+        """
+        Return a schema of only the named columns, in the given order. Columns are
+        named by CSV header or typed field name. Raises ValueError for unknown names.
+        """
+        by_name = {}
+        for column in self.columns:
+            by_name[column.header] = column
+            by_name[column.field] = column
+        unknown = [name for name in names if name not in by_name]
+        if unknown:
+            raise ValueError(f"Unknown columns: {', '.join(unknown)}")
+        return Schema(by_name[name] for name in names)
@@ -0,0 +1,381 @@
+"""
+Sharded export: one export split across several processes or machines.
+
+One process decodes JSON and builds rows under a single GIL, so a very large
+estate can be split into shards by a hash of the organization ID. Every shard
+lists the organizations, keeps those that hash to it and runs a normal
+checkpointed CSV export of them into its own part file,
+withsecure_export.shard-<index>-of-<count>.csv, indexed by the byte offset at
+which each organization starts. merge_shards() then copies those byte ranges
+into withsecure_export.csv in the order of the organization list, without
+parsing a row.
+
+The hash is the same on every machine, so shards can run anywhere that writes to
+the same export folder:
+
+    python WithSecure_API_Export_Tool_Extended.py --output-dir /srv/exports --shard 0/4    (one per machine)
+    python WithSecure_API_Export_Tool_Extended.py --output-dir /srv/exports --merge-shards 4
+
+or as local processes with --shards 4. Each shard reports its progress in
+withsecure_export.shard-<index>-of-<count>.csv.progress.json, which read_progress()
+collects for a front end.
+"""
+import hashlib
+import json
+import os
+import subprocess
+import threading
+import time
+
+from withsecure_api import DEFAULT_RATE_LIMIT
+from withsecure_export import ExportResult, export_path_for, name_suffix
+from withsecure_fleet import FleetSummary
+from withsecure_metrics import RunMetrics
+from withsecure_snapshots import take_snapshot
+from withsecure_writers import PARTIAL_SUFFIX, write_atomically
+
+# Part file of shard <index> of <count>, next to its index and progress report
+SHARD_FILENAME = "withsecure_export.shard-{index}-of-{count}.csv"
+SHARD_INDEX_SUFFIX = ".index.json"
+SHARD_PROGRESS_SUFFIX = ".progress.json"
+
+# Seconds between two progress reports of a shard, and between two reads of them
+PROGRESS_INTERVAL = 0.5
+
+# Bytes copied at a time by the merge
+MERGE_CHUNK_BYTES = 1024 ** 2
+
+# Status of a shard in its progress report
+SHARD_RUNNING = "running"
+SHARD_DONE = "done"
+SHARD_FAILED = "failed"
+
+
+def shard_of(org_id, count):
+    """
+    Shard an organization belongs to. Unlike hash(), the same in every process and on
+    every machine.
+    """
+    digest = hashlib.sha1(org_id.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+
+class Shard:
+    """
+    Shard index (from 0) of count. run_export exports the organizations it owns to
+    output_path() and describes the finished file in the index merge_shards reads.
+    """
+
+    def __init__(self, index, count):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"A shard is INDEX/COUNT with 0 <= INDEX < COUNT, not: {index}/{count}")
+        self.index = index
+        self.count = count
+
+    def __str__(self):
+        return f"{self.index}/{self.count}"
+
+    def owns(self, org_id):
+        return shard_of(org_id, self.count) == self.index
+
+    def output_path(self, export_folder):
+        return os.path.join(export_folder, SHARD_FILENAME.format(index=self.index, count=self.count))
+
+    def index_path(self, export_folder):
+        return self.output_path(export_folder) + SHARD_INDEX_SUFFIX
+
+    def progress_path(self, export_folder):
+        return self.output_path(export_folder) + SHARD_PROGRESS_SUFFIX
+
+    def write_index(self, export_folder, header, organizations, organization_offsets, rows, fleet=None,
+                    snapshot=False, profile_name=None):
+        """
+        Describe the finished part file: its header, the full organization list (the
+        order of the merged export), the offset of the first row of each of this
+        shard's organizations, its rows, its fleet counts, whether the merged export
+        should be kept as a snapshot and the export profile it was run with.
+        """
+        write_atomically(self.index_path(export_folder), json.dumps({
+            "shard": self.index,
+            "count": self.count,
+            "header": header,
+            "organizations": [{"id": org["id"], "name": org["name"]} for org in organizations],
+            "offsets": organization_offsets,
+            "rows": rows,
+            "fleet": fleet.snapshot() if fleet else None,
+            "snapshot": snapshot,
+            "profile": profile_name
+        }))
+
+    def read_index(self, export_folder):
+        path = self.index_path(export_folder)
+        try:
+            with open(path, encoding="utf-8") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            raise ValueError(f"Shard {self} has not finished: {path} is missing") from None
+
+
+def parse_shard(text):
+    """
+    Parse a shard written as INDEX/COUNT, e.g. 0/4.
+    """
+    index, _, count = text.partition("/")
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise ValueError(f"A shard is written as INDEX/COUNT, e.g. 0/4, not: {text}") from None
+    return Shard(index, count)
+
+
+class ShardProgress:
+    """
+    Progress report of a running shard, a small JSON file rewritten at most every
+    PROGRESS_INTERVAL seconds. update() takes the arguments of run_export's
+    on_progress and may be called from the fetch worker threads.
+
+    A report that cannot be written (e.g. while another process has the file open
+    on Windows) is passed to on_error and tried again with the next update: the
+    progress report must never stop the shard's export.
+    """
+
+    def __init__(self, path, shard, on_error=None):
+        self.path = path
+        self.on_error = on_error
+        self.lock = threading.Lock()
+        self.last_write = 0.0
+        self.report = {
+            "shard": shard.index,
+            "count": shard.count,
+            "pid": os.getpid(),
+            "status": SHARD_RUNNING,
+            "completed": 0,
+            "total": None,
+            "organization": None,
+            "rows": None,
+            "error": None
+        }
+        self._write()
+
+    def update(self, completed, total, organization):
+        with self.lock:
+            self.report.update(completed=completed, total=total, organization=organization["name"])
+            if completed == total or time.monotonic() - self.last_write >= PROGRESS_INTERVAL:
+                self._write()
+
+    def finish(self, rows=None, error=None):
+        with self.lock:
+            self.report.update(
+                status=SHARD_FAILED if error else SHARD_DONE,
+                rows=rows,
+                error=str(error) if error else None
+            )
+            self._write()
+
+    def _write(self):
+        self.report["updated_at"] = time.time()
+        self.last_write = time.monotonic()
+        try:
+            write_atomically(self.path, json.dumps(self.report))
+        except OSError as e:
+            if self.on_error:
+                self.on_error(f"Could not write the progress of shard {self.report['shard']}: {e}")
+
+
+def read_progress(export_folder, count):
+    """
+    The latest progress report of each shard of a count-way export, None for a
+    shard that has not reported yet.
+    """
+    reports = []
+    for index in range(count):
+        try:
+            with open(Shard(index, count).progress_path(export_folder), encoding="utf-8") as file:
+                reports.append(json.load(file))
+        except (OSError, ValueError):
+            reports.append(None)
+    return reports
+
+
+def run_sharded_export(command, client_id, client_secret, export_folder, count, resume=False, on_status=None,
+                       on_progress=None, metrics=None):
+    """
+    Run a count-way sharded export as local processes, then merge the part files.
+
+    command starts a tool script with the options every shard shares; each process
+    gets --shard INDEX/COUNT appended and the credentials in its environment. The
+    account's rate limit is split evenly between the processes, as the API quota is
+    per client. With resume, shards that finished in an earlier run are kept and
+    the others resume from their checkpoints.
+
+    on_status and on_progress work as for run_export, with the organizations of all
+    shards added up from their progress reports. The shard and merge steps are
+    timed into metrics. Returns the ExportResult of the merged export.
+    """
+    status = on_status or (lambda message: None)
+    metrics = metrics or RunMetrics()
+    shards = [Shard(index, count) for index in range(count)]
+    env = dict(os.environ, WITHSECURE_CLIENT_ID=client_id, WITHSECURE_CLIENT_SECRET=client_secret)
+    if DEFAULT_RATE_LIMIT:
+        env["WITHSECURE_RATE_LIMIT"] = str(DEFAULT_RATE_LIMIT / count)
+
+    pending = []
+    for shard in shards:
+        finished = os.path.exists(shard.index_path(export_folder)) and os.path.exists(shard.output_path(export_folder))
+        if resume and finished:
+            continue
+        for path in (shard.index_path(export_folder), shard.progress_path(export_folder)):
+            if os.path.exists(path):
+                os.remove(path)
+        pending.append(shard)
+
+    try:
+        status(f"Exporting {len(pending)} of {count} shards...")
+        processes = []
+        with metrics.phase("export_shards"):
+            try:
+                for shard in pending:
+                    processes.append(subprocess.Popen(
+                        command + ["--shard", str(shard)] + (["--resume"] if resume else []),
+                        env=env,
+                        stdout=subprocess.DEVNULL
+                    ))
+                reported = 0
+                while True:
+                    running = any(process.poll() is None for process in processes)
+                    reports = [report for report in read_progress(export_folder, count) if report]
+                    completed = sum(report["completed"] for report in reports)
+                    if on_progress and reports and completed != reported:
+                        reported = completed
+                        total = sum(report["total"] or 0 for report in reports)
+                        latest = max(reports, key=lambda report: report["updated_at"])
+                        on_progress(completed, max(total, completed), {"name": latest["organization"] or ""})
+                    if not running:
+                        break
+                    time.sleep(PROGRESS_INTERVAL)
+            except BaseException:
+                for process in processes:
+                    process.terminate()
+                    process.wait()
+                raise
+
+        failed = [shard for shard, process in zip(pending, processes) if process.returncode != 0]
+        if failed:
+            reports = read_progress(export_folder, count)
+            errors = "; ".join(
+                f"shard {shard}: {(reports[shard.index] or {}).get('error') or 'exited with an error'}"
+                for shard in failed
+            )
+            raise RuntimeError(f"{len(failed)} of {count} shards failed ({errors}). Run again with --resume to retry them.")
+
+        status("Merging shards...")
+        with metrics.phase("merge_shards"):
+            result = merge_shards(export_folder, count)
+    finally:
+        metrics.finish()
+    result.metrics = metrics
+    return result
+
+
+def merge_shards(export_folder, count, keep_parts=False):
+    """
+    Join the part files of a count-way sharded export into withsecure_export.csv, or
+    the file of the export profile the shards were run with.
+
+    The organizations come out in the order of the organization list, each one's
+    rows copied as a byte range of its part file, so the merged file is the same
+    as a single-process export of the same devices. The fleet summary of all shards
+    is written next to it, the export is kept in the snapshot history unless the
+    shards were run without one, and the part files are removed unless keep_parts.
+    Returns an ExportResult.
+    """
+    shards = [Shard(index, count) for index in range(count)]
+    indexes = [shard.read_index(export_folder) for shard in shards]
+    header = indexes[0]["header"]
+    if any(index["header"] != header for index in indexes):
+        raise ValueError("The shards were exported with different columns")
+    profile_name = indexes[0].get("profile")
+    if any(index.get("profile") != profile_name for index in indexes):
+        raise ValueError("The shards were exported with different export profiles")
+
+    # Organizations in the order of the first shard's list, then any only another shard listed
+    order = {}
+    organizations = []
+    for index in indexes:
+        for org in index["organizations"]:
+            if org["id"] not in order:
+                order[org["id"]] = len(order)
+                organizations.append(org)
+
+    # (position in the export, shard, start, end) of every organization's rows
+    ranges = []
+    header_bytes = None
+    for number, (shard, index) in enumerate(zip(shards, indexes)):
+        path = shard.output_path(export_folder)
+        size = os.path.getsize(path)
+        offsets = index["offsets"]
+        data_start = offsets[0][1] if offsets else size
+        with open(path, "rb") as file:
+            shard_header = file.read(data_start)
+        if header_bytes is None:
+            header_bytes = shard_header
+        elif shard_header != header_bytes:
+            raise ValueError(f"Part file of shard {shard} does not start with the header of the others")
+        for (org_id, start), (_, end) in zip(offsets, offsets[1:] + [[None, size]]):
+            if not data_start <= start <= end <= size:
+                raise ValueError(f"Part file of shard {shard} does not match its index")
+            ranges.append((order[org_id], number, start, end, org_id))
+    ranges.sort()
+
+    # Consecutive organizations of the same shard are adjacent in its file: copy them in one go
+    copies = []
+    organization_offsets = []
+    position = len(header_bytes)
+    for _, number, start, end, org_id in ranges:
+        organization_offsets.append([org_id, position])
+        position += end - start
+        if copies and copies[-1][0] == number and copies[-1][2] == start:
+            copies[-1][2] = end
+        else:
+            copies.append([number, start, end])
+
+    output_path = export_path_for(export_folder, profile_name=profile_name)
+    temp_path = output_path + PARTIAL_SUFFIX
+    files = [open(shard.output_path(export_folder), "rb") for shard in shards]
+    try:
+        with open(temp_path, "wb") as output:
+            output.write(header_bytes)
+            for number, start, end in copies:
+                source = files[number]
+                source.seek(start)
+                remaining = end - start
+                while remaining:
+                    chunk = source.read(min(MERGE_CHUNK_BYTES, remaining))
+                    if not chunk:
+                        raise ValueError(f"Part file of shard {shards[number]} is shorter than its index")
+                    output.write(chunk)
+                    remaining -= len(chunk)
+    finally:
+        for file in files:
+            file.close()
+    os.replace(temp_path, output_path)
+
+    fleet = FleetSummary()
+    entries = [entry for index in indexes for entry in index["fleet"] or []]
+    fleet.restore(sorted(entries, key=lambda entry: order.get(entry["id"], len(order))))
+    fleet.write(export_folder, name_suffix(profile_name))
+
+    snapshot = None
+    if all(index.get("snapshot") for index in indexes):
+        snapshot = take_snapshot(output_path, header, organizations, organization_offsets, export_folder)
+
+    if not keep_parts:
+        for shard in shards:
+            for path in (shard.output_path(export_folder), shard.index_path(export_folder),
+                         shard.progress_path(export_folder)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    return ExportResult(
+        output_path, sum(index["rows"] for index in indexes), len(order), fleet=fleet, snapshot=snapshot
+    )
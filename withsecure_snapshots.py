@@ -0,0 +1,313 @@
+"""
+Snapshot history of full exports, and a diff between any two of them.
+
+Every full CSV export is kept as a snapshot in the withsecure_snapshots folder of
+the export folder:
+
+- <id>.csv.gz holds the rows sorted by organization ID, then by device name and
+  serial number. Each organization is a gzip member of its own, so the file is a
+  valid gzip CSV as a whole and any organization can be read without the others.
+- <id>.json indexes it: the header, and the offset, size and rows of each organization.
+
+<id> is the UTC time of the export, so snapshots sort by age. diff_snapshots()
+compares two snapshots one organization at a time with a merge-join over the
+sorted rows, decompressing as it goes, so its memory does not grow with the fleet.
+"""
+import codecs
+import csv
+import io
+import json
+import os
+import zlib
+from collections import Counter
+from datetime import datetime, timezone
+from operator import itemgetter
+
+from withsecure_device_cache import CHANGE_ADDED, CHANGE_REMOVED, CHANGE_UPDATED
+from withsecure_writers import PARTIAL_SUFFIX, write_atomically
+
+SNAPSHOT_FOLDER = "withsecure_snapshots"
+CHANGES_FILENAME = "withsecure_changes.csv"
+
+# Snapshots kept per export folder; the oldest are deleted
+SNAPSHOTS_KEPT = 30
+
+# Rows are sorted on these columns, where the header has them, within each organization
+SNAPSHOT_KEY_COLUMNS = ("Device Name", "Serial Number")
+
+# Not compared between snapshots: a renamed organization would otherwise change every device
+ORGANIZATION_COLUMN = "Organization"
+
+SNAPSHOT_COMPRESSION_LEVEL = 6
+
+# Compressed bytes read at a time when streaming an organization
+READ_CHUNK_BYTES = 256 * 1024
+
+# Distinct old -> new values counted per column in a diff summary; the rest are only counted
+TRANSITIONS_KEPT = 1000
+
+
+def _getter(header, names):
+    # Values of the named columns of a row, always as a tuple so one and several columns compare alike
+    indexes = [header.index(name) for name in names]
+    if len(indexes) == 1:
+        return lambda row: (row[indexes[0]],)
+    return itemgetter(*indexes) if indexes else (lambda row: ())
+
+
+def _compress(rows):
+    # One complete gzip member
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerows(rows)
+    compressor = zlib.compressobj(SNAPSHOT_COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress(buffer.getvalue().encode("utf-8")) + compressor.flush()
+
+
+class Snapshot:
+    """
+    A stored snapshot, read from its index file.
+    """
+
+    def __init__(self, index_path):
+        with open(index_path, encoding="utf-8") as file:
+            index = json.load(file)
+        self.index_path = index_path
+        self.data_path = os.path.splitext(index_path)[0] + ".csv.gz"
+        self.id = index["id"]
+        self.created_at = index["created_at"]
+        self.header = index["header"]
+        self.key = index["key"]
+        self.rows = index["rows"]
+        self.organizations = index["organizations"]
+
+    def iter_rows(self, entry):
+        """
+        Yield the rows of one organization entry of the index, in key order.
+        """
+        decompressor = zlib.decompressobj(31)
+        decoder = codecs.getincrementaldecoder("utf-8")()
+
+        def lines():
+            pending = ""
+            with open(self.data_path, "rb") as file:
+                file.seek(entry["offset"])
+                remaining = entry["size"]
+                while remaining:
+                    data = file.read(min(READ_CHUNK_BYTES, remaining))
+                    if not data:
+                        raise ValueError(f"Snapshot {self.id} is shorter than its index")
+                    remaining -= len(data)
+                    text = pending + decoder.decode(decompressor.decompress(data))
+                    # The csv reader joins the lines of a quoted field back together
+                    *complete, pending = text.split("\n")
+                    for line in complete:
+                        yield line + "\n"
+            if pending:
+                yield pending
+
+        return csv.reader(lines())
+
+
+def snapshot_folder(export_folder):
+    return os.path.join(export_folder, SNAPSHOT_FOLDER)
+
+
+def list_snapshots(export_folder):
+    """
+    The snapshots of an export folder, oldest first.
+    """
+    folder = snapshot_folder(export_folder)
+    if not os.path.isdir(folder):
+        return []
+    names = sorted(name for name in os.listdir(folder) if name.endswith(".json"))
+    return [Snapshot(os.path.join(folder, name)) for name in names]
+
+
+def find_snapshot(export_folder, name):
+    """
+    A snapshot of export_folder by ID, or by the path of its index file.
+    """
+    if os.path.isfile(name):
+        return Snapshot(name)
+    for snapshot in list_snapshots(export_folder):
+        if snapshot.id == name:
+            return snapshot
+    raise ValueError(f"No snapshot {name} in {snapshot_folder(export_folder)}")
+
+
+def take_snapshot(export_path, header, organizations, organization_offsets, export_folder, kept=SNAPSHOTS_KEPT):
+    """
+    Store a finished CSV export as a snapshot and delete all but the kept newest.
+
+    organization_offsets are the [organization id, offset of its first row] pairs of
+    the export, as filled in by export_csv_checkpointed; organizations give their
+    names. One organization's rows are sorted in memory at a time. Returns the Snapshot.
+    """
+    folder = snapshot_folder(export_folder)
+    os.makedirs(folder, exist_ok=True)
+    created_at = datetime.now(timezone.utc)
+    snapshot_id = created_at.strftime("%Y%m%dT%H%M%SZ")
+    suffix = 1
+    while os.path.exists(os.path.join(folder, snapshot_id + ".json")):
+        # "_" sorts after ".", so a later snapshot of the same second lists after the first
+        suffix += 1
+        snapshot_id = f"{created_at.strftime('%Y%m%dT%H%M%SZ')}_{suffix}"
+
+    key = [name for name in SNAPSHOT_KEY_COLUMNS if name in header]
+    key_of = _getter(header, key)
+    names = {org["id"]: org["name"] for org in organizations}
+    size = os.path.getsize(export_path)
+    blocks = sorted(
+        (org_id, start, end)
+        for (org_id, start), (_, end) in zip(organization_offsets, organization_offsets[1:] + [[None, size]])
+    )
+
+    data_path = os.path.join(folder, snapshot_id + ".csv.gz")
+    entries = []
+    rows_total = 0
+    with open(export_path, "rb") as source, open(data_path + PARTIAL_SUFFIX, "wb") as output:
+        output.write(_compress([header]))
+        for org_id, start, end in blocks:
+            source.seek(start)
+            rows = list(csv.reader(io.StringIO(source.read(end - start).decode("utf-8"), newline="")))
+            rows.sort(key=lambda row: (key_of(row), row))
+            offset = output.tell()
+            output.write(_compress(rows))
+            entries.append({
+                "id": org_id, "name": names.get(org_id), "offset": offset, "size": output.tell() - offset,
+                "rows": len(rows)
+            })
+            rows_total += len(rows)
+    os.replace(data_path + PARTIAL_SUFFIX, data_path)
+
+    index_path = os.path.join(folder, snapshot_id + ".json")
+    write_atomically(index_path, json.dumps({
+        "id": snapshot_id,
+        "created_at": created_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "header": header,
+        "key": key,
+        "rows": rows_total,
+        "organizations": entries
+    }, ensure_ascii=False))
+
+    snapshots = list_snapshots(export_folder)
+    for snapshot in snapshots[:max(0, len(snapshots) - kept)]:
+        os.remove(snapshot.data_path)
+        os.remove(snapshot.index_path)
+    return Snapshot(index_path)
+
+
+def _join_rows(old_rows, new_rows, key_of_old, key_of_new, values_of_old, values_of_new, columns):
+    # Both sides are sorted on (key, row): walk them together, pairing equal keys in order
+    old_row = next(old_rows, None)
+    new_row = next(new_rows, None)
+    while old_row is not None or new_row is not None:
+        if new_row is None or (old_row is not None and key_of_old(old_row) < key_of_new(new_row)):
+            yield CHANGE_REMOVED, old_row, None, ()
+            old_row = next(old_rows, None)
+        elif old_row is None or key_of_new(new_row) < key_of_old(old_row):
+            yield CHANGE_ADDED, None, new_row, ()
+            new_row = next(new_rows, None)
+        else:
+            old_values = values_of_old(old_row)
+            new_values = values_of_new(new_row)
+            if old_values != new_values:
+                yield CHANGE_UPDATED, old_row, new_row, [
+                    (column, old_value, new_value)
+                    for column, old_value, new_value in zip(columns, old_values, new_values)
+                    if old_value != new_value
+                ]
+            old_row = next(old_rows, None)
+            new_row = next(new_rows, None)
+
+
+def diff_snapshots(old, new):
+    """
+    Compare two snapshots and yield (change, organization name, device key, column
+    changes) for every added, removed or updated device, where the device key holds
+    the values of the key columns and column changes are (column, old value, new
+    value) triples. Only the columns both snapshots have are compared.
+    """
+    if old.key != new.key:
+        raise ValueError(f"Snapshots {old.id} and {new.id} are sorted on different columns")
+    columns = [name for name in new.header if name in old.header and name != ORGANIZATION_COLUMN]
+    key_of_old, key_of_new = _getter(old.header, old.key), _getter(new.header, new.key)
+    values_of_old, values_of_new = _getter(old.header, columns), _getter(new.header, columns)
+
+    old_entries = iter(old.organizations)
+    new_entries = iter(new.organizations)
+    old_entry = next(old_entries, None)
+    new_entry = next(new_entries, None)
+    while old_entry is not None or new_entry is not None:
+        if new_entry is None or (old_entry is not None and old_entry["id"] < new_entry["id"]):
+            pair = (old_entry, None)
+            old_entry = next(old_entries, None)
+        elif old_entry is None or new_entry["id"] < old_entry["id"]:
+            pair = (None, new_entry)
+            new_entry = next(new_entries, None)
+        else:
+            pair = (old_entry, new_entry)
+            old_entry = next(old_entries, None)
+            new_entry = next(new_entries, None)
+
+        name = (pair[1] or pair[0])["name"]
+        old_rows = old.iter_rows(pair[0]) if pair[0] else iter(())
+        new_rows = new.iter_rows(pair[1]) if pair[1] else iter(())
+        for change, old_row, new_row, changes in _join_rows(
+            old_rows, new_rows, key_of_old, key_of_new, values_of_old, values_of_new, columns
+        ):
+            device_key = key_of_new(new_row) if new_row is not None else key_of_old(old_row)
+            yield change, name, device_key, changes
+
+
+class DiffSummary:
+    """
+    Counts of a diff: devices added, removed and updated, and per column the devices
+    whose value changed with the most common old -> new values.
+    """
+
+    def __init__(self):
+        self.devices = Counter()
+        self.columns = Counter()
+        self.transitions = {}
+
+    def add(self, change, column_changes):
+        self.devices[change] += 1
+        for column, old_value, new_value in column_changes:
+            self.columns[column] += 1
+            transitions = self.transitions.setdefault(column, Counter())
+            if (old_value, new_value) in transitions or len(transitions) < TRANSITIONS_KEPT:
+                transitions[(old_value, new_value)] += 1
+
+    def lines(self, transitions_shown=3):
+        lines = [
+            f"{self.devices[CHANGE_ADDED]:,} devices added, {self.devices[CHANGE_REMOVED]:,} removed, "
+            f"{self.devices[CHANGE_UPDATED]:,} updated"
+        ]
+        for column, count in self.columns.most_common():
+            common = ", ".join(
+                f"{old_value or '(empty)'} -> {new_value or '(empty)'}: {transition_count:,}"
+                for (old_value, new_value), transition_count in self.transitions[column].most_common(transitions_shown)
+            )
+            lines.append(f"  {column}: {count:,} devices ({common})")
+        return lines
+
+
+def write_change_report(old, new, output_path):
+    """
+    Write the diff of two snapshots to a CSV file, one line per added or removed
+    device and per changed column of an updated device. Returns a DiffSummary.
+    """
+    summary = DiffSummary()
+    temp_path = output_path + PARTIAL_SUFFIX
+    with open(temp_path, "w", newline="", encoding="utf-8-sig") as file:
+        writer = csv.writer(file)
+        writer.writerow(["Change", "Organization"] + new.key + ["Column", "Old Value", "New Value"])
+        for change, organization, device_key, column_changes in diff_snapshots(old, new):
+            summary.add(change, column_changes)
+            if not column_changes:
+                writer.writerow([change, organization, *device_key, "", "", ""])
+            for column, old_value, new_value in column_changes:
+                writer.writerow([change, organization, *device_key, column, old_value, new_value])
+    os.replace(temp_path, output_path)
+    return summary
@@ -0,0 +1,334 @@
+"""
+Output writers for the export.
+
+Every writer streams rows to <output>.part from a background thread and renames
+the finished file into place. CSV keeps the formatted, spreadsheet-friendly rows;
+NDJSON, Parquet and Arrow keep typed records (integers, booleans, timestamps) for
+analytics pipelines. Parquet and Arrow need pyarrow and zstd compression needs
+zstandard; both are only imported when such an output is asked for.
+"""
+import csv
+import gzip
+import io
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+# Output is written to <output>.part and renamed to <output> once complete
+PARTIAL_SUFFIX = ".part"
+
+# Written data is flushed to disk (and checkpointed) at least this often, in seconds
+FLUSH_INTERVAL = 2.0
+
+# Encoded chunks queued for the writer thread before producers wait
+WRITE_QUEUE_CHUNKS = 16
+
+# Compression levels: fast enough to keep up with the API, still well below plain size
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Rows per Parquet row group / Arrow record batch
+ROW_GROUP_SIZE = 65536
+
+
+def write_atomically(path, text):
+    """
+    Write text to path through a temporary file renamed over it, so a crash or a
+    reader on another process never sees a half-written file.
+    """
+    temp_path = path + PARTIAL_SUFFIX
+    with open(temp_path, "w", encoding="utf-8") as file:
+        file.write(text)
+    os.replace(temp_path, path)
+
+
+class StreamingWriter:
+    """
+    Producer/consumer file writer.
+    Rows are encoded by the caller and handed to a background thread that appends
+    them to <output>.part, flushing at least every FLUSH_INTERVAL seconds. close()
+    renames the finished file to the output path in one atomic step, so readers
+    never see a half-written export. on_flush(state) is called on the writer thread
+    after each flush with the state passed alongside the last written rows, its
+    "offset" set to the size of the file flushed so far. write_seconds adds up the
+    time the writer thread spent writing.
+
+    Subclasses implement encode(rows), called on the producer's thread, and may
+    override open_stream(), write_chunk() and finish(), called on the writer thread.
+    """
+
+    def __init__(self, output_path, append_at=None, on_flush=None):
+        self.output_path = output_path
+        self.temp_path = output_path + PARTIAL_SUFFIX
+        self.on_flush = on_flush
+        self.error = None
+        self.write_seconds = 0.0
+
+        if append_at is None:
+            self.file = open(self.temp_path, "wb")
+        else:
+            # Continue a partial file, dropping anything written after append_at
+            self.file = open(self.temp_path, "r+b")
+            self.file.truncate(append_at)
+            self.file.seek(append_at)
+
+        self.stream = self.open_stream(self.file)
+        self.chunks = queue.Queue(maxsize=WRITE_QUEUE_CHUNKS)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def open_stream(self, file):
+        return file
+
+    def encode(self, rows):
+        raise NotImplementedError
+
+    def write_chunk(self, chunk):
+        self.stream.write(chunk)
+
+    def finish(self):
+        # Completes the stream (e.g. a compression trailer) without closing the file
+        if self.stream is not self.file:
+            self.stream.close()
+
+    def write_rows(self, rows, state=None):
+        """
+        Encode rows and queue them for the writer thread.
+        """
+        self._put((self.encode(rows), state))
+
+    def _put(self, item):
+        while True:
+            if self.error:
+                raise self.error
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _run(self):
+        last_flush = time.monotonic()
+        pending_state = None
+        try:
+            while True:
+                item = self.chunks.get()
+                if item is None:
+                    break
+                chunk, state = item
+                started = time.monotonic()
+                self.write_chunk(chunk)
+                self.write_seconds += time.monotonic() - started
+                if state is not None:
+                    pending_state = state
+                    pending_state["offset"] = self.file.tell()
+                if time.monotonic() - last_flush >= FLUSH_INTERVAL:
+                    self._flush(pending_state)
+                    pending_state = None
+                    last_flush = time.monotonic()
+            started = time.monotonic()
+            self.finish()
+            self.write_seconds += time.monotonic() - started
+            self._flush(pending_state, finished=True)
+        except Exception as e:
+            self.error = e
+
+    def _flush(self, state, finished=False):
+        if not finished:
+            self.stream.flush()
+        self.file.flush()
+        if state is not None and self.on_flush:
+            self.on_flush(state)
+
+    def close(self, commit=True):
+        """
+        Wait for queued rows to be written. With commit, rename the finished file to
+        the output path; otherwise the partial file is kept for a later resume.
+        """
+        if self.thread.is_alive():
+            self._put(None)
+            self.thread.join()
+        self.file.close()
+        if self.error:
+            raise self.error
+        if commit:
+            os.replace(self.temp_path, self.output_path)
+
+
+def compress_stream(file, compression):
+    """
+    Wrap a binary file in a gzip or zstd compressor; compression=None returns it as is.
+    """
+    if compression is None:
+        return file
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=file, mode="wb", compresslevel=GZIP_LEVEL)
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("zstd output requires the zstandard package: pip install zstandard") from None
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(file, closefd=False)
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+class StreamingCsvWriter(StreamingWriter):
+    """
+    CSV rows of formatted strings, UTF-8 with a BOM so Excel opens the file as
+    UTF-8, optionally compressed with gzip or zstd. position is the number of
+    bytes encoded so far, before compression; for an uncompressed file it is the
+    offset the next rows will be written at.
+    """
+
+    def __init__(self, output_path, header=None, append_at=None, on_flush=None, compression=None):
+        self.compression = compression
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.position = append_at or 0
+        super().__init__(output_path, append_at, on_flush)
+
+        if header is not None:
+            # Add BOM to ensure Excel opens the file as UTF-8
+            self.buffer.write("\ufeff")
+            self.write_rows([header])
+
+    def open_stream(self, file):
+        return compress_stream(file, self.compression)
+
+    def encode(self, rows):
+        self.writer.writerows(rows)
+        chunk = self.buffer.getvalue().encode("utf-8")
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.position += len(chunk)
+        return chunk
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class StreamingNdjsonWriter(StreamingWriter):
+    """
+    One JSON object per line and per record, keyed by field name, optionally
+    compressed with gzip or zstd. Timestamps are written as ISO 8601 strings.
+    """
+
+    def __init__(self, output_path, fields, compression=None):
+        self.names = [name for name, _ in fields]
+        self.compression = compression
+        super().__init__(output_path)
+
+    def open_stream(self, file):
+        return compress_stream(file, self.compression)
+
+    def encode(self, records):
+        names = self.names
+        lines = [
+            json.dumps(dict(zip(names, record)), ensure_ascii=False, default=_json_default)
+            for record in records
+        ]
+        return ("\n".join(lines) + "\n").encode("utf-8") if lines else b""
+
+
+def _arrow_schema(pyarrow, fields):
+    # Field types a typed record can use
+    types = {
+        "string": pyarrow.string(),
+        "int": pyarrow.int64(),
+        "float": pyarrow.float64(),
+        "bool": pyarrow.bool_(),
+        "timestamp": pyarrow.timestamp("s", tz="UTC"),
+    }
+    return pyarrow.schema([(name, types[field_type]) for name, field_type in fields])
+
+
+class StreamingArrowWriter(StreamingWriter):
+    """
+    Typed records in Parquet (file_format="parquet", zstd-compressed columns) or in
+    the Arrow IPC file format (file_format="arrow"). Records are gathered on the
+    writer thread and written as one row group / record batch per ROW_GROUP_SIZE rows.
+    """
+
+    def __init__(self, output_path, fields, file_format="parquet"):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError(f"{file_format} output requires the pyarrow package: pip install pyarrow") from None
+        self.pyarrow = pyarrow
+        self.schema = _arrow_schema(pyarrow, fields)
+        self.file_format = file_format
+        self.pending = []
+        self.table_writer = None
+        super().__init__(output_path)
+
+    def open_stream(self, file):
+        if self.file_format == "parquet":
+            import pyarrow.parquet
+            self.table_writer = pyarrow.parquet.ParquetWriter(file, self.schema, compression="zstd")
+        else:
+            self.table_writer = self.pyarrow.ipc.new_file(file, self.schema)
+        return file
+
+    def encode(self, records):
+        # Columns are built per row group on the writer thread
+        return records
+
+    def write_chunk(self, records):
+        self.pending.extend(records)
+        if len(self.pending) >= ROW_GROUP_SIZE:
+            self._write_row_group(self.pending[:ROW_GROUP_SIZE])
+            del self.pending[:ROW_GROUP_SIZE]
+
+    def _write_row_group(self, records):
+        columns = list(zip(*records)) if records else [[] for _ in self.schema]
+        arrays = [
+            self.pyarrow.array(column, type=field.type)
+            for column, field in zip(columns, self.schema)
+        ]
+        batch = self.pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema)
+        if self.file_format == "parquet":
+            self.table_writer.write_table(self.pyarrow.Table.from_batches([batch]))
+        else:
+            self.table_writer.write_batch(batch)
+
+    def finish(self):
+        if self.pending:
+            self._write_row_group(self.pending)
+            self.pending = []
+        self.table_writer.close()
+
+
+# Output format name -> (file extension, typed records, writer factory(output_path, header, fields))
+OUTPUT_FORMATS = {
+    "csv": (".csv", False, lambda path, header, fields: StreamingCsvWriter(path, header)),
+    "csv.gz": (".csv.gz", False, lambda path, header, fields: StreamingCsvWriter(path, header, compression="gzip")),
+    "csv.zst": (".csv.zst", False, lambda path, header, fields: StreamingCsvWriter(path, header, compression="zstd")),
+    "ndjson": (".ndjson", True, lambda path, header, fields: StreamingNdjsonWriter(path, fields)),
+    "ndjson.gz": (".ndjson.gz", True, lambda path, header, fields: StreamingNdjsonWriter(path, fields, "gzip")),
+    "ndjson.zst": (".ndjson.zst", True, lambda path, header, fields: StreamingNdjsonWriter(path, fields, "zstd")),
+    "parquet": (".parquet", True, lambda path, header, fields: StreamingArrowWriter(path, fields, "parquet")),
+    "arrow": (".arrow", True, lambda path, header, fields: StreamingArrowWriter(path, fields, "arrow")),
+}
+
+
+def format_is_typed(output_format):
+    return OUTPUT_FORMATS[output_format][1]
+
+
+def open_writer(output_format, output_path, header=None, fields=None):
+    """
+    Open the writer for an OUTPUT_FORMATS entry. CSV formats take the header of the
+    formatted rows, typed formats the (name, type) fields of the records.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
+    _, typed, factory = OUTPUT_FORMATS[output_format]
+    if typed and not fields:
+        raise ValueError(f"{output_format} output needs typed record fields")
+    return factory(output_path, header, fields)